@@ -0,0 +1,243 @@
+"""
+Top-N contribution analysis with early pruning.
+
+To find the largest contributors to a fragment's LCIA result, one would compute the whole result with
+frag_flow_lcia(), which builds a summary for every node of every subfragment record, and then sort it.
+top_contributors() instead searches the traversal record best-first, and stops as soon as the leading contributors
+are known.
+
+A contributor is either a leaf of the traversal-- a fragment flow terminated to a process, a context, or a remote
+subfragment-- (by='flow'), or the term node of such leaves, summed over every leaf that shares it (by='process').  A
+leaf's result is its node weight in the whole traversal (signed as in frag_flow_lcia()) times the unit score of its
+termination.  A leaf of a subfragment that occurs several times in the traversal is a separate contributor each time.
+
+The search is guided by an upper bound on the magnitude of everything within each subfragment record: the sum, over
+the record's leaves, of absolute node weight times absolute unit score, plus the bounds of its own subfragments.  The
+bound is computed once per distinct record, from the terminations' unit scores (cached, or computed on first use),
+without building any LciaResult, and scaled by the node weight of each occurrence.  Leaves and subfragment occurrences
+are taken from a queue in descending order of their bounds (a leaf's bound is the magnitude of its result), so that
+an occurrence is only expanded if it might hold a leading contributor.  The search stops when:
+ * by='flow': n leaves have been taken, since nothing left in the queue can exceed them
+ * by='process': the n leading processes can no longer be displaced by what is left in the queue
+ * the largest bound left in the queue is below the threshold
+ * the queue is empty
+
+The sum of the bounds left in the queue is reported as 'pruned'.  It bounds the magnitude of every result not
+examined, so that with by='process', each reported result is within 'pruned' of the process's exact result.
+"""
+
+import heapq
+
+from .terminations import UnresolvedAnchor, UnCachedScore
+
+
+BY = ('flow', 'process')
+
+
+class Contribution(object):
+    """
+    A single contributor to an LCIA result.
+     entity: the leaf FragmentFlow (by='flow'), or the term node of the leaves (by='process')
+     node_weight: the leaf's signed node weight in the whole traversal (by='flow'), or None
+     result: the contribution to the LCIA result
+    """
+    def __init__(self, entity, node_weight, result):
+        self.entity = entity
+        self.node_weight = node_weight
+        self.result = result
+
+    def __repr__(self):
+        return 'Contribution(%s, %.6g)' % (self.entity, self.result)
+
+
+class Contributions(object):
+    """
+    The result of top_contributors(): contributions in descending order of magnitude.
+     quantity: the LCIA quantity
+     by: 'flow' or 'process'
+     bound: the bound on the magnitude of the whole traversal's result
+     pruned: the bound on the magnitude of all results not examined
+     expanded: the number of subfragment occurrences that were expanded
+    """
+    def __init__(self, quantity, by, contributions, bound, pruned, expanded):
+        self.quantity = quantity
+        self.by = by
+        self.contributions = contributions
+        self.bound = bound
+        self.pruned = pruned
+        self.expanded = expanded
+
+    def __iter__(self):
+        return iter(self.contributions)
+
+    def __len__(self):
+        return len(self.contributions)
+
+    def __getitem__(self, item):
+        return self.contributions[item]
+
+    def show(self):
+        for c in self.contributions:
+            print('%10.4g %s' % (c.result, c.entity))
+        if self.pruned:
+            print('%10.4g (bound on results not examined)' % self.pruned)
+
+
+def _record_entries(fragmentflows, quantity, scenario, kwargs):
+    """
+    The leaves and subfragment occurrences of a single traversal record, following _frag_flow_lcia_steps
+    :return: (leaves as (ff, node weight, unit score), subfragments as (ff, node weight))
+    """
+    leaves = []
+    subs = []
+    first = True
+    for ff in fragmentflows:
+        if ff.term.is_null:
+            continue
+
+        node_weight = ff.node_weight
+        if node_weight == 0:
+            continue
+
+        if ff.term.direction == ff.fragment.direction:
+            node_weight *= -1
+
+        if len(ff.subfragments) > 0:
+            subs.append((ff, node_weight))
+            first = False
+            continue
+
+        try:
+            v = ff.term.score_cache(quantity=quantity, **kwargs)
+        except UnresolvedAnchor:
+            first = False
+            continue
+        except UnCachedScore:
+            v = ff.term.term_node.fragment_lcia(quantity, scenario=scenario)
+            leaves.append((ff, node_weight, v.total()))
+            if first:
+                break  # bail out, as frag_flow_lcia()
+            continue
+
+        if not v.is_null:
+            leaves.append((ff, node_weight, v.total()))
+        first = False
+    return leaves, subs
+
+
+def _record_bounds(fragmentflows, quantity, scenario, kwargs):
+    """
+    Entries and magnitude bounds of the traversal record and every distinct subfragment record within it, children
+    before parents, on an explicit stack
+    :return: dict of id(record): (leaves, subfragments, bound)
+    """
+    records = dict()
+    visited = set()
+    stack = [(fragmentflows, scenario, False)]
+    while stack:
+        ffs, sc, done = stack.pop()
+        k = id(ffs)
+        if done:
+            leaves, subs = _record_entries(ffs, quantity, sc, kwargs)
+            bound = sum(abs(nw * s) for _, nw, s in leaves)
+            bound += sum(abs(nw) * records[id(ff.subfragments)][2] for ff, nw in subs)
+            records[k] = (leaves, subs, bound)
+            continue
+        if k in visited:
+            continue
+        visited.add(k)
+        stack.append((ffs, sc, True))
+        for ff in ffs:
+            if len(ff.subfragments) > 0 and not ff.term.is_null and id(ff.subfragments) not in visited:
+                stack.append((ff.subfragments, ff.subfragment_scenarios, False))
+    return records
+
+
+def _settled(totals, n, pruned):
+    """
+    Whether the n leading processes are known, whatever the results not yet examined
+    """
+    if len(totals) < n:
+        return pruned == 0
+    mags = heapq.nlargest(n + 1, (abs(v) for v in totals.values()))
+    nxt = mags[n] if len(mags) > n else 0.0
+    return mags[n - 1] - pruned >= nxt + pruned
+
+
+class _Search(object):
+    """
+    The best-first queue of leaves and subfragment occurrences, with the sum of the bounds it holds
+    """
+    def __init__(self, records):
+        self.records = records
+        self.queue = []
+        self.pruned = 0.0
+        self._seq = 0  # breaks ties in insertion order
+
+    def _push(self, b, ff, node_weight, unit_score):
+        heapq.heappush(self.queue, (-b, self._seq, ff, node_weight, unit_score))
+        self._seq += 1
+        self.pruned += b
+
+    def enqueue(self, record, scale):
+        leaves, subs, _ = self.records[id(record)]
+        for ff, nw, s in leaves:
+            self._push(abs(scale * nw * s), ff, scale * nw, s)
+        for ff, nw in subs:
+            self._push(abs(scale * nw) * self.records[id(ff.subfragments)][2], ff, scale * nw, None)
+
+    def peek(self):
+        return -self.queue[0][0]
+
+    def pop(self):
+        b, _, ff, nw, s = heapq.heappop(self.queue)
+        self.pruned = max(self.pruned + b, 0.0)
+        if not self.queue:
+            self.pruned = 0.0
+        return ff, nw, s
+
+
+def top_contributors(fragmentflows, quantity, n=10, by='flow', threshold=0.0, scenario=None, **kwargs):
+    """
+    Find the leading contributors to the LCIA result of a traversal record, without expanding subfragment records
+    that cannot hold any.
+    :param fragmentflows: a traversal record
+    :param quantity: a quantity ref
+    :param n: [10] number of contributors.  None finds every contributor above the threshold.
+    :param by: ['flow'] contributors are leaf fragment flows ('flow') or term nodes ('process')
+    :param threshold: [0.0] a magnitude below which results and subfragment occurrences are not examined
+    :param scenario: necessary if any remote traversals are required
+    :param kwargs: passed to score_cache()
+    :return: a Contributions
+    """
+    if by not in BY:
+        raise ValueError('Unknown contributor type %s (must be one of %s)' % (by, ', '.join(BY)))
+    records = _record_bounds(fragmentflows, quantity, scenario, kwargs)
+    search = _Search(records)
+    search.enqueue(fragmentflows, 1.0)
+
+    found = []
+    totals = dict()
+    expanded = 0
+    while search.queue and search.peek() >= threshold:
+        ff, nw, s = search.pop()
+        if s is None:
+            search.enqueue(ff.subfragments, nw)
+            expanded += 1
+            continue
+        if by == 'flow':
+            found.append(Contribution(ff, nw, nw * s))
+            if n is not None and len(found) >= n:
+                break
+        else:
+            key = ff.term.term_node
+            totals[key] = totals.get(key, 0.0) + nw * s
+            if n is not None and _settled(totals, n, search.pruned):
+                break
+
+    if by == 'process':
+        found = sorted((Contribution(k, None, v) for k, v in totals.items()), key=lambda c: abs(c.result),
+                       reverse=True)
+        if n is not None:
+            found = found[:n]
+    return Contributions(quantity, by, found, records[id(fragmentflows)][2], search.pruned, expanded)
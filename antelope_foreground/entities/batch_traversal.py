@@ -0,0 +1,225 @@
+"""
+Parallel batch traversal of independent reference fragments.
+
+A foreground typically contains many reference fragments that do not depend on one another at all, and a report that
+traverses and scores each of them under several scenarios is embarrassingly parallel.  traverse_all() distributes
+one task per (fragment, scenario) pair to a pool of worker processes.
+
+The model is handed to the workers once, when the pool starts, as a snapshot: the fragments and everything they reach
+(flows, quantities, terminations with their cached unit scores, and the archives that entity refs query) are pickled
+together in the calling process and rebuilt in each worker.  The snapshot does not depend on the start method, so the
+workers may be forked or spawned; the platform's default start method is used unless another is supplied.  Entities
+hash by their identity, and an entity-keyed dict may be restored before the entity it refers to is complete, so
+entities are rebuilt from their scalar attributes first and given the rest of their state afterward (see
+_SnapshotPickler).  Tasks then carry only indices.  Each worker keeps a traversal memo, so that subfragments shared
+among several reference fragments are traversed once per worker and scenario.
+
+Workers return plain-data TraversalSummary objects, which are merged in task order.  Every task is computed by the
+same code whether it runs in a worker or in the parent (workers=1), so parallel results are identical to serial
+results, bit for bit.  A task whose model fails to traverse, with one of TRAVERSAL_ERRORS, reports its error in the
+summary instead of aborting the batch.  Any other exception is a bug, and propagates with the worker's traceback.
+"""
+
+import io
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from .fragments import InvalidParentChild, ScenarioConflict, ZeroInboundExchange
+from ..fragment_flows import CumulatingFlows, GhostFragment, group_ios, frag_flow_lcia_many
+from ..terminations import FlowConversionError, MissingFlow, UnresolvedAnchor
+
+
+TRAVERSAL_ERRORS = (InvalidParentChild, ScenarioConflict, ZeroInboundExchange, CumulatingFlows, FlowConversionError,
+                    MissingFlow, UnresolvedAnchor)
+
+
+def _quantity_key(quantity):
+    return getattr(quantity, 'link', str(quantity))
+
+
+class TraversalSummary(object):
+    """
+    The result of one traversal, as plain data.
+     fragment: the external ref of the reference fragment
+     scenario: the scenario specification
+     nodes: list of (fragment uuid, magnitude, node weight) for the nodes of the traversal, in traversal order
+     inventory: list of (flow link, direction, magnitude) for the fragment's unit inventory io flows
+     scores: dict of quantity link to total LCIA score
+     error: None, or a string describing the exception raised by the traversal
+    """
+    def __init__(self, fragment, scenario, nodes=None, inventory=None, scores=None, error=None):
+        self.fragment = fragment
+        self.scenario = scenario
+        self.nodes = nodes or []
+        self.inventory = inventory or []
+        self.scores = scores or dict()
+        self.error = error
+
+    def __eq__(self, other):
+        if not isinstance(other, TraversalSummary):
+            return False
+        return (self.fragment, self.nodes, self.inventory, self.scores, self.error) == \
+            (other.fragment, other.nodes, other.inventory, other.scores, other.error)
+
+    def __repr__(self):
+        if self.error:
+            return 'TraversalSummary(%s, %s: %s)' % (self.fragment, self.scenario, self.error)
+        return 'TraversalSummary(%s, %s: %d nodes)' % (self.fragment, self.scenario, len(self.nodes))
+
+
+class _BatchWorker(object):
+    def __init__(self, fragments, quantities, observed, lcia_kwargs):
+        self.fragments = fragments
+        self.quantities = quantities
+        self.observed = observed
+        self.lcia_kwargs = lcia_kwargs
+        self.memo = dict()
+
+    def run(self, i, scenario):
+        frag = self.fragments[i]
+        try:
+            ffs = frag.traverse(scenario, observed=self.observed, memo=self.memo)
+            nodes = [(ff.fragment.uuid, ff.magnitude, ff.node_weight) for ff in ffs
+                     if not isinstance(ff.fragment, GhostFragment)]
+            results = frag_flow_lcia_many(ffs, self.quantities, scenario=scenario, **self.lcia_kwargs)
+            scores = {_quantity_key(q): res.total() for q, res in zip(self.quantities, results)}
+            ios, _ = group_ios(frag, ffs)
+            inventory = [(x.fragment.flow.link, x.fragment.direction, x.magnitude) for x in ios]
+        except TRAVERSAL_ERRORS as e:
+            return TraversalSummary(frag.external_ref, scenario, error='%s: %s' % (type(e).__name__, e))
+        return TraversalSummary(frag.external_ref, scenario, nodes=nodes, inventory=inventory, scores=scores)
+
+
+_SCALARS = (str, int, float, bool, type(None))
+
+
+def _restore(cls, scalars):
+    obj = cls.__new__(cls)
+    obj.__dict__.update(scalars)
+    return obj
+
+
+class _SnapshotPickler(pickle.Pickler):
+    """
+    Pickles objects that define their own hash (entities, refs, contexts, exchanges) in two steps: the object is
+    rebuilt from its scalar attributes, which include everything its hash depends on, and only then given the rest of
+    its state.  The object is therefore hashable as soon as it exists, even if it is reached again, as a dict key,
+    while its own state is being restored.
+    """
+    def reducer_override(self, obj):
+        cls = type(obj)
+        if isinstance(obj, type) or cls.__hash__ is None or cls.__hash__ is object.__hash__:
+            return NotImplemented
+        d = getattr(obj, '__dict__', None)
+        if not d:
+            return NotImplemented
+        return _restore, (cls, {k: v for k, v in d.items() if isinstance(v, _SCALARS)}), d
+
+
+def _snapshot(obj):
+    """
+    :param obj: a model, or any structure containing one
+    :return: bytes from which pickle.loads() rebuilds a copy of obj in any process
+    """
+    b = io.BytesIO()
+    _SnapshotPickler(b, protocol=pickle.HIGHEST_PROTOCOL).dump(obj)
+    return b.getvalue()
+
+
+def _mp_context(mp_context=None):
+    """
+    :param mp_context: None, a start method name, or a multiprocessing context
+    :return: a multiprocessing context; by default the platform's
+    """
+    if mp_context is None or isinstance(mp_context, str):
+        return multiprocessing.get_context(mp_context)
+    return mp_context
+
+
+_worker = None
+
+
+def _init_worker(snapshot):
+    global _worker
+    _worker = _BatchWorker(*pickle.loads(snapshot))
+
+
+def _run_task(task):
+    return _worker.run(*task)
+
+
+def traverse_all(fragments, scenarios=(None, ), workers=None, observed=False, quantities=None, chunksize=None,
+                 mp_context=None, **kwargs):
+    """
+    Traverse (and optionally score) every fragment under every scenario, in parallel.
+    :param fragments: a list of reference fragments
+    :param scenarios: [(None, )] a list of scenario specifications, each as supplied to traverse()
+    :param workers: [None] number of worker processes.  Default is the number of CPUs.  1 computes serially in the
+     calling process.
+    :param observed: [False] as supplied to traverse()
+    :param quantities: [None] a list of quantity refs with which to score each traversal
+    :param chunksize: [None] number of tasks sent to a worker at once.  Default is about four chunks per worker.
+    :param mp_context: [None] a multiprocessing context or start method name ('fork', 'spawn', 'forkserver') for the
+     workers.  Default is the platform's.
+    :param kwargs: passed to frag_flow_lcia_many()
+    :return: a BatchResult
+    """
+    fragments = list(fragments)
+    scenarios = list(scenarios)
+    quantities = list(quantities or [])
+    tasks = [(i, s) for i in range(len(fragments)) for s in scenarios]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+
+    if workers <= 1:
+        w = _BatchWorker(fragments, quantities, observed, kwargs)
+        summaries = [w.run(*t) for t in tasks]
+    else:
+        if chunksize is None:
+            chunksize = max(1, len(tasks) // (workers * 4))
+        snapshot = _snapshot((fragments, quantities, observed, kwargs))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context(mp_context), initializer=_init_worker,
+                                 initargs=(snapshot, )) as pool:
+            summaries = list(pool.map(_run_task, tasks, chunksize=chunksize))
+    return BatchResult(fragments, scenarios, quantities, summaries)
+
+
+class BatchResult(object):
+    """
+    The merged result of traverse_all().  Summaries are stored fragment by fragment, and by scenario within each
+    fragment, in the order supplied.
+    """
+    def __init__(self, fragments, scenarios, quantities, summaries):
+        self.fragments = [f.external_ref for f in fragments]
+        self.scenarios = scenarios
+        self.quantities = quantities
+        self.summaries = summaries
+
+    def __iter__(self):
+        return iter(self.summaries)
+
+    def __len__(self):
+        return len(self.summaries)
+
+    def _index(self, fragment, scenario):
+        i = self.fragments.index(getattr(fragment, 'external_ref', fragment))
+        j = next(k for k, s in enumerate(self.scenarios) if s == scenario)
+        return i * len(self.scenarios) + j
+
+    def summary(self, fragment, scenario=None):
+        """
+        :param fragment: a reference fragment, or its external ref
+        :param scenario: one of the scenario specifications supplied
+        :return: a TraversalSummary
+        """
+        return self.summaries[self._index(fragment, scenario)]
+
+    def score(self, fragment, quantity, scenario=None):
+        return self.summary(fragment, scenario).scores[_quantity_key(quantity)]
+
+    @property
+    def errors(self):
+        return [s for s in self.summaries if s.error is not None]
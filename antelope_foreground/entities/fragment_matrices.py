@@ -0,0 +1,347 @@
+"""
+Sparse matrix representation of a fragment traversal.
+
+A traversal determines the node weight of every node in a fragment tree, but the relationships among node weights
+are linear: once the scenario is fixed, every child node's weight is a fixed multiple of its parent's.  to_matrices()
+records those multiples in a square technology matrix A (intermediate flows x foreground nodes), so that the node
+weights are the solution of
+
+    A x = d
+
+where d is the demand for the reference flow.  The nodes' external exchanges are recorded in two further matrices:
+
+ * C (cutoff flows x nodes): the cutoff (null-terminated) flows emitted by each node per unit node weight, including
+   the unmatched io flows of subfragments.  C x is the fragment's un-grouped cutoff inventory.
+ * B (background terminations x nodes): the unit activity of each process, context, or subfragment termination per
+   unit node weight (negative if the termination is run in reverse).  Given a vector s of unit scores of the
+   background terminations, s B x is the fragment's LCIA result.
+
+Subfragments are not expanded: a subfragment node is a dependency on the subfragment's unit inventory, which appears
+as a row of B, with its unmatched io flows in C.
+
+A FragmentMatrices object factorizes A once, and reuses the factorization for every subsequent solve, for any number
+of demand vectors and LCIA methods.
+
+node_scores() (or lcia_matrix()) gives the LCIA result of each node for several quantities as a dense (nodes x
+quantities) matrix, x * (s B)', with the nodes, their stage names, and the quantities as its index.  Results by stage,
+or by any other grouping of the nodes, are then a single product with a sparse indicator matrix.
+"""
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+from scipy.sparse.linalg import splu
+
+from .fragments import _memo_key, copy_ios
+from .traversal_plan import traversal_scenarios
+from ..fragment_flows import GhostFragment, frag_flow_lcia_many
+from ..terminations import UnresolvedAnchor
+
+
+def lcia_matrix(fragment, quantities, scenario=None, observed=True, memo=None, **kwargs):
+    """
+    Compute the LCIA result of every node of a fragment traversal for several quantities, as a dense matrix.
+    :param fragment:
+    :param quantities: a list of quantity refs
+    :param scenario: a scenario specification, as supplied to traverse()
+    :param observed: [True] as supplied to fragment_lcia()
+    :param memo: [None] a traversal memo, e.g. to use solved loops
+    :param kwargs: passed to score_cache() / frag_flow_lcia_many()
+    :return: a NodeScores
+    """
+    return to_matrices(fragment, scenario, observed=observed, memo=memo).node_scores(quantities, **kwargs)
+
+
+def to_matrices(fragment, scenario=None, observed=False, memo=None):
+    """
+    Traverse the fragment and construct its sparse matrix representation.
+    :param fragment:
+    :param scenario: a scenario specification, as supplied to traverse()
+    :param observed: [False] as supplied to traverse()
+    :param memo: [None] a traversal memo, e.g. to use solved loops
+    :return: a FragmentMatrices
+    """
+    if memo is None:
+        memo = dict()
+    scenarios = traversal_scenarios(scenario, observed=observed)
+    ffs = fragment.traverse(scenarios, memo=memo)
+    return FragmentMatrices(fragment, scenarios, ffs, memo)
+
+
+class FragmentMatrices(object):
+    """
+    Matrices A, B, C and index maps for a fragment traversal (see module docstring).
+
+    Columns: nodes[j] is the FragmentFlow of the j-th node in traversal order; node_index maps fragment uuid to column.
+    Rows of A: intermediates[j] is the flow that delivers node j (row j corresponds to column j).
+    Rows of C: cutoffs[k] is a (flow, direction) pair; cutoff_index maps the pair to its row.
+    Rows of B: background[k] is a representative FlowTermination; background_index maps (term_node, term_flow) to
+    its row.
+    """
+    def __init__(self, fragment, scenarios, ffs, memo):
+        self.fragment = fragment
+        self.scenarios = scenarios
+        self.nodes = []
+        self.node_index = dict()
+        self.cutoffs = []
+        self.cutoff_index = dict()
+        self.background = []
+        self.background_index = dict()
+        self._records = []  # subfragment traversal record for each background row (or None)
+        self._lu = None
+
+        a = ([], [], [])  # off-diagonal technology coefficients
+        b = ([], [], [])
+        c = ([], [], [])
+        for ff in ffs:
+            if isinstance(ff.fragment, GhostFragment):
+                continue  # unmatched subfragment ios are accounted with their subfragment node
+            if ff.term.is_null and ff.fragment.reference_entity is not None:
+                p = self.node_index[ff.fragment.reference_entity.uuid]
+                self._add_entry(c, self._cutoff_row(ff.fragment.flow, ff.fragment.direction), p,
+                                self._coefficient(ff.magnitude, p))
+                continue
+
+            j = self._add_node(ff)
+            if ff.fragment.reference_entity is not None:
+                p = self.node_index[ff.fragment.reference_entity.uuid]
+                self._add_entry(a, j, p, -self._coefficient(ff.node_weight, p))
+            if ff.term.is_null:
+                continue  # trivial fragment
+
+            if ff.term.is_fg or ff.magnitude == 0:
+                continue
+            sense = -1.0 if ff.term.direction == ff.fragment.direction else 1.0
+            if ff.term.is_subfrag:
+                if len(ff.subfragments) == 0:
+                    continue  # zero inbound exchange: subfragment was not traversed
+                self._add_entry(b, self._background_row(ff), j, sense)
+                for x in self._unmatched_ios(ff, memo):
+                    self._add_entry(c, self._cutoff_row(x.fragment.flow, x.fragment.direction), j, x.magnitude)
+            else:
+                self._add_entry(b, self._background_row(ff), j, sense)
+
+        n = len(self.nodes)
+        self.intermediates = [ff.fragment.flow for ff in self.nodes]
+        self.A = csc_matrix((np.concatenate([np.ones(n), a[2]]),
+                             (np.concatenate([np.arange(n), a[0]]).astype(int),
+                              np.concatenate([np.arange(n), a[1]]).astype(int))), shape=(n, n))
+        self.B = csc_matrix((b[2], (b[0], b[1])), shape=(len(self.background), n))
+        self.C = csc_matrix((c[2], (c[0], c[1])), shape=(len(self.cutoffs), n))
+        self.demand = np.zeros(n)
+        if n > 0:
+            self.demand[0] = self.nodes[0].node_weight
+
+    @staticmethod
+    def _add_entry(m, i, j, v):
+        m[0].append(i)
+        m[1].append(j)
+        m[2].append(v)
+
+    def _add_node(self, ff):
+        j = len(self.nodes)
+        self.nodes.append(ff)
+        self.node_index[ff.fragment.uuid] = j
+        return j
+
+    def _coefficient(self, value, p):
+        """
+        value per unit node weight of node p.  Children of zero-weight nodes have zero weight themselves.
+        """
+        if self.nodes[p].node_weight == 0:
+            return 0.0
+        return value / self.nodes[p].node_weight
+
+    def _cutoff_row(self, flow, direction):
+        key = (flow, direction)
+        if key not in self.cutoff_index:
+            self.cutoff_index[key] = len(self.cutoffs)
+            self.cutoffs.append(key)
+        return self.cutoff_index[key]
+
+    def _background_row(self, ff):
+        term = ff.term
+        key = (term.term_node, term.term_flow)
+        if key not in self.background_index:
+            self.background_index[key] = len(self.background)
+            self.background.append(term)
+            if term.is_subfrag:
+                self._records.append((ff.subfragments, ff.subfragment_scenarios))
+            else:
+                self._records.append(None)
+        return self.background_index[key]
+
+    @staticmethod
+    def _unmatched_ios(ff, memo):
+        """
+        The subfragment io flows not matched by the node's termination or child flows, per unit node weight, exactly
+        as emitted during traversal.  They are taken from the memo entry that supplied the node's subfragment record,
+        so the memo must be the traversal's own, and the entry must not have been replaced since.
+        :param ff: a subfragment node
+        :param memo: the memo of the traversal
+        :return: list of io FragmentFlows
+        """
+        term = ff.term
+        record = ff.subfragments
+        hit = memo.get(_memo_key(term.term_node, ff.subfragment_scenarios))
+        if hit is None:
+            raise ValueError('Subfragment %s is not in the memo: supply the memo of the traversal' % term.term_node)
+        ios, internal, _ = hit
+        if len(internal) != len(record) or any(x is not y for x, y in zip(internal, record)):
+            raise ValueError('Memo entry for subfragment %s does not match the traversal record' % term.term_node)
+        unit_inv = copy_ios(ios)
+        for flow in [term.term_flow] + [f.flow for f in ff.fragment.child_flows]:
+            try:
+                unit_inv.remove(next(k for k in unit_inv if k.fragment.flow == flow))
+            except StopIteration:
+                pass
+        return unit_inv
+
+    @property
+    def shape(self):
+        """
+        :return: (number of nodes, number of cutoff flows, number of background terminations)
+        """
+        return len(self.nodes), len(self.cutoffs), len(self.background)
+
+    def node_weights(self, demand=None):
+        """
+        Solve A x = d.  The factorization of A is computed once and cached.
+        :param demand: [None] a demand vector, or a (nodes x k) array of k demand vectors.  Default is the traversal's
+         own demand, which reproduces the traversal's node weights.
+        :return: node weight vector (or nodes x k array)
+        """
+        if demand is None:
+            demand = self.demand
+        if self._lu is None:
+            self._lu = splu(self.A)
+        return self._lu.solve(np.asarray(demand, dtype=float))
+
+    def cutoff_inventory(self, demand=None):
+        """
+        :return: the magnitude of each cutoff flow (C x)
+        """
+        return self.C @ self.node_weights(demand)
+
+    def background_activity(self, demand=None):
+        """
+        :return: the activity level of each background termination (B x)
+        """
+        return self.B @ self.node_weights(demand)
+
+    def unit_scores(self, quantities, **kwargs):
+        """
+        Unit LCIA scores of the background terminations.  Process and context terminations use their score caches;
+        subfragment terminations are scored from their traversal records.  Unresolved anchors score zero.
+        :param quantities: a list of quantity refs
+        :param kwargs: passed to score_cache() / frag_flow_lcia_many()
+        :return: (quantities x background) array
+        """
+        s = np.zeros((len(quantities), len(self.background)))
+        for k, term in enumerate(self.background):
+            record = self._records[k]
+            if record is None:
+                for i, q in enumerate(quantities):
+                    try:
+                        s[i, k] = term.score_cache(quantity=q, **kwargs).total()
+                    except UnresolvedAnchor:
+                        pass
+            else:
+                for i, res in enumerate(frag_flow_lcia_many(record[0], quantities, scenario=record[1], **kwargs)):
+                    s[i, k] = res.total()
+        return s
+
+    def lcia(self, quantities, demand=None, **kwargs):
+        """
+        Total LCIA scores for a list of quantities, computed as s B x with a single solve for node weights.
+        :param quantities: a list of quantity refs
+        :param demand: [None] as supplied to node_weights()
+        :param kwargs: passed to unit_scores()
+        :return: an array of scores, one per quantity (or quantities x k, for k demand vectors)
+        """
+        return self.unit_scores(quantities, **kwargs) @ self.background_activity(demand)
+
+    def node_scores(self, quantities, demand=None, **kwargs):
+        """
+        The LCIA result of every node, as a dense matrix: the node weights times the unit scores of each node's
+        background dependencies, x * (s B)'.  Subfragment nodes carry the whole score of their subfragment.
+        :param quantities: a list of quantity refs
+        :param demand: [None] a single demand vector, as supplied to node_weights()
+        :param kwargs: passed to unit_scores()
+        :return: a NodeScores
+        """
+        x = self.node_weights(demand)
+        s = self.unit_scores(quantities, **kwargs)
+        return NodeScores(self.nodes, quantities, x[:, np.newaxis] * (self.B.T @ s.T))
+
+
+def _stage_name(fragment):
+    try:
+        return fragment['StageName'] or ''
+    except KeyError:
+        return ''
+
+
+class NodeScores(object):
+    """
+    Nodes x quantities matrix of LCIA results, as computed by FragmentMatrices.node_scores().
+     nodes: the FragmentFlow of each node, in traversal order (a row index)
+     node_index: dict of fragment uuid to row
+     stages: the StageName of each node's fragment ('' if none)
+     quantities: the LCIA quantities (a column index)
+     values: nodes x quantities array
+    """
+    def __init__(self, nodes, quantities, values):
+        self.nodes = list(nodes)
+        self.node_index = {ff.fragment.uuid: j for j, ff in enumerate(self.nodes)}
+        self.stages = [_stage_name(ff.fragment) for ff in self.nodes]
+        self.quantities = list(quantities)
+        self.values = values
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def _col(self, quantity):
+        for k, q in enumerate(self.quantities):
+            if q is quantity or q == quantity:
+                return k
+        raise KeyError(quantity)
+
+    def score(self, fragment, quantity):
+        """
+        :param fragment: a node's fragment, or its uuid
+        :param quantity:
+        :return:
+        """
+        return self.values[self.node_index[getattr(fragment, 'uuid', fragment)], self._col(quantity)]
+
+    def totals(self):
+        """
+        :return: total score for each quantity
+        """
+        return self.values.sum(axis=0)
+
+    def aggregation(self, groups):
+        """
+        :param groups: a group label for each node
+        :return: (labels, sparse labels x nodes indicator matrix), labels in order of first appearance
+        """
+        index = dict()
+        rows = [index.setdefault(g, len(index)) for g in groups]
+        g = csr_matrix((np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(len(index), len(rows)))
+        return list(index.keys()), g
+
+    def aggregate(self, groups):
+        """
+        Sum node results by group, with a single matrix product
+        :param groups: a group label for each node
+        :return: (labels, labels x quantities array)
+        """
+        labels, g = self.aggregation(groups)
+        return labels, g @ self.values
+
+    def by_stage(self):
+        """
+        :return: (stage names, stages x quantities array)
+        """
+        return self.aggregate(self.stages)
@@ -3,16 +3,23 @@
 
 """
 
+import heapq
 import uuid
 # from collections import defaultdict
 
 from antelope import comp_dir, check_direction, PropertyExists, CatalogRef, RxRef, QuantityRequired
 
-from ..fragment_flows import group_ios, FragmentFlow, ios_exchanges, frag_flow_lcia
+from ..fragment_flows import group_ios, FragmentFlow, ios_exchanges, frag_flow_lcia, frag_flow_lcia_many
 from antelope_core.entities import LcEntity, LcFlow
 from antelope_core.exchanges import ExchangeValue
 # from lcatools.interact import ifinput, parse_math
 from ..terminations import FlowTermination, MissingFlow
+from ..contributions import top_contributors
+from ..lcia_dict import LciaResults
+from ..prefetch import prefetch_unit_scores
+from ..profiling import profiler
+from ..tracing import tracer
+from .uncertainty import Distribution
 from ..foreground_query import MissingResource
 
 class InvalidParentChild(Exception):
@@ -46,8 +53,237 @@ class ZeroInboundExchange(Exception):
     pass
 
 
+'''
+Scenario resolution index
+
+Every scenario key that is defined for any fragment's exchange values or terminations is assigned a bit position
+while it is defined.  Each fragment's exchange value and termination dicts carry a bitmask of the keys they define,
+maintained as keys are added and removed, and a ScenarioSet carries the bitmask of its members.  Matching a fragment
+against a scenario set is then a single AND: no match if the result is zero, a ScenarioConflict if more than one bit
+is set.  Falsy keys (0, None) are never matched against scenario sets, and are not registered.
+
+A key's bit is held by each dict that defines the key, and is released when the last of them drops it (or is itself
+discarded), so that the keys of fragments no longer loaded do not occupy bits.  Released bits are reused lowest
+first, to keep masks short.
+'''
+_scenario_bits = dict()  # scenario key: bit position
+_scenario_keys = []  # bit position: scenario key, or None if released
+_scenario_holds = []  # bit position: number of dicts defining the key
+_free_bits = []  # heap of released bit positions
+_scenario_version = 0  # incremented whenever a key is registered or released
+
+
+def _hold_scenario(key):
+    """
+    :param key: a scenario key, newly defined by a dict
+    :return: the key's bit, registering the key if no other dict defines it
+    """
+    global _scenario_version
+    try:
+        pos = _scenario_bits[key]
+    except KeyError:
+        if _free_bits:
+            pos = heapq.heappop(_free_bits)
+            _scenario_keys[pos] = key
+            _scenario_holds[pos] = 0
+        else:
+            pos = len(_scenario_keys)
+            _scenario_keys.append(key)
+            _scenario_holds.append(0)
+        _scenario_bits[key] = pos
+        _scenario_version += 1
+    _scenario_holds[pos] += 1
+    return 1 << pos
+
+
+def _release_scenario(key):
+    """
+    :param key: a scenario key, no longer defined by a dict
+    :return: the key's bit, which is released if no other dict defines the key
+    """
+    global _scenario_version
+    pos = _scenario_bits[key]
+    _scenario_holds[pos] -= 1
+    if _scenario_holds[pos] == 0:
+        del _scenario_bits[key]
+        _scenario_keys[pos] = None
+        heapq.heappush(_free_bits, pos)
+        _scenario_version += 1
+    return 1 << pos
+
+
+def scenario_bit(key):
+    """
+    :param key: a scenario key
+    :return: the key's bit, or 0 if no fragment defines the key
+    """
+    try:
+        return 1 << _scenario_bits[key]
+    except KeyError:
+        return 0
+
+
+def scenario_mask(scenarios):
+    """
+    :param scenarios: an iterable of scenario keys
+    :return: the bitmask of the registered keys among them.  Unregistered keys are not defined by any fragment.
+    """
+    if isinstance(scenarios, ScenarioSet):
+        return scenarios.mask
+    mask = 0
+    for k in filter(None, scenarios):
+        if k in _scenario_bits:
+            mask |= 1 << _scenario_bits[k]
+    return mask
+
+
+def _mask_keys(mask):
+    return [_scenario_keys[i] for i in range(mask.bit_length()) if mask >> i & 1]
+
+
+def _mask_key(mask):
+    """
+    :param mask: a bitmask with exactly one bit set
+    :return: the scenario key
+    """
+    return _scenario_keys[mask.bit_length() - 1]
+
+
+class ScenarioSet(set):
+    """
+    A set of scenario names that caches its bitmask.  The mask is recomputed if the set is modified or if scenario
+    keys have been registered or released since it was computed.
+    """
+    def __init__(self, *args):
+        super(ScenarioSet, self).__init__(*args)
+        self._mask = None
+        self._version = None
+
+    @property
+    def mask(self):
+        if self._mask is None or self._version != _scenario_version:
+            self._version = _scenario_version
+            self._mask = scenario_mask(iter(self))
+        return self._mask
+
+    def _modified(self):
+        self._mask = None
+
+    def add(self, key):
+        super(ScenarioSet, self).add(key)
+        self._modified()
+
+    def remove(self, key):
+        super(ScenarioSet, self).remove(key)
+        self._modified()
+
+    def discard(self, key):
+        super(ScenarioSet, self).discard(key)
+        self._modified()
+
+    def pop(self):
+        k = super(ScenarioSet, self).pop()
+        self._modified()
+        return k
+
+    def clear(self):
+        super(ScenarioSet, self).clear()
+        self._modified()
+
+    def update(self, *args):
+        super(ScenarioSet, self).update(*args)
+        self._modified()
+
+    def difference_update(self, *args):
+        super(ScenarioSet, self).difference_update(*args)
+        self._modified()
+
+    def intersection_update(self, *args):
+        super(ScenarioSet, self).intersection_update(*args)
+        self._modified()
+
+    def symmetric_difference_update(self, other):
+        super(ScenarioSet, self).symmetric_difference_update(other)
+        self._modified()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+    def __reduce__(self):
+        return self.__class__, (list(self), )
+
+
+class _ScenarioKeys(dict):
+    """
+    A dict keyed by scenario that maintains the bitmask of its (truthy) keys, and holds their bits
+    """
+    def __init__(self, *args, **kwargs):
+        super(_ScenarioKeys, self).__init__(*args, **kwargs)
+        self.mask = 0
+        for k in self.keys():
+            if k:
+                self.mask |= _hold_scenario(k)
+
+    def __del__(self):
+        if _scenario_bits is not None:  # not at interpreter shutdown
+            self.clear()
+
+    def __setitem__(self, key, value):
+        if key and key not in self:
+            self.mask |= _hold_scenario(key)
+        super(_ScenarioKeys, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(_ScenarioKeys, self).__delitem__(key)
+        if key:
+            self.mask &= ~_release_scenario(key)
+
+    def pop(self, key, *args):
+        if key and key in self:
+            self.mask &= ~_release_scenario(key)
+        return super(_ScenarioKeys, self).pop(key, *args)
+
+    def popitem(self):
+        k, v = super(_ScenarioKeys, self).popitem()
+        if k:
+            self.mask &= ~_release_scenario(k)
+        return k, v
+
+    def clear(self):
+        for k in self.keys():
+            if k:
+                _release_scenario(k)
+        super(_ScenarioKeys, self).clear()
+        self.mask = 0
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def __reduce__(self):
+        return self.__class__, (dict(self), )
+
+
 def _new_evs():
-    d = dict()  # should be a LowerDict? should scenario names be case sensitive?
+    d = _ScenarioKeys()  # should be a LowerDict? should scenario names be case sensitive?
     d[0] = 1.0
     d[1] = 0.0
     return d
@@ -105,6 +341,12 @@ class LcFragment(LcEntity):
                 i = tuple(i.split('____'))
             frag._exchange_values[i] = v
             # frag.set_exchange_value(i, v)
+        for i, v in j.get('uncertainty', dict()).items():
+            if i in ('0', '1'):
+                i = int(i)
+            elif i.find('____') >= 0:
+                i = tuple(i.split('____'))
+            frag._uncertainty[i] = Distribution.from_json(v)
         for tag, val in j['tags'].items():
             frag[tag] = val  # just a fragtag group of values
         return frag
@@ -167,11 +409,15 @@ class LcFragment(LcEntity):
 
         self.__dbg_threshold = -1  # higher number is more verbose
         self._exchange_values = _new_evs()
+        self._uncertainty = dict()  # exchange value key: Distribution
         self._balance_child = None
         self._private = private
         # self._background = background
         self._is_balance = False
         self._child_flows = list()
+        self._revision = 0
+        self._structure_revision = 0
+        self._subfragment_users = set()  # fragments that terminate to this one
 
         super(LcFragment, self).__init__('fragment', external_ref, entity_uuid=the_uuid, **kwargs)
         if self._external_ref == self._uuid:
@@ -186,7 +432,7 @@ class LcFragment(LcEntity):
         self.flow = flow
         self.direction = check_direction(direction)  # w.r.t. parent
 
-        self._terminations = dict()
+        self._terminations = _ScenarioKeys()
         self._terminations[None] = FlowTermination.null(self)
 
         # set termination and StageName
@@ -195,6 +441,7 @@ class LcFragment(LcEntity):
                 self._d['StageName'] = ''
         else:
             self._terminations[None] = FlowTermination(self, termination, term_flow=term_flow, descend=descend)
+            self._register_subfragment(self._terminations[None])
             if 'StageName' not in self._d:
                 stagename = ''
                 try:
@@ -252,7 +499,14 @@ class LcFragment(LcEntity):
         self._external_ref = None
 
     def set_debug_threshold(self, level):
+        """
+        Print this fragment's debugging messages, including its traversal events (see tracing.py), at levels of detail
+        below the threshold
+        :param level: -1 to stop printing
+        :return:
+        """
         self.__dbg_threshold = level
+        tracer.echo(self, level)
 
     def dbg_print(self, qwer, level=1):
         if level < self.__dbg_threshold:
@@ -284,9 +538,45 @@ class LcFragment(LcEntity):
         return self
 
     def top(self):
-        if self.reference_entity is None:
-            return self
-        return self.reference_entity.top()
+        top = self
+        while top.reference_entity is not None:
+            top = top.reference_entity
+        return top
+
+    @property
+    def revision(self):
+        """
+        A counter that advances whenever this fragment, any fragment beneath it, or any fragment it uses as a
+        subfragment is modified.  A traversal result remains valid so long as its fragment's revision is unchanged.
+        """
+        return self._revision
+
+    @property
+    def structure_revision(self):
+        """
+        Like revision, but only advances for changes that alter the shape of a traversal: child flows, terminations,
+        balance flows, and the set of scenarios for which exchange values are defined.
+        """
+        return self._structure_revision
+
+    def _mark_dirty(self, structural=False):
+        """
+        Advance the revision of this fragment and of every fragment whose traversal depends on it: the parent chain,
+        and every fragment that terminates to any fragment in the parent chain.
+        :param structural: [False] whether to also advance the structure revision
+        :return:
+        """
+        stack = [self]
+        seen = set()
+        while stack:
+            frag = stack.pop()
+            while frag is not None and id(frag) not in seen:
+                seen.add(id(frag))
+                frag._revision += 1
+                if structural:
+                    frag._structure_revision += 1
+                stack.extend(frag._subfragment_users)
+                frag = frag.reference_entity
 
     def set_parent(self, parent):
         if self.reference_entity is not None:
@@ -336,6 +626,7 @@ class LcFragment(LcEntity):
             self.terminate(self)
         for term in self._terminations.values():
             term.clear_score_cache()
+        self._mark_dirty(structural=True)
 
     def remove_child(self, child):
         """
@@ -351,6 +642,7 @@ class LcFragment(LcEntity):
                 self.clear_termination()
         for term in self._terminations.values():
             term.clear_score_cache()
+        self._mark_dirty(structural=True)
 
     @property
     def child_flows(self):
@@ -435,6 +727,9 @@ class LcFragment(LcEntity):
             'terminations': self._serialize_terms(save_unit_scores=save_unit_scores),
             'tags': self._d
         })
+        if self._uncertainty:
+            j['uncertainty'] = {str(k) if isinstance(k, int) else k: v.serialize()
+                                for k, v in self._uncertainty.items()}
         for k in self._d.keys():
             j.pop(k, None)  # we put these together in tags
         return j
@@ -548,6 +843,7 @@ class LcFragment(LcEntity):
         if value == self.cached_ev:
             return
         self._exchange_values[0] = value
+        self._mark_dirty()
 
     def reset_cache(self):
         """
@@ -555,6 +851,7 @@ class LcFragment(LcEntity):
         :return:
         """
         self._exchange_values[0] = 1.0
+        self._mark_dirty()
 
     def scale_evs(self, factor):
         """
@@ -564,9 +861,14 @@ class LcFragment(LcEntity):
         """
         for k, v in self._exchange_values.items():
             self._exchange_values[k] = v * factor
+        for k, v in self._uncertainty.items():
+            self._uncertainty[k] = v.scale(factor)
+        self._mark_dirty()
 
     def clear_evs(self):
         self._exchange_values = _new_evs()
+        self._uncertainty = dict()
+        self._mark_dirty(structural=True)
 
     @property
     def observed_ev(self):
@@ -601,6 +903,7 @@ class LcFragment(LcEntity):
     def observed_ev(self, value):
         if self._check_observability(None):
             self._exchange_values[1] = value
+            self._mark_dirty()
 
     def _observe(self, scenario=None, value=None, units=None):
         """
@@ -685,19 +988,31 @@ class LcFragment(LcEntity):
          filter out internal scenarios (start with '__') from recursive queries but not from the top level
         :return:
         """
-        scenarios = set(list(self._exchange_values.keys()))
-        for scen, term in self._terminations.items():
-            scenarios.add(scen)
-            if recurse and term.is_subfrag:
-                for k in term.term_node.scenarios(recurse=True):
-                    if str(k).startswith('__'):
-                        continue
-                    scenarios.add(k)
+        scenarios = set()
+        # (fragment, whether reached across a subfragment boundary)
+        stack = [(self, False)]
+        seen = set()
+        while stack:
+            frag, internal = stack.pop()
+            if (id(frag), internal) in seen:
+                continue
+            seen.add((id(frag), internal))
+            if isinstance(frag, LcFragment):
+                keys = list(frag._exchange_values.keys())
+                keys.extend(frag._terminations.keys())
+            else:
+                keys = list(frag.scenarios(recurse=True))
+            if internal:
+                keys = [k for k in keys if not str(k).startswith('__')]
+            scenarios.update(keys)
 
-        if recurse:
-            for c in self.child_flows:
-                for k in c.scenarios(recurse=True):
-                    scenarios.add(k)
+            if not recurse or not isinstance(frag, LcFragment):
+                continue
+            for term in frag._terminations.values():
+                if term.is_subfrag:
+                    stack.append((term.term_node, True))
+            for c in frag.child_flows:
+                stack.append((c, internal))
 
         scenarios -= {0, 1, None}
         for k in sorted(scenarios):
@@ -727,12 +1042,12 @@ class LcFragment(LcEntity):
         if scenario is None:
             return None
         if isinstance(scenario, set):
-            match = [scen for scen in filter(None, scenario) if scen in self._exchange_values.keys()]
-            if len(match) == 0:
+            match = self._exchange_values.mask & scenario_mask(scenario)
+            if match == 0:
                 return 1
-            elif len(match) > 1:
-                raise ScenarioConflict('fragment: %s\nexchange value matches: %s' % (self, match))
-            m = match[0]
+            elif match & (match - 1):
+                raise ScenarioConflict('fragment: %s\nexchange value matches: %s' % (self, _mask_keys(match)))
+            m = _mask_key(match)
             if str(m).startswith('norm') and self.parent is None:
                 print('Applying and removing one-time normalization scenario %s' % m)
                 # self.dbg_print('Applying and removing one-time normalization scenario %s' % m, level=0)
@@ -746,12 +1061,12 @@ class LcFragment(LcEntity):
         if scenario == 0 or scenario == '0' or scenario is None:
             return None
         if isinstance(scenario, set):
-            match = [scen for scen in filter(None, scenario) if scen in self._terminations.keys()]
-            if len(match) == 0:
+            match = self._terminations.mask & scenario_mask(scenario)
+            if match == 0:
                 return None
-            elif len(match) > 1:
-                raise ScenarioConflict('fragment: %s\ntermination matches: %s' % (self, match))
-            return match[0]
+            elif match & (match - 1):
+                raise ScenarioConflict('fragment: %s\ntermination matches: %s' % (self, _mask_keys(match)))
+            return _mask_key(match)
         if scenario in self._terminations.keys():
             return scenario
         return None
@@ -825,6 +1140,8 @@ class LcFragment(LcEntity):
         """
         if value is None:
             if scenario not in {1, '1', 0, '0', None}:
+                if scenario in self._exchange_values:
+                    self._mark_dirty(structural=True)  # scenario matching changes
                 v = self._exchange_values.pop(scenario, None)
                 if v:
                     self.dbg_print('Removed observation %g for scenario %s' % (v, scenario), level=0)
@@ -848,7 +1165,55 @@ class LcFragment(LcEntity):
         elif scenario == 1 or scenario == '1' or scenario == 'observed':
             self._exchange_values[1] = value
         else:
+            new_key = scenario not in self._exchange_values
             self._exchange_values[scenario] = value
+            if new_key:
+                self._mark_dirty(structural=True)  # scenario matching changes
+                return
+        self._mark_dirty()
+
+    @staticmethod
+    def _ev_key(scenario):
+        if scenario == 0 or scenario == '0' or scenario == 'cached' or scenario is None:
+            return 0
+        elif scenario == 1 or scenario == '1' or scenario == 'observed':
+            return 1
+        return scenario
+
+    def set_uncertainty(self, scenario, distribution):
+        """
+        Attach a probability distribution to one of the fragment's exchange values, for Monte Carlo simulation.  The
+        exchange value itself is not changed.
+        :param scenario: as in set_exchange_value(): None / 0 for the cached value, 1 for the observed value, or a
+         scenario name
+        :param distribution: an uncertainty.Distribution, or None to remove
+        :return:
+        """
+        key = self._ev_key(scenario)
+        if distribution is None:
+            self._uncertainty.pop(key, None)
+            return
+        if not isinstance(distribution, Distribution):
+            raise TypeError('%s is not a Distribution' % distribution)
+        if not self._check_observability(scenario=scenario):
+            raise DependentFragment('Fragment exchange value set during traversal')
+        if isinstance(scenario, tuple) or isinstance(scenario, set):
+            raise ScenarioConflict('Set uncertainty must specify single scenario')
+        self._uncertainty[key] = distribution
+
+    def uncertainty(self, scenario=None):
+        """
+        :param scenario: as in set_uncertainty()
+        :return: the Distribution attached to the exchange value, or None
+        """
+        return self._uncertainty.get(self._ev_key(scenario))
+
+    @property
+    def uncertainties(self):
+        """
+        :return: a dict of exchange value key to Distribution
+        """
+        return dict(self._uncertainty)
 
     @property
     def conserved(self):
@@ -868,11 +1233,13 @@ class LcFragment(LcEntity):
         negates all stored exchange values, so as to have no effect on traversal computations.
         :return:
         """
-        d = dict()
+        d = _ScenarioKeys()
         for k, v in self._exchange_values.items():
             d[k] = -1 * v
         self.direction = comp_dir(self.direction)
         self._exchange_values = d
+        self._uncertainty = {k: v.scale(-1) for k, v in self._uncertainty.items()}
+        self._mark_dirty(structural=True)
 
     def set_balance_flow(self):
         """
@@ -884,11 +1251,13 @@ class LcFragment(LcEntity):
         if self.is_balance is False:
             self.reference_entity.set_conservation_child(self)
             self._is_balance = True
+            self._mark_dirty(structural=True)
 
     def unset_balance_flow(self):
         if self.is_balance:
             self.reference_entity.unset_conservation_child()
             self._is_balance = False
+            self._mark_dirty(structural=True)
 
     def set_conservation_child(self, child):
         if child.reference_entity != self:
@@ -1024,11 +1393,17 @@ class LcFragment(LcEntity):
             # shortcut: assign an existing scenario to be default  ## DWR? this is surely nonstandard-
             # causes namespace conflicts btwn scenario and external_ref, but not really because the argument is
             # supposed to be a node. supplying txt as an argument is nonstandard- so it's clearly a hack. eh.
+            self._release_subfragment(self._terminations[None])
             self._terminations[None] = self._terminations[term_node]
+            self._mark_dirty(structural=True)
             return self._terminations[term_node]
 
         termination = FlowTermination(self, term_node, **kwargs)
+        if scenario in self._terminations:
+            self._release_subfragment(self._terminations[scenario])
         self._terminations[scenario] = termination
+        self._register_subfragment(termination)
+        self._mark_dirty(structural=True)
         if scenario is None:
             if self['StageName'] == '' and not termination.is_null:
                 if termination.is_frag:
@@ -1044,7 +1419,22 @@ class LcFragment(LcEntity):
         return termination
 
     def clear_termination(self, scenario=None):
+        if scenario in self._terminations:
+            self._release_subfragment(self._terminations[scenario])
         self._terminations[scenario] = FlowTermination.null(self)
+        self._mark_dirty(structural=True)
+
+    def _register_subfragment(self, term):
+        if term.is_subfrag and isinstance(term.term_node, LcFragment):
+            term.term_node._subfragment_users.add(self)
+
+    def _release_subfragment(self, term):
+        """
+        Stop tracking a subfragment when the last termination that uses it is replaced
+        """
+        if term.is_subfrag and isinstance(term.term_node, LcFragment):
+            if sum(1 for t in self._terminations.values() if t.term_node is term.term_node) <= 1:
+                term.term_node._subfragment_users.discard(self)
 
     '''
     def to_foreground(self, scenario=None):
@@ -1084,6 +1474,8 @@ class LcFragment(LcEntity):
         if isinstance(scenario, tuple):
             raise ScenarioConflict('Set termination must specify single scenario')
         self._terminations[scenario] = FlowTermination.from_json(self, fg, scenario, j)
+        self._register_subfragment(self._terminations[scenario])
+        self._mark_dirty(structural=True)
 
     def termination(self, scenario=None):
         match = self._match_scenario_term(scenario)
@@ -1219,51 +1611,104 @@ class LcFragment(LcEntity):
         :param descend: [True] if False, yield subfragments as nodes
         :return: generator of terminal nodes
         """
-        term = self.termination(scenario)
         yds = set()
-        if term.is_process or term.is_context:
-            if term.term_node not in yds:
-                yield term.term_node
-                yds.add(term.term_node)
-        elif term.is_subfrag:
-            if term.descend and descend:
-                for n in term.term_node.nodes(scenario, descend=descend):
-                    if n not in yds:
-                        yield n
-                        yds.add(n)
-            else:
-                yield term.term_node
+        # stack entries are (fragment, None) to visit a node, or (None, term_node) to yield a terminal node
+        stack = [(self, None)]
+        while stack:
+            frag, node = stack.pop()
+            if frag is None:
+                if node not in yds:
+                    yield node
+                    yds.add(node)
+                continue
+            stack.extend((c, None) for c in reversed(list(frag.child_flows)))
+            term = frag.termination(scenario)
+            if term.is_process or term.is_context:
+                stack.append((None, term.term_node))
+            elif term.is_subfrag:
+                if term.descend and descend:
+                    if isinstance(term.term_node, LcFragment):
+                        stack.append((term.term_node, None))
+                    else:
+                        stack.extend((None, n) for n in reversed(list(term.term_node.nodes(scenario,
+                                                                                           descend=descend))))
+                elif frag is self:
+                    # not recorded: it may be yielded again by a child flow
+                    yield term.term_node
+                else:
+                    stack.append((None, term.term_node))
             # foreground, null: do nothing
-        for c in self.child_flows:
-            for n in c.nodes(scenario, descend=descend):
-                if n not in yds:
-                    yield n
-                    yds.add(n)
 
     def tree(self):
         """
-        This is real simple- just a recursive enumeration of child flows, depth first
+        This is real simple- just an enumeration of child flows, depth first
 
         :return:
         """
-        yield self
-        for c in self.child_flows:
-            for b in c.tree():
-                yield b
+        stack = [self]
+        while stack:
+            frag = stack.pop()
+            yield frag
+            stack.extend(reversed(list(frag.child_flows)))
 
-    def fragment_lcia(self, quantity_ref, scenario=None, observed=True, **kwargs):
+    def fragment_lcia(self, quantity_ref, scenario=None, observed=True, memo=None, prefetch=0, **kwargs):
         """
         Fragments don't have access to a qdb, so this piggybacks on the quantity_ref.
         note: refresh is no longer supported during traversal
         :param quantity_ref:
         :param scenario:
         :param observed: [True] whether to limit the computation to observed flows
+        :param memo: [None] subfragment inventory memo, passed to traverse()
+        :param prefetch: [0] number of threads with which to compute missing unit scores before the LCIA walk (see
+         prefetch_unit_scores()).  0 computes them during the walk, one at a time.
         :param kwargs: ultimately passed down to LCIA computation routine
         :return:
         """
-        fragmentflows = self.traverse(scenario=scenario, observed=observed)
+        fragmentflows = self.traverse(scenario=scenario, observed=observed, memo=memo)
+        if prefetch:
+            prefetch_unit_scores(fragmentflows, [quantity_ref], threads=prefetch, **kwargs)
         return frag_flow_lcia(fragmentflows, quantity_ref, scenario=scenario, **kwargs)
 
+    def fragment_lcia_many(self, quantities, scenario=None, observed=True, memo=None, prefetch=0, **kwargs):
+        """
+        LCIA for several quantities from a single traversal, walking the traversal record once.  Each result is
+        identical to the result of fragment_lcia() for that quantity.
+        :param quantities: a list of quantity refs
+        :param scenario:
+        :param observed: [True] whether to limit the computation to observed flows
+        :param memo: [None] subfragment inventory memo, passed to traverse()
+        :param prefetch: [0] as for fragment_lcia()
+        :param kwargs: ultimately passed down to LCIA computation routine
+        :return: an LciaResults keyed by quantity
+        """
+        quantities = list(quantities)
+        fragmentflows = self.traverse(scenario=scenario, observed=observed, memo=memo)
+        if prefetch:
+            prefetch_unit_scores(fragmentflows, quantities, threads=prefetch, **kwargs)
+        results = LciaResults(self)
+        for q, res in zip(quantities, frag_flow_lcia_many(fragmentflows, quantities, scenario=scenario, **kwargs)):
+            results[q] = res
+        return results
+
+    def top_contributors(self, quantity_ref, n=10, by='flow', threshold=0.0, scenario=None, observed=True, memo=None,
+                         **kwargs):
+        """
+        The leading contributors to the fragment's LCIA result, found without expanding subfragments that cannot hold
+        any (see contributions.py).
+        :param quantity_ref:
+        :param n: [10] number of contributors.  None finds every contributor above the threshold.
+        :param by: ['flow'] contributors are leaf fragment flows ('flow') or their term nodes ('process')
+        :param threshold: [0.0] a magnitude below which results and subfragments are not examined
+        :param scenario:
+        :param observed: [True] whether to limit the computation to observed flows
+        :param memo: [None] subfragment inventory memo, passed to traverse()
+        :param kwargs: ultimately passed down to LCIA computation routine
+        :return: a Contributions
+        """
+        fragmentflows = self.traverse(scenario=scenario, observed=observed, memo=memo)
+        return top_contributors(fragmentflows, quantity_ref, n=n, by=by, threshold=threshold, scenario=scenario,
+                                **kwargs)
+
     def activity(self, scenario=None, observed=True):
         """
         Reports a list of node activities of direct descendants only
@@ -1298,7 +1743,7 @@ class LcFragment(LcEntity):
         for x in self.inventory(scenario=scenario):
             yield x
 
-    def unit_inventory(self, scenario=None, observed=False, frags_seen=None):
+    def unit_inventory(self, scenario=None, observed=False, frags_seen=None, memo=None):
         """
         Traverses the fragment containing self, and returns a set of FragmentFlows indicating the net input/output
          with respect to a *unit node weight of the reference fragment*.
@@ -1313,6 +1758,7 @@ class LcFragment(LcEntity):
         :param scenario:
         :param observed:
         :param frags_seen: to prevent recursive loops
+        :param memo: subfragment inventory memo, passed to traverse()
         :return: list of io flows,
         """
         top = self.top()
@@ -1320,7 +1766,7 @@ class LcFragment(LcEntity):
         if frags_seen:
             frags_seen = set(frags_seen)  # reset to allow reentry
 
-        ffs = top.traverse(scenario, observed=observed, frags_seen=frags_seen)
+        ffs = top.traverse(scenario, observed=observed, frags_seen=frags_seen, memo=memo)
 
         ios, internal = group_ios(self, ffs)
 
@@ -1366,27 +1812,69 @@ class LcFragment(LcEntity):
                        for f in cos], key=lambda x: (x.direction == 'Input', x.flow.context,
                                                      x.flow['Name'], x.value), reverse=True)
 
-    def traverse(self, scenario=None, observed=False, frags_seen=None):
+    def traverse(self, scenario=None, observed=False, frags_seen=None, memo=None):
+        """
+        Traverse the fragment, computing the magnitude and node weight of every node.
+
+        Subfragment unit inventories are memoized during the traversal, so that a subfragment that is referenced from
+        several nodes under the same scenario set is only traversed once.  To share the memo across several
+        traversals, supply a dict as the memo argument.  The caller is then responsible for discarding it when the
+        model changes.
+
+        :param scenario: a scenario name, or a set, tuple, or list of scenario names
+        :param observed: [False] if scenario is None, use observed exchange values
+        :param frags_seen: carried along to catch recursion loops
+        :param memo: [None] a dict for memoizing subfragment unit inventories.  If None, a new memo is used for each
+         traversal.
+        :return: a list of FragmentFlows
+        """
+        if memo is None:
+            memo = dict()
+        return _run_traversal(self, self._traversal_scenarios(scenario, observed), frags_seen, memo)
+
+    def traverse_iter(self, scenario=None, observed=False, frags_seen=None, memo=None):
+        """
+        Streaming traversal: generate the same FragmentFlows as traverse(), in the same order, as each one is
+        finalized, so that a consumer (group_ios(), an exporter) can process a large model without holding the whole
+        traversal in memory.  Nothing is computed until the generator is consumed.
+
+        The contract is the following: a FragmentFlow is yielded only once its magnitude and node weight are final,
+        and the traversal never modifies it afterward.  A node is yielded before any of its descendants.  The balance
+        flow of a conserving node can only be computed once the node's other child flows have been summed, so it is
+        yielded after all of its siblings AND all of their descendants, and is followed by its own descendants.  A
+        subfragment node is yielded once its subfragment has been traversed and its node weight normalized; the
+        subfragment's unmatched io flows are yielded after the node's own child flows.
+
+        Subfragment traversals themselves are not streamed, since they must be complete before they can be grouped.
+        Only the fragment's own traversal is held to bounded memory.
+
+        :param scenario: as for traverse()
+        :param observed: [False] as for traverse()
+        :param frags_seen: carried along to catch recursion loops
+        :param memo: [None] as for traverse()
+        :return: a generator of FragmentFlows
+        """
+        if memo is None:
+            memo = dict()
+        return _stream_traversal(self, self._traversal_scenarios(scenario, observed), frags_seen, memo)
+
+    @staticmethod
+    def _traversal_scenarios(scenario, observed):
         if isinstance(scenario, set):
-            scenarios = set(scenario)
+            return ScenarioSet(scenario)
         elif isinstance(scenario, tuple) or isinstance(scenario, list):
-            scenarios = set(scenario)
+            return ScenarioSet(scenario)
         elif scenario is None:
             if observed:
-                scenarios = {1}
-            else:
-                scenarios = None
-        else:
-            scenarios = {scenario}
-        ffs, _ = self._traverse_node(1.0, scenarios, frags_seen=frags_seen)
-        return ffs
+                return ScenarioSet([1])
+            return None
+        return ScenarioSet([scenario])
 
-    def _traverse_fg_node(self, ff, scenarios, frags_seen):
+    def _conservation_stock(self, ff, scenarios):
         """
-        Handle foreground nodes and processes--> these can be quantity-conserving, but except for
-        balancing flows the flow magnitudes are determined at the time of construction (or scenario specification).
-
-        Balancing flow exchange values are always determined with respect to a unit activity of the terminal node.
+        Determine the initial conserved-quantity stock for a conserving foreground node or process, with respect to a
+        unit activity of the terminal node.  Child flows then add their conserved values to the stock, and the
+        balance flow is assigned whatever is left over.
 
         This is messy so it deserves some notes.
         the fragment's exchange value specifies the scaling factor for the terminal node, EXCEPT if the
@@ -1402,31 +1890,22 @@ class LcFragment(LcEntity):
         because direction is always interpreted relative to the parent).
 
         So then we traverse the child flows, let's say none of them have kg C characterization, and so our stock
-        remains -3999 kg. WHen we hit the balancing fragment "atmospheric carbon in", we catch the FoundBalanceFlow
-        and come back to it.
+        remains -3999 kg. When we hit the balancing fragment "atmospheric carbon in", we set it aside and come back
+        to it after the other child flows.
 
         When we come back, we re-negate the stock to +3999 and pass that as _balance to the balancing flow, which
-        becomnes that flow's exchange value (again w.r.t. this node's unit node weight).
+        becomes that flow's exchange value (again w.r.t. this node's unit node weight).
 
         IF the terminal node is a process, or if the node is an interior (non-reference) fragment, it's much easier.
         The stock is simply the process's inbound exchange value (with respect to a unit activity level), or if
         it's a foreground node then the stock is simply 1, and the node_weight already accounts for the exchange
         value and scales the balancing flow correctly.
 
-        Were we to do this non-'live' or with some kind of stack, we could conceivably balance multiple quantities with
-        additional fragment flows, but I'm pretty sure the same effect can be achieved by nesting conserving fragments.
-        This also requires the modeler to specify a resolution order and cuts the need for elaborate error checking.
-
-        :param ff: a FragmentFlow containing the foreground termination to recurse into
+        :param ff: a FragmentFlow containing the foreground termination
         :param scenarios:
-        :param frags_seen:
-        :return: a list of FragmentFlows in the order encountered, with input ff in position 0
+        :return: a _ConservationStock
         """
         term = ff.term
-        node_weight = ff.node_weight
-        ffs = [ff]
-        stock_inflow = stock_outflow = 0.0  # keep track of total inflows to detect+quash near-zero (floating-point-tolerance) balances
-
         if term.is_fg or not term.valid:
             if self.reference_entity is None:
                 # inbound exchange value w.r.t. term node's unit magnitude
@@ -1435,168 +1914,33 @@ class LcFragment(LcEntity):
                 stock = 1.0  # balance measurement w.r.t. term node's unit magnitude
         else:
             stock = term.inbound_exchange_value  # balance measurement w.r.t. term node's unit magnitude
-        bal_f = None
-        if self.is_conserved_parent:
-            stock *= self.balance_magnitude
-            if self.direction == 'Input':  # convention: inputs to self are positive
-                #  direction w.r.t. parent so self.direction == 'Input' is an input to parent = output from node
-                stock *= -1
-            self.dbg_print('%g inbound-balance' % stock, level=2)
-
-        if stock > 0:
-            stock_inflow += stock
-        else:
-            stock_outflow -= stock
-        # TODO: Handle auto-consumption!  test child flows for flow identity and null term; cumulate; scale node_weight
-
-        for f in self.child_flows:
-            try:  # now that we are storing _balance_child we can just skip it instead of try-catch. but whatever.
-                # traverse child, collecting conserved value if applicable
-                child_ff, cons = f._traverse_node(node_weight, scenarios,
-                                                  frags_seen=frags_seen, conserved_qty=self.conserved_quantity)
-                if cons is None:
-                    self.dbg_print('-- returned cons_value', level=3)
-                else:
-                    self.dbg_print('%g returned cons_value' % cons, level=2)
-                    stock += cons
-                    if cons > 0:
-                        stock_inflow += cons
-                    else:
-                        stock_outflow -= cons
-            except FoundBalanceFlow:
-                self.dbg_print('%g bal magnitude on %.3s' % (stock, f.uuid), level=3)
-                bal_f = f
-                child_ff = []
-
-            ffs.extend(child_ff)
-
-        stock_max = max([abs(stock_inflow), abs(stock_outflow)])
-
-        if bal_f is not None:
-            # balance reports net inflows; positive value is more coming in than out
-            # if balance flow is an input, its exchange must be the negative of the balance
-            # if it is an output, its exchange must equal the balance
-            if stock != 0 and (abs(stock) / stock_max < 1e-10):
-                self.dbg_print('Quashing <1e-10 balance flow (%g vs %g)' % (stock, stock_inflow), level=1)
-                stock = 0.0
-            if bal_f.direction == 'Input':
-                stock *= -1
-                self.dbg_print('%.3s Input: negating balance value' % bal_f.uuid)
-            else:
-                self.dbg_print('%.3s Output: maintaining balance value' % bal_f.uuid)
-            self.dbg_print('%g balance value passed to %.3s' % (stock, bal_f.uuid))
-            bal_ff, _ = bal_f._traverse_node(node_weight, scenarios,
-                                             frags_seen=set(frags_seen), conserved_qty=None, _balance=stock)
-            ffs.extend(bal_ff)
+        stock *= self.balance_magnitude
+        if self.direction == 'Input':  # convention: inputs to self are positive
+            #  direction w.r.t. parent so self.direction == 'Input' is an input to parent = output from node
+            stock *= -1
+        if tracer.enabled:
+            tracer.event(self, 'inbound_balance', level=2, stock=stock)
 
-        return ffs
+        return _ConservationStock(self, ff.node_weight, stock)
 
-    def _traverse_subfragment(self, ff, scenarios, frags_seen):
+    def _node_flow(self, upstream_nw, scenarios, frags_seen, conserved_qty=None, _balance=None):
         """
-        handle sub-fragments, including background flows--
-        for sub-fragments, the flow magnitudes are determined at the time of traversal and must be pushed out to
-         child flows
-        for LOCAL background flows, the background ff should replace the current ff, maintaining self as fragment
-
-        subfragment activity level is determined as follows:
-         - if the subfragment is a background fragment, it MUST have a unity inbound_exchange_value; this is enforced:
-           - for background processes, because FlowTermination._unobserved_exchanges() uses term_node.lci(ref_flow)
-           - for background fragments, in the yet-to-be-implemented bg_lcia method  (part of the foreground interface??)
-           in any case, the background term is swapped into the foreground node.
-
-         - otherwise, the subfragment inventory is taken and grouped, and the matching flow is found, and the magnitude
-           of the matching flow is used to normalize the downstream node weight.
-
-         - then the inventory of the subfragment is used to apply exchange values to child fragments, and traversal
-           recursion continues.
-
-
-        :param ff: a FragmentFlow containing the non-fg subfragment termination to recurse into
-        :param scenarios:
-        :param frags_seen:
-        :return:
-        """
-        '''
-        '''
-
-        term = ff.term
-        if 0:  #  term.term_is_bg: this is deprecated
-            pass
-            '''
-            if term.term_flow == term.term_node.flow:
-                # collapse trivial bg terminations into the parent fragment flow
-                bg_ff, _ = term.term_node._traverse_node(ff.node_weight, scenario, observed=observed)
-                assert len(bg_ff) == 1, (self.uuid, term.term_node.external_ref)
-                bg_ff[0].fragment = self
-                return bg_ff
-            '''
-
-        # traverse the subfragment, match the driven flow, compute downstream node weight and normalized inventory
-        try:
-            ffs, unit_inv, downstream_nw = _do_subfragment_traversal(ff, scenarios, frags_seen)
-        except ZeroInboundExchange:
-            self.dbg_print('subfragment divide by zero', 1)
-            return [ff]
-
-        # next we traverse our own child flows, determining the exchange values from the normalized unit inventory
-        for f in self.child_flows:
-            self.dbg_print('Handling child flow %s' % f, 4)
-            ev = 0.0
-            try:
-                m = next(j for j in unit_inv if j.fragment.flow == f.flow)
-                if m.fragment.direction == f.direction:
-                    self.dbg_print('  ev += %g' % m.magnitude, 4)
-                    ev += m.magnitude
-                else:
-                    self.dbg_print('  ev -= %g' % m.magnitude, 4)
-                    ev -= m.magnitude
-                unit_inv.remove(m)
-            except StopIteration:
-                self.dbg_print('  no driving flows found')
-                continue
-
-            self.dbg_print('traversing with ev = %g' % ev, 4)
-            child_ff, _ = f._traverse_node(downstream_nw, scenarios,
-                                           frags_seen=frags_seen, _balance=ev)
-            ffs.extend(child_ff)
-
-        # remaining un-accounted io flows are getting appended, so do scale
-        for x in unit_inv:
-            x.scale(downstream_nw)
-        ffs.extend(list(unit_inv))
-
-        return ffs
-
-    def _traverse_node(self, upstream_nw, scenarios,
-                       frags_seen=None, conserved_qty=None, _balance=None):
-
-        """
-        If the node has a non-null termination, use that; follow child flows.
-
-        If the node's termination is null- then look for matching background fragments. If one is found, adopt its
-        termination, and return.
-
-        else: assume it is a null foreground node; follow child flows
+        Compute the FragmentFlow for this node.
 
         :param upstream_nw: upstream node weight
         :param scenarios: set of scenario values
-        #:param observed: whether to use observed or cached evs (overridden by scenario specification)
         :param frags_seen: carried along to catch recursion loops
         :param conserved_qty: in case the parent node is a conservation node
         :param _balance: used when flow magnitude is determined during traversal, i.e. for balance flows and
         children of fragment nodes
-        :return: 2-tuple: ffs, conserved_val
-          ffs = an array of FragmentFlow records reporting the traversal, beginning with self
+        :return: 2-tuple: ff, conserved_val
+          ff = the FragmentFlow record for this node
           conserved_val = the magnitude of the flow with respect to the conserved quantity, if applicable (or None)
         """
-
         # first check for cycles
-        if frags_seen is None:
-            frags_seen = set()
-
         if self.reference_entity is None:
             if self.uuid in frags_seen:
-                # this should really get resolved into a loop-closing algorithm
+                # cyclic models must be traversed with their loops closed-- see loop_solver.solve_loops()
                 raise InvalidParentChild('Frag %s seeing self\n %s' % (self.uuid, '; '.join(frags_seen)))
             frags_seen.add(self.uuid)
 
@@ -1605,12 +1949,9 @@ class LcFragment(LcEntity):
             ev = self.exchange_value(_scen_ev)
         else:
             _scen_ev = None
-            self.dbg_print('%g balance' % _balance, level=2)
+            if tracer.enabled:
+                tracer.event(self, 'balance_ev', level=2, ev=_balance)
             ev = _balance
-            '''
-            if self._check_observability(scenario):
-                self._cache_balance_ev(_balance, scenario, observed)
-            '''
 
         magnitude = upstream_nw * ev
         _scen_term = self._match_scenario_term(scenarios)
@@ -1619,22 +1960,26 @@ class LcFragment(LcEntity):
         if self.reference_entity is None:
             node_weight = upstream_nw
             if magnitude == 0:
-                self.dbg_print('Unobserved reference fragment')
+                if tracer.enabled:
+                    tracer.event(self, 'unobserved_reference')
                 node_weight = 0
         else:
             node_weight = magnitude
 
         node_weight *= term.node_weight_multiplier
 
-        self.dbg_print('magnitude: %g node_weight: %g' % (magnitude, node_weight))
+        if tracer.enabled:
+            tracer.event(self, 'node_flow', magnitude=magnitude, node_weight=node_weight)
 
         conserved_val = None
         if conserved_qty is not None:
             if self.is_balance:
-                self.dbg_print('Found balance flow')
+                if tracer.enabled:
+                    tracer.event(self, 'found_balance')
                 raise FoundBalanceFlow  # to be caught
             cf = conserved_qty.cf(self.flow)
-            self.dbg_print('consrv cf %g for qty %s' % (cf, conserved_qty), level=3)
+            if tracer.enabled:
+                tracer.event(self, 'conserved_cf', level=3, cf=cf, quantity=str(conserved_qty))
             conserved_val = ev * cf
             if conserved_val == 0:
                 conserved = False
@@ -1642,76 +1987,378 @@ class LcFragment(LcEntity):
                 conserved = True
                 if self.direction == 'Output':  # convention: inputs to parent are positive
                     conserved_val *= -1
-                self.dbg_print('conserved_val %g' % conserved_val, level=2)
+                if tracer.enabled:
+                    tracer.event(self, 'conserved_value', level=2, value=conserved_val)
         elif self.is_balance:
-            # traversing balance flow after FoundBalanceFlow exception
+            # traversing balance flow after the other child flows
             conserved = True
         else:
             conserved = self.conserved
 
-        # print('%6f %6f %s' % (magnitude, node_weight, self))
         # this is the only place a FragmentFlow is created
         # TODO: figure out how to cache + propagate matched scenarios ... in progress
         ff = FragmentFlow(self, magnitude, node_weight, term, conserved, match_ev=_scen_ev, match_term=_scen_term)
+        return ff, conserved_val
+
+
+class _ConservationStock(object):
+    """
+    The conserved-quantity stock of a conserving foreground node, while its child flows are being traversed
+    """
+    def __init__(self, fragment, node_weight, stock):
+        self.fragment = fragment
+        self.node_weight = node_weight
+        self.stock = stock
+        # keep track of total inflows to detect+quash near-zero (floating-point-tolerance) balances
+        self.inflow = self.outflow = 0.0
+        self.add(stock)
+        self.balance_flow = None
+
+    def add(self, cons):
+        if cons > 0:
+            self.inflow += cons
+        else:
+            self.outflow -= cons
+
+    def accumulate(self, cons):
+        if tracer.enabled:
+            tracer.event(self.fragment, 'accumulate', level=2, value=cons)
+        self.stock += cons
+        self.add(cons)
+
+    def balance(self):
+        """
+        balance reports net inflows; positive value is more coming in than out
+        if balance flow is an input, its exchange must be the negative of the balance
+        if it is an output, its exchange must equal the balance
+        :return: the exchange value of the balance flow
+        """
+        stock = self.stock
+        stock_max = max([abs(self.inflow), abs(self.outflow)])
+        bal_f = self.balance_flow
+        if stock != 0 and (abs(stock) / stock_max < 1e-10):
+            if tracer.enabled:
+                tracer.event(self.fragment, 'quash_balance', stock=stock, inflow=self.inflow)
+            stock = 0.0
+        if bal_f.direction == 'Input':
+            stock *= -1
+        if tracer.enabled:
+            tracer.event(self.fragment, 'balance_value', value=stock, balance_flow=bal_f.uuid,
+                         direction=bal_f.direction)
+        return stock
+
+
+_NODE = 0  # traverse a node
+_BALANCE = 1  # traverse the balance flow of a conserving node, after its other child flows
+_EMIT = 2  # append unmatched subfragment io flows, after a subfragment node's child flows
+
+_FLOW = 0  # event: a finalized FragmentFlow
+_SUBFRAGMENT = 1  # event: a request for a subfragment traversal
+
+
+def _traverse_steps(fragment, scenarios, frags_seen, memo):
+    """
+    The traversal of one fragment, written as a generator so that it can be driven without recursion by
+    _stream_traversal().
+
+    The fragment tree is walked depth-first with an explicit stack of tasks:
+     - each node computes its FragmentFlow (LcFragment._node_flow) and selects a handler based on term type:
+     - foreground nodes and processes push their child flows-- if the node is quantity-conserving, the balance
+       flow is set aside and a _BALANCE task is pushed to traverse it after the others, with the remaining stock;
+     - subfragment nodes obtain the subfragment's unit inventory (see below), match the driven flow, compute the
+       downstream node weight (_match_subfragment_inventory), and push their child flows with exchange values
+       determined from the normalized inventory, followed by an _EMIT task to append the unmatched io flows.
+     - cutoffs, contexts, and zero-magnitude nodes end traversal.
+
+    The generator yields two kinds of events.  (_FLOW, ff) reports a FragmentFlow that is finalized: it will not be
+    modified further by the traversal.  Subfragment unit inventories are taken from the memo if possible; otherwise the
+    generator yields (_SUBFRAGMENT, (subfragment top, scenarios, frags_seen)) and is sent back the subfragment's
+    traversal, which it groups with group_ios() and stores in the memo.  Remote subfragments are asked for their unit
+    inventories directly.
+
+    :param fragment:
+    :param scenarios: set of scenario values, or None
+    :param frags_seen: carried along to catch recursion loops
+    :param memo: a dict of subfragment unit inventories
+    :return: nothing; FragmentFlows are yielded in traversal order
+    """
+    if frags_seen is None:
+        frags_seen = set()
+    tasks = [(_NODE, fragment, 1.0, None, None)]
+    while tasks:
+        task = tasks.pop()
+        if task[0] == _EMIT:
+            for x in task[1]:
+                yield _FLOW, x
+            continue
+        if task[0] == _BALANCE:
+            stock = task[1]
+            if stock.balance_flow is not None:
+                tasks.append((_NODE, stock.balance_flow, stock.node_weight, None, stock.balance()))
+            continue
+
+        _, frag, upstream_nw, stock, _balance = task
+        if stock is None:
+            conserved_qty = None
+        else:
+            conserved_qty = stock.fragment.conserved_quantity
+        if profiler.enabled:
+            profiler.enter('node', frag)
+        try:
+            ff, cons = frag._node_flow(upstream_nw, scenarios, frags_seen, conserved_qty=conserved_qty,
+                                       _balance=_balance)
+        except FoundBalanceFlow:
+            if tracer.enabled:
+                tracer.event(stock.fragment, 'balance_magnitude', level=3, stock=stock.stock, balance_flow=frag.uuid)
+            stock.balance_flow = frag
+            continue
+        finally:
+            if profiler.enabled:
+                profiler.exit()
+        if cons is not None:
+            stock.accumulate(cons)
 
         '''
         now looking forward: is our termination a cutoff, background, foreground or subfragment?
         '''
-        if magnitude == 0:
+        term = ff.term
+        if ff.magnitude == 0:
             # no flow to follow
-            self.dbg_print('zero magnitude')
-            return [ff], conserved_val
+            if tracer.enabled:
+                tracer.event(frag, 'zero_magnitude')
+            yield _FLOW, ff
+            continue
         elif term.is_null or term.is_context:
             # cutoff /context and background end traversal
-            self.dbg_print('cutoff or bg')
-            return [ff], conserved_val
+            if tracer.enabled:
+                tracer.event(frag, 'cutoff')
+            yield _FLOW, ff
+            continue
 
         if term.is_fg or term.is_process or not term.valid:
-            self.dbg_print('fg')
-            ffs = self._traverse_fg_node(ff, scenarios, frags_seen)
+            if tracer.enabled:
+                tracer.event(frag, 'fg')
+            yield _FLOW, ff
+            if frag.is_conserved_parent:
+                child_stock = frag._conservation_stock(ff, scenarios)
+                tasks.append((_BALANCE, child_stock))
+            else:
+                child_stock = None
+            tasks.extend((_NODE, c, ff.node_weight, child_stock, None) for c in reversed(list(frag.child_flows)))
+            continue
+
+        if tracer.enabled:
+            tracer.event(frag, 'subfrag')
+        term_node = term.term_node
+        inv = _memo_lookup(term_node, scenarios, frags_seen, memo)
+        if profiler.enabled:
+            profiler.count('subfragment', term_node.top(), hit=inv is not None)
+        if inv is None:
+            if isinstance(term_node, LcFragment):
+                if frags_seen:
+                    sub_seen = set(frags_seen)  # reset to allow reentry
+                else:
+                    sub_seen = frags_seen
+                if scenarios is None:
+                    sub_scenarios = None
+                else:
+                    sub_scenarios = ScenarioSet(scenarios)
+                sub_ffs = yield _SUBFRAGMENT, (term_node.top(), sub_scenarios, sub_seen)
+                ios, internal = group_ios(term_node, sub_ffs)
+            elif profiler.enabled:
+                profiler.enter('subfragment', term_node)
+                try:
+                    ios, internal = term_node.unit_inventory(scenario=scenarios)
+                finally:
+                    profiler.exit()
+            else:
+                ios, internal = term_node.unit_inventory(scenario=scenarios)
+            inv = _memo_store(term_node, scenarios, memo, ios, internal)
+        unit_inv, subfrags = inv
+
+        # match the driven flow, compute downstream node weight and normalized inventory
+        try:
+            _, unit_inv, downstream_nw = _match_subfragment_inventory(ff, unit_inv, subfrags, scenarios)
+        except ZeroInboundExchange:
+            if tracer.enabled:
+                tracer.event(frag, 'zero_inbound')
+            yield _FLOW, ff
+            continue
+        yield _FLOW, ff  # only now is the node weight final
+
+        # next we traverse our own child flows, determining the exchange values from the normalized unit inventory
+        children = []
+        for f in frag.child_flows:
+            ev = 0.0
+            try:
+                m = next(j for j in unit_inv if j.fragment.flow == f.flow)
+                if m.fragment.direction == f.direction:
+                    ev += m.magnitude
+                else:
+                    ev -= m.magnitude
+                unit_inv.remove(m)
+            except StopIteration:
+                if tracer.enabled:
+                    tracer.event(frag, 'no_driving_flow', child=f.uuid)
+                continue
+
+            if tracer.enabled:
+                tracer.event(frag, 'child_ev', level=4, child=f.uuid, ev=ev)
+            children.append((_NODE, f, downstream_nw, None, ev))
+
+        # remaining un-accounted io flows are getting appended, so do scale
+        for x in unit_inv:
+            x.scale(downstream_nw)
+        tasks.append((_EMIT, list(unit_inv)))
+        tasks.extend(reversed(children))
+
+
+def _stream_traversal(fragment, scenarios, frags_seen, memo):
+    """
+    Drive a traversal, along with the subfragment traversals it requires, on an explicit stack of _traverse_steps
+    generators, so that neither the depth of the fragment tree nor the nesting of subfragments is limited by the
+    Python stack.  The FragmentFlows of the fragment's own traversal are yielded as they are finalized; those of
+    subfragment traversals are collected into lists, because they must be grouped before the subfragment node can be
+    finalized.
+    :return: a generator of FragmentFlows, in traversal order
+    """
+    prof = profiler.enabled
+    if prof:
+        depth = profiler.depth
+        profiler.enter('traverse', fragment)
+    stack = [(_traverse_steps(fragment, scenarios, frags_seen, memo), None)]
+    value = None
+    try:
+        while stack:
+            steps, ffs = stack[-1]
+            try:
+                event, arg = steps.send(value)
+            except StopIteration:
+                stack.pop()
+                value = ffs
+                if prof:
+                    profiler.exit()
+                continue
+            value = None
+            if event == _FLOW:
+                if ffs is None:
+                    yield arg
+                else:
+                    ffs.append(arg)
+            else:
+                if prof:
+                    profiler.enter('subfragment', arg[0])
+                stack.append((_traverse_steps(*arg, memo), []))
+    finally:
+        if prof:
+            profiler.unwind(depth)
+
+
+def _run_traversal(fragment, scenarios, frags_seen, memo):
+    """
+    :return: a list of FragmentFlows
+    """
+    return list(_stream_traversal(fragment, scenarios, frags_seen, memo))
+
+
+def copy_ios(ios):
+    """
+    Copy a list of io FragmentFlows, which are modified during subfragment traversal (matched flows are removed and
+    the remainder are scaled)
+    :param ios:
+    :return:
+    """
+    return [FragmentFlow(x.fragment, x.magnitude, x.node_weight, x.term, x.is_conserved) for x in ios]
+
+
+def _traversed_references(term_node, internal, scenarios=None, memo=None):
+    """
+    The uuids of reference fragments encountered in a subfragment traversal- used to detect recursive loops when a
+    memoized inventory is reused.  Nested subfragments that are already in the memo contribute their memoized
+    references, so deeply nested subfragments are not walked repeatedly.
+    """
+    seen = {term_node.top().uuid}
+    stack = [internal]
+    while stack:
+        for ff in stack.pop():
+            if ff.term.is_subfrag and isinstance(ff.term.term_node, LcFragment):
+                hit = None if memo is None else memo.get(_memo_key(ff.term.term_node, scenarios))
+                if hit is None:
+                    seen.add(ff.term.term_node.top().uuid)
+                    stack.append(ff.subfragments)
+                else:
+                    seen.update(hit[2])
+    return seen
 
+
+def memo_unit_inventory(term_node, scenarios, frags_seen, memo):
+    """
+    Obtain the unit inventory of a subfragment, consulting the memo first.  Memo entries are keyed by subfragment and
+    effective scenario set.  The io flows are copied on every use so that the memoized inventory is not modified;
+    the internal flows are only a record of the subfragment traversal and are shared.
+
+    If the memoized traversal encountered any fragment that is already in frags_seen, the subfragment is re-traversed
+    so that the recursive loop is reported exactly as it would be without the memo.
+
+    :param term_node: the subfragment termination's term node
+    :param scenarios: the effective scenario set, or None
+    :param frags_seen:
+    :param memo: a dict
+    :return: ios, internal
+    """
+    hit = _memo_lookup(term_node, scenarios, frags_seen, memo)
+    if hit is None:
+        if isinstance(term_node, LcFragment):
+            ios, internal = term_node.unit_inventory(scenario=scenarios, frags_seen=frags_seen, memo=memo)
         else:
-            self.dbg_print('subfrag')
-            ffs = self._traverse_subfragment(ff, scenarios, frags_seen)
+            ios, internal = term_node.unit_inventory(scenario=scenarios)
+        hit = _memo_store(term_node, scenarios, memo, ios, internal)
+    return hit
+
+
+def _memo_key(term_node, scenarios):
+    if scenarios is None:
+        return term_node.link, None
+    return term_node.link, frozenset(scenarios)
+
+
+def _memo_lookup(term_node, scenarios, frags_seen, memo):
+    """
+    :return: a copy of the memoized (ios, internal), or None if there is no usable memo entry
+    """
+    hit = memo.get(_memo_key(term_node, scenarios))
+    if hit is None or (frags_seen and not hit[2].isdisjoint(frags_seen)):
+        return None
+    return copy_ios(hit[0]), list(hit[1])
 
-        return ffs, conserved_val
+
+def _memo_store(term_node, scenarios, memo, ios, internal):
+    """
+    :return: a copy of the stored (ios, internal)
+    """
+    if isinstance(term_node, LcFragment):
+        seen = _traversed_references(term_node, internal, scenarios, memo)
+    else:
+        seen = set()
+    memo[_memo_key(term_node, scenarios)] = (ios, internal, seen)
+    return copy_ios(ios), list(internal)
 
 
-def _do_subfragment_traversal(ff, scenarios, frags_seen):
+def _match_subfragment_inventory(ff, unit_inv, subfrags, scenarios):
     """
-    This turns out to be surprisingly complicated. So we now have:
-     - LcFragment._traverse_node <-- which is called recursively
-      + scenario matching + finds ev and term
-      - selects handler based on term type:
-       - LcFragment._subfragment_traversal
-       |- invokes (static) _do_subfragment_traversal (YOU ARE HERE)
-       ||- calls [internally recursive] term_node.unit_inventory, which is just a wrapper for
-       || - (static) group_ios
-       ||  + reference flow and autoconsumption handling
-       || /
-       ||/
-       |+ reference flow matching and normalizing
-       + child flow matching and further recursion --> into LcFragment._traverse_node
-      /
-     /
-     ffs, conserved_val
-
-
-     - (static) group_ios
-     - nested inside LcFragment.unit_inventory, which is really just a wrapper
-     - called from
-     - called from
-
-    :param ff: The FragmentFlow whose subfragment is being traversed
-    :param scenarios: to pass to subfragment
+    Match the driven flow in a subfragment's unit inventory and normalize it, so that compiled traversal plans can
+    supply their own subfragment inventory and still normalize it exactly the way a live traversal does.
+
+    :param ff: The FragmentFlow whose subfragment was traversed
+    :param unit_inv: the grouped io flows of the subfragment traversal (modified in place: matched flow removed)
+    :param subfrags: the subfragment traversal itself
+    :param scenarios: to record on the FragmentFlow
     :return: ffs [subfragment traversal appended], unit_inv [with reference flow removed], downstream node weight
     """
-    term = ff.term  # note that we ignore term.direction in subfragment traversal
+    term = ff.term
     node_weight = ff.node_weight
     self = ff.fragment
 
-    unit_inv, subfrags = term.term_node.unit_inventory(scenario=scenarios, frags_seen=frags_seen)
-
     # find the inventory flow that matches us
     # use term_flow over term_node.flow because that allows client code to specify inverse traversal knowing
     #  only the sought flow.
@@ -1726,7 +2373,8 @@ def _do_subfragment_traversal(ff, scenarios, frags_seen):
         for k in unit_inv:
             print('%s' % k.fragment.flow.link)
         raise MissingFlow('Term flow: %s' % term.term_flow.link)
-    self.dbg_print('matched flow %s' % match.fragment.flow.link)
+    if tracer.enabled:
+        tracer.event(self, 'matched_flow', flow=match.fragment.flow.link)
 
     unit_inv.remove(match)
 
@@ -1737,7 +2385,8 @@ def _do_subfragment_traversal(ff, scenarios, frags_seen):
         raise ZeroInboundExchange
     if match.fragment.direction == self.direction:  # match direction is w.r.t. subfragment
         # self is driving subfragment in reverse
-        self.dbg_print('reverse-driven subfragment %.3s' % match.fragment.uuid)
+        if tracer.enabled:
+            tracer.event(self, 'reverse_driven', match=match.fragment.uuid)
         in_ex *= -1
 
     # node weight for the driven [downstream] fragment
@@ -1761,7 +2410,8 @@ def _do_subfragment_traversal(ff, scenarios, frags_seen):
     '''
     # now, we abolish descend as a traversal parameter and make it only an LCIA parameter
     # therefore, we retain subfragments always, we just have to decide how to scale them
-    self.dbg_print('%d subfrags resulting from this traversal' % len(subfrags), 1)
+    if tracer.enabled:
+        tracer.event(self, 'subfrags', count=len(subfrags))
     ff.aggregate_subfragments(subfrags, scenarios=scenarios)
     ff.node_weight = downstream_nw
     ffs = [ff]
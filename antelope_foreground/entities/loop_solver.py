@@ -0,0 +1,252 @@
+"""
+Loop-closing solver for cyclic fragment models.
+
+A live traversal raises InvalidParentChild whenever a reference fragment is encountered inside its own subfragment
+traversal, because the recursion would never terminate.  Recycling loops (e.g. used oil re-refining feeding base oil
+back into lubricant production) are nonetheless legitimate models, and can be solved exactly by linear algebra.
+
+The subfragment references among reference fragments form a directed graph.  Its strongly connected components
+(SCCs) are the sets of fragments that depend on one another through loops.  For each SCC:
+
+ * every member H is traversed "directly", with subfragment nodes that refer to SCC members treated as demands
+   only.  This gives H's direct io flows, and a column of the technology matrix A: A[G, H] is the activity of member
+   G demanded by a unit activity of H.
+ * the total activities required to deliver one unit of each member are the columns of S = (I - A)^-1, which is
+   computed from a sparse LU factorization of (I - A).
+ * the closed unit inventory of member G is then the sum of each member's direct io flows, weighted by S[H, G].
+
+The closed inventories are stored in a traversal memo (see LcFragment.traverse()), so that ordinary traversals,
+unit inventories, and LCIA of any fragment that uses the loop find the loop already solved.  SCCs are solved in
+dependency order, so a loop that drives another loop sees that loop already closed.
+
+Within an SCC, subfragment nodes that refer to other members must be driven by the member's reference flow and may
+not have child flows of their own, since their exchange values would depend on the solution itself.  In the closed
+traversal record, such a node reports the member activity it demands; the member's contributions appear in the
+record of the member that closes the loop, so the node's own subfragment record is empty (a single zero-weight
+reference flow).
+"""
+
+import numpy as np
+from scipy.sparse import csc_matrix, identity
+from scipy.sparse.linalg import splu
+
+from .fragments import LcFragment, _memo_key
+from .traversal_plan import traversal_scenarios, _scaled_ff
+from ..fragment_flows import FragmentFlow, group_ios
+
+
+class LoopClosureError(Exception):
+    pass
+
+
+def subfragment_graph(fragment, scenarios):
+    """
+    The subfragment references among the reference fragments reachable from the fragment under a given scenario set.
+    :param fragment:
+    :param scenarios: a scenario set, as constructed by traversal_scenarios()
+    :return: a list of reference fragments in the order encountered, and a dict mapping each reference fragment's
+     uuid to a list of its subfragment nodes and their terminations
+    """
+    tops = []
+    edges = dict()
+    stack = [fragment.top()]
+    while stack:
+        top = stack.pop()
+        if top.uuid in edges:
+            continue
+        tops.append(top)
+        edges[top.uuid] = []
+        for node in top.tree():
+            term = node._terminations[node._match_scenario_term(scenarios)]
+            if term.is_subfrag and isinstance(term.term_node, LcFragment):
+                edges[top.uuid].append((node, term))
+                stack.append(term.term_node.top())
+    return tops, edges
+
+
+def strongly_connected(tops, edges):
+    """
+    Tarjan's algorithm, without recursion.  The components are reported in reverse topological order, i.e. every
+    component is reported after all the components it depends on.
+    :param tops: a list of reference fragments
+    :param edges: as returned by subfragment_graph()
+    :return: a list of lists of reference fragments.  Only components that contain a loop are reported.
+    """
+    index = dict()
+    low = dict()
+    on_stack = set()
+    stack = []
+    sccs = []
+    counter = 0
+    for root in tops:
+        if root.uuid in index:
+            continue
+        work = [(root, 0)]
+        while work:
+            v, i = work.pop()
+            if i == 0:
+                index[v.uuid] = low[v.uuid] = counter
+                counter += 1
+                stack.append(v)
+                on_stack.add(v.uuid)
+            succ = edges[v.uuid]
+            if i < len(succ):
+                work.append((v, i + 1))
+                w = succ[i][1].term_node.top()
+                if w.uuid not in index:
+                    work.append((w, 0))
+                elif w.uuid in on_stack:
+                    low[v.uuid] = min(low[v.uuid], index[w.uuid])
+                continue
+            # v is finished
+            if work:
+                u = work[-1][0]
+                low[u.uuid] = min(low[u.uuid], low[v.uuid])
+            if low[v.uuid] == index[v.uuid]:
+                scc = []
+                while True:
+                    w = stack.pop()
+                    on_stack.remove(w.uuid)
+                    scc.append(w)
+                    if w is v:
+                        break
+                scc.reverse()
+                if len(scc) > 1 or any(t.term_node.top() is v for _, t in edges[v.uuid]):
+                    sccs.append(scc)
+    return sccs
+
+
+class _LoopSolution(object):
+    """
+    Solve one strongly connected component of reference fragments and store the closed unit inventories of its
+    members in a traversal memo.
+    """
+    def __init__(self, members, edges, scenarios, memo):
+        self.members = members
+        self.scenarios = scenarios
+        self.memo = memo
+        self._index = {m.uuid: i for i, m in enumerate(members)}
+        self._term_nodes = [dict() for m in members]  # subfragment term nodes that refer to each member
+        for m in members:
+            for node, term in edges[m.uuid]:
+                target = term.term_node.top()
+                if target.uuid not in self._index:
+                    continue
+                if term.term_flow != target.flow:
+                    raise LoopClosureError('%.5s: loop-closing subfragment must be driven by its reference flow'
+                                           % node.uuid)
+                if next(node.child_flows, None) is not None:
+                    raise LoopClosureError('%.5s: loop-closing subfragment may not have child flows' % node.uuid)
+                self._term_nodes[self._index[target.uuid]][term.term_node.link] = term.term_node
+        self.activities = None
+
+    def _member_term(self, member):
+        return member._terminations[member._match_scenario_term(self.scenarios)]
+
+    def _placeholders(self, ref_ios):
+        """
+        Memo entries that report only a member's reference flow, so that a direct traversal computes the demand for
+        the member without traversing it
+        """
+        for i, m in enumerate(self.members):
+            ref = ref_ios[i]
+            internal = [FragmentFlow(m, 0.0, 0.0, self._member_term(m), False)]
+            for link, term_node in self._term_nodes[i].items():
+                io = FragmentFlow.cutoff(term_node, m.flow, ref[0], ref[1])
+                self.memo[_memo_key(term_node, self.scenarios)] = ([io], internal, set())
+
+    def _direct(self):
+        return [m.traverse(self.scenarios, memo=self.memo) for m in self.members]
+
+    def _reference_io(self, member, ffs):
+        ios, _ = group_ios(member, ffs)
+        try:
+            ref = next(k for k in ios if k.fragment.flow == member.flow)
+        except StopIteration:
+            raise LoopClosureError('%.5s: reference flow does not appear in unit inventory' % member.uuid)
+        return ref.fragment.direction, ref.magnitude
+
+    def solve(self):
+        n = len(self.members)
+        # pass 1: find each member's reference io.  Demands on other members do not affect it.
+        self._placeholders([('Output', 1.0)] * n)
+        ref_ios = [self._reference_io(m, ffs) for m, ffs in zip(self.members, self._direct())]
+
+        # pass 2: direct traversals and technology matrix
+        self._placeholders(ref_ios)
+        direct = self._direct()
+        rows, cols, data = [], [], []
+        for j, ffs in enumerate(direct):
+            for ff in ffs:
+                if ff.term.is_subfrag and isinstance(ff.term.term_node, LcFragment):
+                    i = self._index.get(ff.term.term_node.top().uuid)
+                    if i is not None:
+                        rows.append(i)
+                        cols.append(j)
+                        data.append(ff.node_weight)
+        a = csc_matrix((data, (rows, cols)), shape=(n, n))
+        try:
+            lu = splu(csc_matrix(identity(n) - a))
+        except RuntimeError as e:
+            raise LoopClosureError('Singular loop among %s: %s' % (', '.join(m.uuid for m in self.members), e))
+        self.activities = lu.solve(np.eye(n))
+
+        for g, m in enumerate(self.members):
+            record = self._closed_record(g, direct)
+            for link, term_node in self._term_nodes[g].items():
+                ios, internal = group_ios(term_node, record)
+                self.memo[_memo_key(term_node, self.scenarios)] = (ios, internal, set())
+        return self.activities
+
+    def _closed_record(self, g, direct):
+        """
+        The traversal record of member g with its loops closed: its own reference flow, followed by every member's
+        direct traversal scaled to the activity required per unit of member g
+        """
+        s = self.activities[:, g]
+        top = direct[g][0]
+        record = [top]
+        record.extend(_scaled_ff(ff, s[g]) for ff in direct[g][1:])
+        if s[g] != 1.0 and not top.term.is_fg:
+            record.append(_scaled_ff(top, s[g] - 1.0))
+        for h, ffs in enumerate(direct):
+            if h == g or s[h] == 0:
+                continue
+            record.extend(_scaled_ff(ff, s[h]) for ff in ffs)
+        return record
+
+
+def close_loops(fragment, scenarios, memo):
+    """
+    Solve every loop of subfragment references reachable from the fragment, and store the closed unit inventories
+    in the memo.  A subsequent LcFragment.traverse() with the same memo and scenario set uses them.
+    :param fragment:
+    :param scenarios: a scenario set, as constructed by traversal_scenarios()
+    :param memo: a dict
+    :return: a list of the loops closed, each a list of reference fragments
+    """
+    tops, edges = subfragment_graph(fragment, scenarios)
+    sccs = strongly_connected(tops, edges)
+    for scc in sccs:
+        _LoopSolution(scc, edges, scenarios, memo).solve()
+    return sccs
+
+
+def solve_loops(fragment, scenario=None, observed=False, memo=None):
+    """
+    Prepare a traversal memo in which all the loops reachable from the fragment are closed.  Supply it to
+    traverse(), unit_inventory(), or fragment_lcia() with the same scenario specification:
+
+    >>> memo = solve_loops(frag, 'my_scenario')
+    >>> ffs = frag.traverse('my_scenario', memo=memo)
+
+    :param fragment:
+    :param scenario:
+    :param observed:
+    :param memo: [None] an existing memo to extend
+    :return: the memo
+    """
+    if memo is None:
+        memo = dict()
+    close_loops(fragment, traversal_scenarios(scenario, observed=observed), memo)
+    return memo
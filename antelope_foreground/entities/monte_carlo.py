@@ -0,0 +1,158 @@
+"""
+Vectorized Monte Carlo simulation of fragment models.
+
+The exchange values of a fragment model may carry probability distributions (see uncertainty.py and
+LcFragment.set_uncertainty()).  monte_carlo() draws N samples from every distribution reachable from a fragment,
+including those of its subfragments, as numpy arrays, and traverses the model once for all N samples: each sample is
+a column of a multi-scenario column traversal (see traversal_matrix.py) in which the sampled exchange values replace
+the point values.  Balance flows, conservation, and subfragment normalization are computed column-wise exactly as in
+a live traversal, so that sample k reproduces the traversal that would result from setting every sampled exchange
+value to its k-th sample.  The LCIA of all N samples is then computed in the same batch, with each unit score
+looked up only once.  Every occurrence of a subfragment takes the same samples, so a subfragment that occurs several
+times in the model is traversed and scored once.
+
+Distributions may also be supplied ad hoc, keyed by fragment (or knob name, through the foreground interface).  An ad
+hoc distribution applies to whichever exchange value is in effect for the scenario, and takes precedence over any
+distribution stored with the fragment.
+
+Sampling is deterministic for a given seed: distributions are sampled in order of fragment uuid and exchange value
+key.
+"""
+
+import numpy as np
+
+from .fragments import LcFragment, ScenarioSet
+from .traversal_matrix import TraversalMatrix, _ColumnTraversal
+from .traversal_plan import traversal_scenarios
+from .uncertainty import Distribution
+
+
+def fragment_distributions(fragment):
+    """
+    Collect the distributions stored with every fragment reachable from the given fragment, through subfragment
+    terminations under any scenario.
+    :param fragment:
+    :return: dict of fragment uuid to {exchange value key: Distribution}
+    """
+    dists = dict()
+    seen = set()
+    stack = [fragment.top()]
+    while stack:
+        top = stack.pop()
+        if top.uuid in seen:
+            continue
+        seen.add(top.uuid)
+        for node in top.tree():
+            if node.uncertainties:
+                dists[node.uuid] = node.uncertainties
+            for term in node._terminations.values():
+                if term.is_subfrag and isinstance(term.term_node, LcFragment):
+                    stack.append(term.term_node.top())
+    return dists
+
+
+def draw_samples(fragment, n, distributions=None, rng=None):
+    """
+    :param fragment:
+    :param n: number of samples
+    :param distributions: [None] ad hoc distributions: a dict of fragment (or fragment uuid) to Distribution
+    :param rng: [None] a numpy Generator
+    :return: dict of fragment uuid to {exchange value key: array of n samples}, with ad hoc samples under key None
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    dists = fragment_distributions(fragment)
+    if distributions:
+        for k, d in distributions.items():
+            if not isinstance(d, Distribution):
+                raise TypeError('%s: %s is not a Distribution' % (k, d))
+            uuid = k.uuid if hasattr(k, 'uuid') else k
+            dists.setdefault(uuid, dict())[None] = d
+    samples = dict()
+    for uuid in sorted(dists.keys()):
+        samples[uuid] = dict()
+        for key in sorted(dists[uuid].keys(), key=lambda x: (x is not None, str(x))):
+            samples[uuid][key] = dists[uuid][key].sample(n, rng)
+    return samples
+
+
+def monte_carlo(fragment, quantities, n, scenario=None, observed=True, distributions=None, seed=None,
+                passthru_threshold=0.45, **kwargs):
+    """
+    Run a Monte Carlo simulation of a fragment's LCIA results.
+    :param fragment:
+    :param quantities: a list of quantity refs
+    :param n: number of samples
+    :param scenario: a scenario specification, as supplied to traverse()
+    :param observed: [True] as supplied to fragment_lcia()
+    :param distributions: [None] ad hoc distributions: a dict of fragment (or fragment uuid) to Distribution
+    :param seed: [None] random seed, for reproducible results
+    :param passthru_threshold: used when grouping subfragment inventories; see group_ios
+    :param kwargs: passed to score_cache()
+    :return: a MonteCarloResult
+    """
+    rng = np.random.default_rng(seed)
+    samples = draw_samples(fragment, n, distributions=distributions, rng=rng)
+    scenarios = traversal_scenarios(scenario, observed=observed)
+    sets = [None if scenarios is None else ScenarioSet(scenarios) for k in range(n)]
+    tm = TraversalMatrix(fragment, [scenario] * n)
+    ct = _ColumnTraversal(fragment, sets, passthru_threshold=passthru_threshold, samples=samples)
+    ct.run(tm)
+    scores = ct.lcia(quantities, **kwargs)
+    return MonteCarloResult(fragment, scenario, quantities, samples, tm, scores)
+
+
+class MonteCarloResult(object):
+    """
+    The result of monte_carlo().
+     quantities: the LCIA quantities, as supplied (a row index of scores)
+     scores: quantities x samples array of total LCIA scores
+     samples: dict of fragment uuid to {exchange value key: array of sampled values}
+     traversal: a TraversalMatrix whose rows are the sampled traversals
+    """
+    def __init__(self, fragment, scenario, quantities, samples, traversal, scores):
+        self._fragment = fragment
+        self.scenario = scenario
+        self.quantities = list(quantities)
+        self.samples = samples
+        self.traversal = traversal
+        self.scores = scores
+
+    @property
+    def fragment(self):
+        return self._fragment
+
+    @property
+    def n(self):
+        return self.scores.shape[1]
+
+    def _row(self, quantity):
+        if quantity is None:
+            if len(self.quantities) != 1:
+                raise ValueError('Quantity must be specified')
+            return 0
+        for k, q in enumerate(self.quantities):
+            if q is quantity or q == quantity:
+                return k
+        raise KeyError(quantity)
+
+    def totals(self, quantity=None):
+        """
+        :param quantity: [None] may be omitted if only one quantity was computed
+        :return: array of per-sample total scores
+        """
+        return self.scores[self._row(quantity)]
+
+    def mean(self, quantity=None):
+        return self.totals(quantity).mean()
+
+    def std(self, quantity=None):
+        return self.totals(quantity).std(ddof=1)
+
+    def percentile(self, q, quantity=None):
+        """
+        :param q: percentile or sequence of percentiles, 0-100
+        :param quantity:
+        :return:
+        """
+        return np.percentile(self.totals(quantity), q)
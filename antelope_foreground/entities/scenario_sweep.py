@@ -0,0 +1,230 @@
+"""
+Scenario sweeps: the LCIA of one fragment under many scenarios, for several quantities, by stage.
+
+A sweep is specified by a list of scenario specifications, each as supplied to traverse(), or by the dict of dicts
+that ForegroundCatalog.set_scenario_knobs() consumes.  In the latter case the knobs must already have been applied
+with set_scenario_knobs(); each scenario is then swept under its name together with its flags (the keys whose value
+is True).
+
+scenario_sweep() traverses the fragment once per scenario and computes, from each traversal, the LCIA result of every
+node for every quantity (see fragment_matrices.py), summed by stage.  Unit scores are kept in the score caches of the
+terminations, which the scenarios share: a termination that no scenario replaces is scored once for the whole sweep,
+and only the terminations particular to a scenario are scored again.  The missing unit scores of each traversal are
+computed concurrently, on a pool of threads, before it is scored (see prefetch.py).
+
+The scenarios themselves are computed by one of three executors:
+ * 'serial' (the default): one after another in the calling process, with a shared traversal memo, so that
+   subfragments are traversed once per distinct set of scenarios
+ * 'thread': traversed by a pool of threads, each traversal with a memo of its own, and scored in the calling thread
+   in the order supplied, while the remaining traversals proceed.  Scoring computes and caches unit scores in the
+   terminations and uses the persistent score store, and so stays in the calling thread.  Traversals report to the
+   profiler and the tracer, which keep a single stack and sequence, so this executor cannot be used while either is
+   enabled (within profile() or trace()).
+ * 'process': by a pool of worker processes, handed a snapshot of the model when the pool starts, as in
+   batch_traversal.py.  The calling process first scores the default scenario, so that the snapshot includes its
+   unit scores and the workers compute only the scores their scenarios add.  Unit scores computed by the workers are
+   not returned to the calling process.
+
+The result is a SweepTable, a tidy table with one row per (scenario, quantity, stage), held column-wise.  Its columns()
+are suitable for e.g. pandas.DataFrame().
+"""
+
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from .batch_traversal import _mp_context, _snapshot
+from .fragment_matrices import FragmentMatrices
+from .traversal_plan import traversal_scenarios
+from ..prefetch import prefetch_unit_scores
+from ..profiling import profiler
+from ..tracing import tracer
+
+
+EXECUTORS = ('serial', 'thread', 'process')
+COLUMNS = ('scenario', 'quantity', 'stage', 'result')
+
+
+def sweep_specs(scenarios):
+    """
+    :param scenarios: a list of scenario specifications, or a dict of dicts as supplied to set_scenario_knobs()
+    :return: list of (label, scenario specification)
+    """
+    if isinstance(scenarios, dict):
+        specs = []
+        for name, knobs in scenarios.items():
+            flags = tuple(k for k, v in (knobs or dict()).items() if v is True)
+            if flags:
+                specs.append((name, (name, ) + flags))
+            else:
+                specs.append((name, name))
+        return specs
+    return [(s, s) for s in scenarios]
+
+
+class _SweepWorker(object):
+    def __init__(self, fragment, quantities, observed, prefetch, lcia_kwargs):
+        self.fragment = fragment
+        self.quantities = quantities
+        self.observed = observed
+        self.prefetch = prefetch
+        self.lcia_kwargs = lcia_kwargs
+        self.memo = dict()
+
+    def traverse(self, scenario, memo=None):
+        """
+        :param scenario: a scenario specification
+        :param memo: [None] a traversal memo.  Default is a new one.
+        :return: (scenario set, traversal record, memo)
+        """
+        if memo is None:
+            memo = dict()
+        scenarios = traversal_scenarios(scenario, observed=self.observed)
+        return scenarios, self.fragment.traverse(scenarios, memo=memo), memo
+
+    def score(self, scenarios, ffs, memo):
+        """
+        :param scenarios: a scenario set
+        :param ffs: the fragment's traversal record under the scenario set
+        :param memo: the memo of the traversal
+        :return: (stage names, stages x quantities array)
+        """
+        if self.prefetch:
+            prefetch_unit_scores(ffs, self.quantities, threads=self.prefetch, **self.lcia_kwargs)
+        m = FragmentMatrices(self.fragment, scenarios, ffs, memo)
+        return m.node_scores(self.quantities, **self.lcia_kwargs).by_stage()
+
+    def run(self, scenario):
+        """
+        :param scenario: a scenario specification
+        :return: (stage names, stages x quantities array)
+        """
+        return self.score(*self.traverse(scenario, self.memo))
+
+
+_worker = None
+
+
+def _init_worker(snapshot):
+    global _worker
+    _worker = _SweepWorker(*pickle.loads(snapshot))
+
+
+def _run_task(scenario):
+    return _worker.run(scenario)
+
+
+def scenario_sweep(fragment, scenarios, quantities, executor='serial', workers=None, observed=True, prefetch=8,
+                   mp_context=None, **kwargs):
+    """
+    Compute the LCIA results of a fragment by stage, for every quantity, under every scenario.
+    :param fragment: a reference fragment
+    :param scenarios: a list of scenario specifications, or a dict of dicts as supplied to set_scenario_knobs()
+    :param quantities: a list of quantity refs
+    :param executor: ['serial'], 'thread', or 'process'.  'thread' is refused while profiling or tracing.
+    :param workers: [None] with executor='thread' or 'process', number of threads or worker processes.  Default is
+     the number of CPUs.
+    :param observed: [True] as supplied to fragment_lcia()
+    :param prefetch: [8] number of threads computing missing unit scores.  0 computes them during LCIA.
+    :param mp_context: [None] with executor='process', a multiprocessing context or start method name.  Default is
+     the platform's.
+    :param kwargs: passed to score_cache() / frag_flow_lcia_many()
+    :return: a SweepTable
+    """
+    specs = sweep_specs(scenarios)
+    quantities = list(quantities)
+    if executor not in EXECUTORS:
+        raise ValueError('Unknown executor %s (must be one of %s)' % (executor, ', '.join(EXECUTORS)))
+    if executor == 'thread' and (profiler.enabled or tracer.enabled):
+        raise ValueError("executor='thread' cannot be used while profiling or tracing")
+    w = _SweepWorker(fragment, quantities, observed, prefetch, kwargs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(specs)))
+    if executor == 'serial':
+        results = [w.run(s) for _, s in specs]
+    elif executor == 'thread':
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = [w.score(*t) for t in pool.map(w.traverse, [s for _, s in specs])]
+    else:
+        w.run(None)  # unit scores of the default scenario, included in the snapshot
+        snapshot = _snapshot((fragment, quantities, observed, prefetch, kwargs))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context(mp_context), initializer=_init_worker,
+                                 initargs=(snapshot, )) as pool:
+            results = list(pool.map(_run_task, [s for _, s in specs]))
+    return SweepTable.from_stages([label for label, _ in specs], quantities, results)
+
+
+class SweepTable(object):
+    """
+    The result of a scenario sweep in tidy form, with one row per scenario, quantity, and stage, stored by column:
+     scenario: the scenario's label (its name in a scenario dict, or else its specification)
+     quantity: the quantity
+     stage: the stage name ('' for nodes without one)
+     result: the LCIA result of the stage, as an array
+    Rows are ordered by scenario and quantity, in the order supplied, and then by stage, in traversal order.
+    """
+    @classmethod
+    def from_stages(cls, labels, quantities, results):
+        """
+        :param labels: a label for each scenario
+        :param quantities: a list of quantities
+        :param results: for each scenario, (stage names, stages x quantities array)
+        :return:
+        """
+        scenario, quantity, stage, values = [], [], [], []
+        for label, (stages, v) in zip(labels, results):
+            for i, q in enumerate(quantities):
+                scenario.extend([label] * len(stages))
+                quantity.extend([q] * len(stages))
+                stage.extend(stages)
+                values.append(v[:, i])
+        if values:
+            result = np.concatenate(values)
+        else:
+            result = np.zeros(0)
+        return cls(scenario, quantity, stage, result)
+
+    def __init__(self, scenario, quantity, stage, result):
+        self.scenario = scenario
+        self.quantity = quantity
+        self.stage = stage
+        self.result = result
+
+    def __len__(self):
+        return len(self.result)
+
+    def columns(self):
+        """
+        :return: dict of column name to column
+        """
+        return {k: getattr(self, k) for k in COLUMNS}
+
+    def rows(self):
+        """
+        :return: generates (scenario, quantity, stage, result) tuples
+        """
+        for k in range(len(self)):
+            yield self.scenario[k], self.quantity[k], self.stage[k], float(self.result[k])
+
+    def _mask(self, scenario, quantity):
+        return np.array([s == scenario and (q is quantity or q == quantity)
+                         for s, q in zip(self.scenario, self.quantity)], dtype=bool)
+
+    def stages(self, scenario, quantity):
+        """
+        :param scenario: a scenario label
+        :param quantity:
+        :return: dict of stage name to result
+        """
+        return {self.stage[k]: float(self.result[k]) for k in np.flatnonzero(self._mask(scenario, quantity))}
+
+    def total(self, scenario, quantity):
+        """
+        :param scenario: a scenario label
+        :param quantity:
+        :return: the total result of the scenario for the quantity
+        """
+        return float(self.result[self._mask(scenario, quantity)].sum())
@@ -0,0 +1,134 @@
+"""
+Forward-mode sensitivity of fragment LCIA results with respect to knobs.
+
+A one-at-a-time sensitivity analysis perturbs each knob (a named, parameterizable fragment) in turn and re-traverses
+the model, at a cost of one traversal per knob, and with a truncation error that depends on the size of the
+perturbation.  sensitivity() instead propagates the exact first derivatives of every magnitude and node weight
+alongside the values themselves, in a single column traversal (see traversal_matrix.py) with one column per knob.
+
+Derivatives are carried by the complex-step method: the exchange value v of knob k is replaced, in column k only, by
+v + ih for a very small step h.  Every quantity computed during the traversal then takes the form f + ih f', where f
+is the ordinary value and f' its derivative with respect to the knob, because the traversal involves only
+arithmetic (products, sums, and the quotients of subfragment normalization), and all comparisons and sign decisions
+are made on real parts.  This is the same computation as forward-mode automatic differentiation with dual numbers,
+using numpy's complex arrays as the dual type; unlike finite differences, it involves no subtraction, so the
+derivatives are exact to machine precision regardless of h.
+
+Balance flows, conserved quantities, and subfragment normalization all carry derivatives.  Discrete decisions
+(whether a node is reached, autoconsumption, the direction of grouped flows) are made at the unperturbed values,
+so the derivatives are those of the piecewise-smooth model in the neighborhood of the current values.
+
+A knob within a subfragment is perturbed in the same column at every occurrence of the subfragment, so a subfragment
+that occurs several times in the model is traversed and scored once, with its derivatives serving every occurrence.
+"""
+
+import numpy as np
+
+from .fragments import ScenarioSet
+from .traversal_matrix import _ColumnTraversal
+from .traversal_plan import traversal_scenarios
+
+
+STEP = 1e-20
+
+
+def sensitivity(fragment, quantities, knobs, scenario=None, observed=True, passthru_threshold=0.45, **kwargs):
+    """
+    Compute the derivative of the fragment's LCIA results with respect to the exchange value of each knob.
+    :param fragment:
+    :param quantities: a list of quantity refs
+    :param knobs: a list of fragments whose exchange values are the parameters
+    :param scenario: a scenario specification, as supplied to traverse()
+    :param observed: [True] as supplied to fragment_lcia()
+    :param passthru_threshold: used when grouping subfragment inventories; see group_ios
+    :param kwargs: passed to score_cache()
+    :return: a SensitivityTable
+    """
+    knobs = list(knobs)
+    n = len(knobs) + 1  # column 0 is unperturbed
+    scenarios = traversal_scenarios(scenario, observed=observed)
+    tangents = dict()
+    for k, knob in enumerate(knobs):
+        tangents.setdefault(knob.uuid, np.zeros(n, dtype=complex))[k + 1] = 1j * STEP
+
+    sets = [None if scenarios is None else ScenarioSet(scenarios) for k in range(n)]
+    ct = _ColumnTraversal(fragment, sets, passthru_threshold=passthru_threshold, tangents=tangents)
+    ct.run()
+    scores = ct.lcia(quantities, **kwargs)
+
+    values = [knob.exchange_value(traversal_scenarios(scenario, observed=observed)) for knob in knobs]
+    return SensitivityTable(fragment, scenario, knobs, quantities, values, scores[:, 0].real,
+                            scores[:, 1:].imag.T / STEP)
+
+
+class SensitivityTable(object):
+    """
+    The result of sensitivity().
+     knobs: the knob fragments (a row index)
+     quantities: the LCIA quantities (a column index)
+     values: the exchange value of each knob
+     base: the LCIA result for each quantity
+     derivatives: knobs x quantities array of d(result) / d(exchange value)
+    """
+    def __init__(self, fragment, scenario, knobs, quantities, values, base, derivatives):
+        self._fragment = fragment
+        self.scenario = scenario
+        self.knobs = knobs
+        self.quantities = list(quantities)
+        self.values = np.array(values, dtype=float)
+        self.base = base
+        self.derivatives = derivatives
+
+    @property
+    def fragment(self):
+        return self._fragment
+
+    @property
+    def shape(self):
+        return len(self.knobs), len(self.quantities)
+
+    @property
+    def elasticities(self):
+        """
+        Relative sensitivities: the fractional change in each result per fractional change in each knob,
+        d(ln result) / d(ln value).  Zero where the result is zero.
+        :return: knobs x quantities array
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            e = self.derivatives * self.values[:, np.newaxis] / self.base[np.newaxis, :]
+        return np.where(self.base[np.newaxis, :] == 0, 0.0, e)
+
+    def _row(self, knob):
+        for k, x in enumerate(self.knobs):
+            if x is knob or x.external_ref == knob or x.uuid == knob:
+                return k
+        raise KeyError(knob)
+
+    def _col(self, quantity):
+        for k, q in enumerate(self.quantities):
+            if q is quantity or q == quantity:
+                return k
+        raise KeyError(quantity)
+
+    def derivative(self, knob, quantity):
+        """
+        :param knob: a knob, or its name
+        :param quantity:
+        :return:
+        """
+        return self.derivatives[self._row(knob), self._col(quantity)]
+
+    def elasticity(self, knob, quantity):
+        return self.elasticities[self._row(knob), self._col(quantity)]
+
+    def show(self, elasticity=True):
+        """
+        Print the table, one row per knob
+        :param elasticity: [True] print elasticities; otherwise print derivatives
+        :return:
+        """
+        table = self.elasticities if elasticity else self.derivatives
+        print('%-24.24s %10s  %s' % ('knob', 'value', '  '.join('%10.10s' % q for q in self.quantities)))
+        for k, knob in enumerate(self.knobs):
+            print('%-24.24s %10.4g  %s' % (knob.external_ref, self.values[k],
+                                           '  '.join('%10.4g' % v for v in table[k])))
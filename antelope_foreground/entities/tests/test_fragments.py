@@ -37,20 +37,39 @@ Here are the things the fragment traversal is supposed to accomplish / enable:
    (a) by supplying a negative node weight
    (b) by invoking them with a flow whose direction is opposing the fragment's reference direction
 
+ * stochastic exchange values: distributions attached to exchange values are sampled in a vectorized Monte Carlo
+   traversal
+
 Not yet implemented:
  = FragmentFlows must specify which scenarios applied to both ev and termination (exactly 1 for each, maybe None)
    - challenge here is in propagating that info in GhostFragments and aggregations
  = apply-scenario option for subfragment terminations. Build one electricity grid and parameterize it for multiple
    locales; then traverse each instance differently as specified in the termination
- = stochastic exchange values
  = private subfragments can force nondescend?
   + privacy is enforced by providing a fragment ref, which can elect/neglect to implement traverse
 """
 
+import copy
+import sys
 import unittest
+from unittest.mock import patch
 # from math import floor
 
 from ..fragment_editor import create_fragment
+from ..traversal_plan import TraversalPlan, IncrementalTraversal, traversal_scenarios
+from ..traversal_matrix import traverse_many, _ColumnTraversal
+from ..fragments import LcFragment, InvalidParentChild, ScenarioConflict, ScenarioSet, scenario_bit
+from ...fragment_flows import group_ios
+from ...profiling import profile
+from ...tracing import trace
+from ...tests import lcia_fixtures as lcia
+from ..loop_solver import solve_loops
+from ..fragment_matrices import FragmentMatrices, to_matrices, lcia_matrix
+from ..batch_traversal import traverse_all
+from ..scenario_sweep import scenario_sweep, sweep_specs
+from ..monte_carlo import monte_carlo
+from ..sensitivity import sensitivity
+from ..uncertainty import Distribution, Lognormal, Triangular, Uniform
 from ...terminations import MissingFlow, FlowConversionError
 from antelope_core.entities import LcFlow
 from antelope_core.archives import Qdb
@@ -527,6 +546,517 @@ class FragmentTests(unittest.TestCase):
         self._check_fragmentflows(ff_o_s_e, f7, 'Input', expected_item)
         self._check_fragmentflows(ff_o_s_e, f5, 'Input', 1 - a1_surplus_addl)
 
+    def _ff_records(self, ffs):
+        """
+        A complete record of a traversal, including subfragments, for testing equivalence of traversal methods
+        """
+        recs = []
+        for ff in ffs:
+            recs.append((ff.fragment.uuid, ff.fragment.flow.external_ref, ff.fragment.direction, ff.magnitude,
+                         ff.node_weight, ff.term, ff.is_conserved, ff.match_scenarios,
+                         self._ff_records(ff.subfragments)))
+        return recs
+
+    def test_compiled_plan(self):
+        """
+        A compiled traversal plan must reproduce traverse() exactly, for every scenario specification
+        :return:
+        """
+        for frag in (self.a1, self.a2, self.aa, self.af):
+            for scenario in (None, 'surplus', 'improvement', 'nondescend', {'optimistic', 'efficiency'},
+                             ('optimistic', 'improvement', 'surplus')):
+                for observed in (False, True):
+                    plan = TraversalPlan.compile(frag, scenario, observed=observed)
+                    self.assertEqual(self._ff_records(frag.traverse(scenario, observed=observed)),
+                                     self._ff_records(plan.execute()))
+
+    def test_subfragment_memo(self):
+        """
+        self.af is used as a subfragment twice in self.a1 (directly and by way of self.a2).  A memo supplied to
+        traverse() should hold its inventory and give the same results when reused.
+        :return:
+        """
+        memo = dict()
+        expected = self._ff_records(self.a1.traverse('surplus'))
+        self.assertEqual(self._ff_records(self.a1.traverse('surplus', memo=memo)), expected)
+        self.assertIn((self.af.link, frozenset({'surplus'})), memo)
+        self.assertEqual(self._ff_records(self.a1.traverse('surplus', memo=memo)), expected)
+
+    def test_traverse_many(self):
+        """
+        Each row of a multi-scenario traversal must match the corresponding single-scenario traversal, node for node
+        :return:
+        """
+        scenarios = [None, 'surplus', 'improvement', 'nondescend', {'optimistic', 'efficiency'},
+                     ('optimistic', 'improvement', 'surplus'), 'surplus']
+        for frag in (self.a1, self.a2, self.aa, self.af):
+            for observed in (False, True):
+                tm = traverse_many(frag, scenarios, observed=observed)
+                self.assertEqual(tm.shape, (len(scenarios), len(tm.fragments)))
+                for k, scenario in enumerate(scenarios):
+                    ffs = [ff for ff in frag.traverse(scenario, observed=observed) if isinstance(ff.fragment, LcFragment)]
+                    self.assertEqual(tm.scenario_magnitudes(k), {ff.fragment.uuid: ff.magnitude for ff in ffs})
+                    for ff in ffs:
+                        self.assertEqual(tm.node_weights[k, tm.index(ff.fragment)], ff.node_weight)
+
+    def test_traverse_many_shared(self):
+        """
+        A subfragment that occurs several times is traversed once per distinct set of scenarios, and every row still
+        matches the single-scenario traversal
+        """
+        inner, e = lcia.scored_subfragment(2.0, 3.0)
+        e.set_exchange_value('dirty', 5.0)
+        top = lcia.new_model()
+        c = lcia.use_subfragment(top, inner, 4.0)
+        c.set_exchange_value('more', 6.0)
+        for value in (1.0, 2.0):
+            lcia.use_subfragment(top, inner, value)
+        lcia.use_subfragment(top, inner, 0.5, descend=False)
+        scenarios = [None, 'dirty', 'more', ('dirty', 'more'), 'dirty']
+        with patch.object(_ColumnTraversal, 'run', autospec=True, side_effect=_ColumnTraversal.run) as run:
+            tm = traverse_many(top, scenarios, observed=True)
+        self.assertEqual(run.call_count, 2)  # top, and inner once for all four occurrences
+        for k, scenario in enumerate(scenarios):
+            ffs = top.traverse(scenario, observed=True)
+            self.assertEqual(tm.scenario_magnitudes(k), {ff.fragment.uuid: ff.magnitude for ff in ffs})
+            for ff in ffs:
+                self.assertEqual(tm.node_weights[k, tm.index(ff.fragment)], ff.node_weight)
+
+    def test_compiled_plan_observation(self):
+        """
+        Exchange values are read at execution time, so a plan reflects observations made after it is compiled
+        :return:
+        """
+        aq = next(c for c in self.a1.child_flows if c.flow is f4)
+        plan = TraversalPlan.compile(self.a1, 'surplus')
+        aq.observe(a1_surplus_addl * 2, scenario='surplus')
+        try:
+            self._check_fragmentflows(plan.execute(), f5, 'Input', 1 - 2 * a1_surplus_addl)
+        finally:
+            aq.observe(a1_surplus_addl, scenario='surplus')
+
+    def test_dirty_tracking(self):
+        """
+        Changing an exchange value advances the revision of the fragment's parents and of fragments that use it as a
+        subfragment, but not of unrelated fragments
+        :return:
+        """
+        a2p = next(c for c in self.a2.child_flows if c.flow is fp)
+        revs = [k.revision for k in (self.a1, self.a2, self.af)]
+        a2p.set_exchange_value(1, a2_private * 2)
+        try:
+            self.assertGreater(self.a1.revision, revs[0])  # a1 uses a2 as a subfragment
+            self.assertGreater(self.a2.revision, revs[1])
+            self.assertEqual(self.af.revision, revs[2])
+        finally:
+            a2p.set_exchange_value(1, a2_private)
+
+    def test_incremental_traversal(self):
+        it = IncrementalTraversal(self.a1, 'surplus', observed=True)
+        ffs = it.traverse()
+        self.assertFalse(it.is_dirty)
+        a2p = next(c for c in self.a2.child_flows if c.flow is fp)
+        a2p.set_exchange_value(1, a2_private * 2)
+        try:
+            self.assertTrue(it.is_dirty)
+            patched = it.traverse()
+            fresh = self.a1.traverse('surplus', observed=True)
+            self.assertEqual(len(patched), len(fresh))
+            for p, f in zip(patched, fresh):
+                self.assertIs(p.fragment, f.fragment)
+                self.assertAlmostEqual(p.magnitude, f.magnitude, places=12)
+                self.assertAlmostEqual(p.node_weight, f.node_weight, places=12)
+            # unaffected subtrees are reused
+            self.assertIs(next(k for k in patched if k.fragment.flow is f2), next(k for k in ffs if k.fragment.flow is f2))
+        finally:
+            a2p.set_exchange_value(1, a2_private)
+
+    def test_deep_traversal(self):
+        """
+        Walks must not be limited by the Python stack
+        """
+        depth = sys.getrecursionlimit() + 100
+        top = prev = new_fragment(f1, 'Output', value=1.0, observe=True)
+        for i in range(depth):
+            c = new_fragment(f1, 'Input', parent=prev, value=1.001, observe=True)
+            c.terminate(c)
+            prev = c
+        new_fragment(f2, 'Input', parent=prev, value=1.0, observe=True)
+        ffs = top.traverse(observed=True)
+        self.assertEqual(len(ffs), depth + 2)
+        self.assertAlmostEqual(ffs[-1].magnitude, 1.001 ** depth)
+        self.assertEqual(len(list(top.tree())), depth + 2)
+        self.assertIs(prev.top(), top)
+
+        inner = new_fragment(f1, 'Output', value=1.0, observe=True)
+        new_fragment(f2, 'Input', parent=inner, value=2.0, observe=True)
+        for i in range(depth):
+            outer = new_fragment(f1, 'Output', value=1.0, observe=True)
+            new_fragment(f1, 'Input', parent=outer, value=1.0, observe=True).terminate(inner, descend=bool(i % 2))
+            inner = outer
+        io, _ = inner.unit_inventory(observed=True)
+        self.assertAlmostEqual(next(k for k in io if k.fragment.flow is f2).magnitude, 2.0)
+
+    def test_loop_solver(self):
+        """
+        Lubricant production uses re-refined base oil; re-refining uses some lubricant
+        """
+        lube = new_flow('Lubricant', 'mass')
+        base = new_flow('Base oil', 'mass')
+        used = new_flow('Used oil', 'mass')
+        lub = new_fragment(lube, 'Output', value=1.0)
+        b = new_fragment(base, 'Input', parent=lub, value=0.9)
+        new_fragment(f5, 'Input', parent=lub, value=0.1)
+        rr = new_fragment(base, 'Output', value=1.0)
+        new_fragment(used, 'Input', parent=rr, value=1.2)
+        new_fragment(lube, 'Input', parent=rr, value=0.05).terminate(lub)
+        b.terminate(rr)
+        with self.assertRaises(InvalidParentChild):
+            lub.traverse()
+
+        memo = solve_loops(lub)
+        ios, _ = lub.unit_inventory(memo=memo)
+        s = 1.0 / (1.0 - 0.9 * 0.05)
+        self.assertAlmostEqual(next(k for k in ios if k.fragment.flow is f5).magnitude, 0.1 * s, places=12)
+        self.assertAlmostEqual(next(k for k in ios if k.fragment.flow is used).magnitude, 1.2 * 0.9 * s, places=12)
+        ffs = lub.traverse(memo=memo)
+        self.assertAlmostEqual(next(k for k in ffs if k.fragment is b).node_weight, 0.9)
+
+    def test_to_matrices(self):
+        for scenario in (None, 'surplus', 'improvement'):
+            m = to_matrices(self.a1, scenario, observed=True)
+            ffs = self.a1.traverse(scenario, observed=True)
+            x = m.node_weights()
+            for j, ff in enumerate(m.nodes):
+                self.assertAlmostEqual(x[j], ff.node_weight, places=12)
+            inv = m.cutoff_inventory()
+            for ff in ffs:
+                if ff.term.is_null and ff.fragment.reference_entity is not None:
+                    k = m.cutoff_index[(ff.fragment.flow, ff.fragment.direction)]
+                    self.assertAlmostEqual(inv[k], sum(f.magnitude for f in ffs if f.term.is_null and
+                                                       (f.fragment.flow, f.fragment.direction) == m.cutoffs[k]))
+            self.assertEqual(m.B.shape, (len(m.background), len(m.nodes)))
+
+        # unmatched subfragment ios come from the traversal's own memo
+        scenarios = traversal_scenarios(None, observed=True)
+        memo = dict()
+        ffs = self.a1.traverse(scenarios, memo=memo)
+        self.assertEqual(FragmentMatrices(self.a1, scenarios, ffs, memo).shape, to_matrices(self.a1, None, True).shape)
+        with self.assertRaises(ValueError):
+            FragmentMatrices(self.a1, scenarios, ffs, dict())  # not in the memo
+        other = dict()
+        self.a1.traverse(scenarios, memo=other)
+        with self.assertRaises(ValueError):
+            FragmentMatrices(self.a1, scenarios, ffs, other)  # a different traversal's record
+
+    def test_monte_carlo(self):
+        """
+        Each sample reproduces the traversal with its sampled exchange values, through a subfragment that occurs twice
+        and is normalized by its own sampled reference value
+        """
+        inner, e = lcia.scored_subfragment(1.0, 2.0, {lcia.mass: 3.0})
+        inner.set_uncertainty(1, Triangular(0.5, 1.0, 2.0))  # normalizes the subfragment
+        top = lcia.new_model()
+        c = lcia.use_subfragment(top, inner, 4.0)
+        d = lcia.use_subfragment(top, inner, 1.0)
+        k = lcia.scored_leaf(top, lcia.fuel, 1.5, {lcia.mass: 1.0})
+        k.set_uncertainty(1, Lognormal(1.5, 1.2))
+        m = monte_carlo(top, [lcia.mass], 200, distributions={c: Uniform(3.0, 5.0)}, seed=1)
+        x_c = m.samples[c.uuid][None]
+        x_in = m.samples[inner.uuid][1]
+        x_k = m.samples[k.uuid][1]
+        self.assertTrue(((x_c >= 3.0) & (x_c <= 5.0)).all())
+        self.assertNotIn(d.uuid, m.samples)
+        for i in range(m.n):
+            self.assertAlmostEqual(m.totals()[i], (x_c[i] + 1.0) / x_in[i] * 2.0 * 3.0 + x_k[i], places=10)
+        self.assertAlmostEqual(m.traversal.magnitude(k)[0], x_k[0])
+        m2 = monte_carlo(top, [lcia.mass], 200, distributions={c: Uniform(3.0, 5.0)}, seed=1)
+        self.assertTrue((m2.scores == m.scores).all())
+
+        k.set_uncertainty(1, None)
+        c.set_uncertainty(1, Uniform(4.0, 4.0))
+        inner.set_uncertainty(1, None)
+        self.assertAlmostEqual(monte_carlo(top, [lcia.mass], 3).mean(), top.fragment_lcia(lcia.mass).total(),
+                               places=10)
+        self.assertEqual(Distribution.from_json(c.serialize()['uncertainty']['1']), Uniform(4.0, 4.0))
+
+    def test_monte_carlo_shared(self):
+        """
+        A subfragment that occurs several times takes the same samples everywhere, and is traversed and scored once
+        """
+        inner, e = lcia.scored_subfragment(2.0, 3.0, {lcia.mass: 1.5})
+        e.set_uncertainty(1, Uniform(2.0, 4.0))
+        top = lcia.new_model()
+        for value in (4.0, 1.0, 0.5):
+            lcia.use_subfragment(top, inner, value)
+        with patch.object(_ColumnTraversal, 'lcia', autospec=True, side_effect=_ColumnTraversal.lcia) as score:
+            m = monte_carlo(top, [lcia.mass], 50, seed=2)
+        self.assertEqual(score.call_count, 2)  # top, and inner once for all three occurrences
+        x_e = m.samples[e.uuid][1]
+        for i in range(m.n):
+            self.assertAlmostEqual(m.totals()[i], 5.5 * x_e[i] / 2.0 * 1.5, places=12)
+
+    def test_sensitivity(self):
+        """
+        Exact derivatives through a balance flow and a subfragment normalization, with the subfragment occurring twice
+        """
+        inner, e = lcia.scored_subfragment(2.0, 3.0)
+        top = lcia.new_model()
+        c = lcia.use_subfragment(top, inner, 4.0)
+        d = lcia.use_subfragment(top, inner, 1.0)
+        top.terminate(top)
+        b = lcia.new_fragment(lcia.product, 'Output', parent=top, balance=True)
+        b.terminate(NullContext)
+        b.termination().add_lcia_score(lcia.mass, 10.0)
+        # score = (c + d) * e / inner + 10 * (c + d - 1)
+        self.assertAlmostEqual(top.fragment_lcia(lcia.mass).total(), 5.0 * 3.0 / 2.0 + 10.0 * 4.0)
+        with patch.object(_ColumnTraversal, 'run', autospec=True, side_effect=_ColumnTraversal.run) as run:
+            st = sensitivity(top, [lcia.mass], [c, d, e, inner])
+        self.assertEqual(run.call_count, 2)  # top, and inner once for both occurrences
+        self.assertAlmostEqual(st.base[0], 47.5)
+        for frag in (c, d):
+            self.assertAlmostEqual(st.derivative(frag, lcia.mass), 3.0 / 2.0 + 10.0, places=12)
+        self.assertAlmostEqual(st.derivative(e, lcia.mass), 5.0 / 2.0, places=12)
+        self.assertAlmostEqual(st.derivative(inner, lcia.mass), -5.0 * 3.0 / 4.0, places=12)
+        self.assertAlmostEqual(st.elasticity(e, lcia.mass), 2.5 * 3.0 / 47.5, places=12)
+
+    def test_scenario_index(self):
+        """
+        Scenario matching by bitmask, with masks maintained as scenarios are added and removed
+        """
+        f = new_fragment(f1, 'Output', value=1.0, observe=True)
+        c = new_fragment(f2, 'Input', parent=f, value=1.0, observe=True)
+        flags = ScenarioSet(['flag %d' % i for i in range(25)])
+        self.assertEqual(c._match_scenario_ev(flags), 1)
+        c.set_exchange_value('flag 7', 2.0)
+        self.assertEqual(c._match_scenario_ev(flags), 'flag 7')
+        self.assertEqual(f.traverse(flags)[1].magnitude, 2.0)
+        c.set_exchange_value('flag 9', 3.0)
+        with self.assertRaises(ScenarioConflict):
+            c._match_scenario_ev(flags)
+        flags.remove('flag 7')
+        self.assertEqual(c._match_scenario_ev(flags), 'flag 9')
+        c.set_exchange_value('flag 9', None)
+        self.assertEqual(c._match_scenario_ev(flags), 1)
+        self.assertEqual(c._match_scenario_ev({'flag 7', 'flag 8'}), 'flag 7')  # plain sets match too
+        c.terminate(NullContext, scenario='flag 3')
+        self.assertEqual(c._match_scenario_term(flags), 'flag 3')
+        c.reverse_direction()
+        self.assertEqual(c._match_scenario_ev(ScenarioSet(['flag 7'])), 'flag 7')
+
+        # a key's bit is released when no fragment defines it, and reused
+        self.assertEqual(scenario_bit('flag 9'), 0)
+        mask = flags.mask
+        d = new_fragment(f2, 'Input', parent=f, value=1.0, observe=True)
+        d.set_exchange_value('flag 11', 4.0)
+        self.assertNotEqual(flags.mask, mask)
+        del d._exchange_values['flag 11']
+        self.assertEqual(scenario_bit('flag 11'), 0)
+        d.set_exchange_value('flag 12', 5.0)
+        reused = ScenarioSet(['flag 7', 'flag 12'])  # 'flag 12' takes a released bit
+        self.assertEqual(c._match_scenario_ev(reused), 'flag 7')
+        self.assertEqual(d._match_scenario_ev(reused), 'flag 12')
+        d.set_exchange_value('flag 13', 6.0)
+        bit = scenario_bit('flag 13')
+        d.reverse_direction()  # the replaced dict releases its keys
+        self.assertEqual(scenario_bit('flag 13'), bit)
+        d._exchange_values.clear()
+        self.assertEqual(scenario_bit('flag 13'), 0)
+
+    def test_traverse_all(self):
+        scored = new_fragment(f1, 'Output', value=1.0, observe=True)
+        e = new_fragment(f5, 'Output', parent=scored, value=2.0, observe=True)
+        e.terminate(NullContext)
+        e.termination().add_lcia_score(mass, 3.0)
+        e.set_exchange_value('surplus', 4.0)
+        frags = [self.a1, self.a2, self.af, self.aa, self.a2_alt, scored]
+        scenarios = [None, 'surplus', 'optimistic', ('optimistic', 'surplus', 'efficiency')]
+        serial = traverse_all(frags, scenarios, workers=1, observed=True)
+        parallel = traverse_all(frags, scenarios, workers=3, observed=True)
+        self.assertEqual(len(parallel), len(frags) * len(scenarios))
+        self.assertEqual(parallel.errors, [])
+        self.assertEqual(serial.summaries, parallel.summaries)
+        ffs = self.a1.traverse('surplus', observed=True)
+        self.assertEqual(parallel.summary(self.a1, 'surplus').nodes[1], (ffs[1].fragment.uuid, ffs[1].magnitude,
+                                                                         ffs[1].node_weight))
+        scores = traverse_all([scored], scenarios, workers=2, observed=True, quantities=[mass])
+        self.assertEqual(scores.score(scored, mass, 'surplus'), 12.0)
+        self.assertEqual(scores.score(scored, mass), scored.fragment_lcia(mass).total())
+
+    def test_traverse_all_spawn(self):
+        """
+        Spawned workers inherit nothing from the calling process: they must rebuild the model from the snapshot,
+        hand-made unit scores included
+        """
+        inner, e = lcia.scored_subfragment(2.0, 3.0)
+        e.set_exchange_value('dirty', 5.0)
+        top = lcia.new_model()
+        for value in (4.0, 1.0):
+            lcia.use_subfragment(top, inner, value)
+        scenarios = [None, 'surplus', 'dirty']
+        for frags, quantities in (([self.a1, self.aa, top], None), ([top], [lcia.mass])):
+            serial = traverse_all(frags, scenarios, workers=1, observed=True, quantities=quantities)
+            spawned = traverse_all(frags, scenarios, workers=2, observed=True, quantities=quantities,
+                                   mp_context='spawn')
+            self.assertEqual(spawned.errors, [])
+            self.assertEqual(serial.summaries, spawned.summaries)
+        self.assertEqual(spawned.score(top, lcia.mass, 'dirty'), 5.0 * 5.0 / 2.0)
+
+    def test_traverse_all_errors(self):
+        """
+        A model that cannot be traversed is reported; any other exception propagates
+        """
+        top = lcia.new_model()
+        c = lcia.scored_leaf(top, lcia.fuel, 1.0, {lcia.mass: 1.0})
+        c.set_exchange_value('light', 0.5)
+        c.set_exchange_value('heavy', 2.0)
+        batch = traverse_all([top], [None, ('light', 'heavy')], workers=2, observed=True)
+        self.assertEqual([s.scenario for s in batch.errors], [('light', 'heavy')])
+        self.assertTrue(batch.errors[0].error.startswith('ScenarioConflict'))
+        with self.assertRaises(AttributeError):
+            traverse_all([top], workers=1, observed=True, quantities=['not a quantity'])
+
+    def test_traverse_iter(self):
+        """
+        Streaming traversal yields the same flows as traverse(), with balance flows after their siblings
+        """
+        def summary(ffs):
+            return [(ff.fragment.uuid, ff.magnitude, ff.node_weight) for ff in ffs]
+
+        for frag in (self.a1, self.a2, self.af, self.aa, self.a2_alt):
+            for scenario in (None, 'surplus', ('optimistic', 'surplus', 'efficiency')):
+                ffs = frag.traverse(scenario, observed=True)
+                self.assertEqual(summary(frag.traverse_iter(scenario, observed=True)), summary(ffs))
+                streamed, _ = group_ios(frag, frag.traverse_iter(scenario, observed=True))
+                ios, _ = group_ios(frag, ffs)
+                self.assertEqual([(x.fragment.flow, x.fragment.direction, x.magnitude) for x in streamed],
+                                 [(x.fragment.flow, x.fragment.direction, x.magnitude) for x in ios])
+
+        top = new_fragment(f1, 'Output', value=1.0, observe=True)
+        top.terminate(top)
+        b = new_fragment(f1, 'Output', parent=top, balance=True)
+        c = new_fragment(f1, 'Input', parent=top, value=4.0, observe=True)
+        c.terminate(c)
+        new_fragment(f2, 'Input', parent=c, value=2.0, observe=True)
+        seen = []
+        for ff in top.traverse_iter(observed=True):
+            if ff.fragment is b:
+                self.assertEqual(ff.magnitude, 3.0)
+                self.assertEqual(len(seen), 3)  # top, c, and c's child
+            seen.append(ff.fragment)
+        self.assertIn(b, seen)
+
+    def test_slotted_records(self):
+        ffs = self.a1.traverse(observed=True)
+        ios, _ = self.a1.unit_inventory(observed=True)
+        for ff in ffs + ios:
+            self.assertFalse(hasattr(ff, '__dict__'))
+        self.assertFalse(hasattr(ios[0].fragment, '__dict__'))
+        self.assertIsNone(ios[0].term._lcia_results)  # cutoffs are never scored
+        c = copy.copy(ios[0])  # uses the same reduce protocol as pickle
+        self.assertEqual((c.fragment, c.magnitude, c.node_weight, c.term), (ios[0].fragment, ios[0].magnitude,
+                                                                             ios[0].node_weight, ios[0].term))
+
+    def test_fragment_lcia_many(self):
+        """
+        One traversal and one walk give the same results as fragment_lcia() for each quantity, with the subfragment
+        occurring both descended and not
+        """
+        mass, volume = lcia.mass, lcia.volume
+        inner, e = lcia.scored_subfragment(2.0, 3.0, {mass: 1.0, volume: 5.0})
+        top = lcia.new_model()
+        lcia.use_subfragment(top, inner, 4.0)
+        lcia.use_subfragment(top, inner, 0.5, descend=False)
+        lcia.scored_leaf(top, lcia.fuel, 1.5, {mass: 2.0, volume: 0.1})
+        res = top.fragment_lcia_many([mass, volume])
+        self.assertEqual(list(res.indices()), [mass, volume])
+        for q in (mass, volume):
+            single = top.fragment_lcia(q)
+            self.assertEqual(res[q].total(), single.total())
+            self.assertEqual(sorted(res[q].keys()), sorted(single.keys()))
+        self.assertAlmostEqual(res[mass].total(), 4.5 * 3.0 / 2.0 + 1.5 * 2.0)
+        self.assertAlmostEqual(res[volume].total(), 4.5 * 3.0 * 5.0 / 2.0 + 1.5 * 0.1)
+
+    def test_lcia_matrix(self):
+        """
+        Node scores by stage, under a scenario that changes a non-descended subfragment's exchange value
+        """
+        mass, volume = lcia.mass, lcia.volume
+        inner, e = lcia.scored_subfragment(2.0, 3.0, {mass: 1.0, volume: 5.0})
+        top = lcia.new_model(StageName='assembly')
+        c = lcia.use_subfragment(top, inner, 4.0, descend=False)
+        c['StageName'] = 'materials'
+        c.set_exchange_value('more', 6.0)
+        k = lcia.scored_leaf(top, lcia.fuel, 1.5, {mass: 2.0, volume: 0.1}, StageName='assembly')
+        for scenario, x_c in ((None, 4.0), ('more', 6.0)):
+            m = lcia_matrix(top, [mass, volume], scenario=scenario)
+            self.assertEqual(m.shape, (3, 2))
+            res = top.fragment_lcia_many([mass, volume], scenario=scenario)
+            for i, q in enumerate((mass, volume)):
+                self.assertAlmostEqual(m.totals()[i], res[q].total(), places=12)
+                for frag in (c, k):
+                    self.assertAlmostEqual(m.score(frag, q), res[q][frag.uuid].cumulative_result, places=12)
+            self.assertAlmostEqual(m.score(c, volume), x_c * 3.0 * 5.0 / 2.0)
+            stages, by_stage = m.by_stage()
+            self.assertEqual(stages, ['assembly', 'materials'])
+            self.assertAlmostEqual(by_stage[0, 0], 1.5 * 2.0)
+            self.assertAlmostEqual(by_stage[1, 0], x_c * 3.0 / 2.0)
+
+    def test_scenario_sweep(self):
+        top = new_fragment(f1, 'Output', value=1.0, observe=True, StageName='assembly')
+        c = new_fragment(f5, 'Output', parent=top, value=2.0, observe=True, StageName='materials')
+        c.terminate(NullContext)
+        c.termination().add_lcia_score(mass, 3.0)
+        c.set_exchange_value('heavy', 5.0)
+        k = new_fragment(f4, 'Output', parent=top, value=1.5, observe=True, StageName='assembly')
+        k.terminate(NullContext)
+        k.termination().add_lcia_score(mass, 2.0)
+        knobs = {'base': None, 'heavy': {'light-duty': True}}
+        self.assertEqual(sweep_specs(knobs), [('base', 'base'), ('heavy', ('heavy', 'light-duty'))])
+        serial = scenario_sweep(top, knobs, [mass])
+        self.assertEqual(len(serial), 4)
+        self.assertEqual(serial.stage[:2], ['assembly', 'materials'])
+        self.assertEqual(serial.stages('heavy', mass), {'assembly': 1.5 * 2.0, 'materials': 5.0 * 3.0})
+        for s in knobs:
+            self.assertAlmostEqual(serial.total(s, mass), top.fragment_lcia(mass, scenario=s).total())
+        threaded = scenario_sweep(top, knobs, [mass], executor='thread', workers=2)
+        self.assertEqual(list(serial.rows()), list(threaded.rows()))
+        for context in (profile, trace):
+            with context(), self.assertRaises(ValueError):
+                scenario_sweep(top, knobs, [mass], executor='thread')
+        parallel = scenario_sweep(top, knobs, [mass], executor='process', workers=2, mp_context='spawn')
+        self.assertEqual(list(serial.rows()), list(parallel.rows()))
+        self.assertEqual(list(serial.columns().keys()), ['scenario', 'quantity', 'stage', 'result'])
+        with self.assertRaises(ValueError):
+            scenario_sweep(top, [None], [mass], executor='gpu')
+
+    def test_top_contributors(self):
+        """
+        A dominating leaf is found without expanding the subfragment, which occurs twice
+        """
+        mass = lcia.mass
+        inner, e = lcia.scored_subfragment(2.0, 3.0)
+        top = lcia.new_model()
+        lcia.use_subfragment(top, inner, 4.0)
+        lcia.use_subfragment(top, inner, 2.0)
+        k = lcia.scored_leaf(top, lcia.fuel, 1.5, {mass: 20.0})
+        lead = top.top_contributors(mass, n=1)
+        self.assertEqual([x.entity.fragment for x in lead], [k])
+        self.assertAlmostEqual(lead[0].result, 30.0)
+        self.assertEqual(lead.expanded, 0)  # the subfragments' bounds are below the leading result
+        self.assertAlmostEqual(lead.pruned, 6.0 * 3.0 / 2.0)
+        every = top.top_contributors(mass, n=None)
+        self.assertEqual([x.entity.fragment for x in every], [k, e, e])
+        self.assertEqual([x.result for x in every[1:]], [6.0, 3.0])
+        self.assertEqual(every.pruned, 0.0)
+        self.assertAlmostEqual(sum(x.result for x in every), top.fragment_lcia(mass).total())
+        self.assertEqual(len(top.top_contributors(mass, n=None, threshold=5.0)), 2)
+        by_process = top.top_contributors(mass, by='process')
+        self.assertEqual(len(by_process), 1)
+        self.assertAlmostEqual(by_process[0].result, 39.0)
+        with self.assertRaises(ValueError):
+            top.top_contributors(mass, by='stage')
+
 
 
 
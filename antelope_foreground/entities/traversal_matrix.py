@@ -0,0 +1,721 @@
+"""
+Multi-scenario traversal.
+
+A scenario sweep that calls LcFragment.traverse() once per scenario repeats the same tree walk hundreds of times,
+differing only in the numbers that flow through it.  traverse_many() walks the fragment tree once for a whole list of
+scenario specifications.  Each node's exchange values are gathered across all the requested scenarios into a numpy
+column, and node weights are propagated for all scenarios at once.  Balance flows, subfragment normalization, and the
+grouping of subfragment inventories (group_ios) are all computed on columns, with masks to account for the parts of
+the tree that are reached in some scenarios and not others.
+
+The result is a TraversalMatrix holding dense scenario x node arrays of magnitudes and node weights, in which row k
+reproduces the values reported by traverse(scenarios[k]) for every node in the fragment tree.  Nodes that are not
+reached in a given scenario have zero magnitude and node weight.
+
+Static properties of each node (matched exchange value, termination, conservation factors) are resolved once per
+distinct scenario set, so that scenario specifications that resolve identically share the work.  Likewise, a
+subfragment that occurs several times in the tree is traversed once per distinct set of columns.  Only remote
+subfragments (FragmentRefs to other foregrounds) are computed scenario-by-scenario, because their inventories must
+be obtained from their hosts.
+
+The columns need not be distinct scenarios: a column traversal may also be given arrays of sampled exchange values
+(see monte_carlo.py), which replace the resolved exchange values of the sampled nodes column by column.  Once a
+column traversal has run, lcia() computes the total LCIA score of every column, as frag_flow_lcia() would for the
+corresponding traversal.
+"""
+
+import numpy as np
+
+from .fragments import InvalidParentChild, ScenarioConflict, LcFragment, ScenarioSet
+from .traversal_plan import traversal_scenarios
+from ..fragment_flows import CumulatingFlows
+from ..terminations import FlowConversionError, MissingFlow, UnresolvedAnchor, UnCachedScore
+from ..tracing import tracer
+
+
+NODE_UNREACHED = -1
+NODE_CUTOFF = 0
+NODE_FOREGROUND = 1
+NODE_SUBFRAGMENT = 2
+
+
+def _dir_sign(direction):
+    return 1 if direction == 'Output' else -1
+
+
+def _magnitude(v):
+    """
+    Absolute value by the sign of the real part, so that tangents (imaginary parts) keep their sense
+    """
+    return np.where(v.real < 0, -v, v)
+
+
+def traverse_many(fragment, scenarios, observed=False, passthru_threshold=0.45):
+    """
+    Traverse a fragment under a list of scenario specifications at once.
+    :param fragment: the fragment to traverse
+    :param scenarios: a list of scenario specifications, each of which has the same meaning as the scenario argument
+     to LcFragment.traverse()
+    :param observed: as in LcFragment.traverse()
+    :param passthru_threshold: used when grouping subfragment inventories; see group_ios
+    :return: a TraversalMatrix
+    """
+    scenarios = list(scenarios)
+    scenario_sets = [traversal_scenarios(s, observed=observed) for s in scenarios]
+    tm = TraversalMatrix(fragment, scenarios)
+    _ColumnTraversal(fragment, scenario_sets, passthru_threshold=passthru_threshold).run(tm)
+    return tm
+
+
+class TraversalMatrix(object):
+    """
+    The result of traverse_many().
+     fragments: the nodes of the fragment tree, in traversal order (a column index)
+     scenarios: the scenario specifications, as supplied (a row index)
+     magnitudes: scenarios x nodes array of fragment flow magnitudes
+     node_weights: scenarios x nodes array of node weights
+     reached: scenarios x nodes boolean array indicating whether the node appears in the traversal
+    """
+    def __init__(self, fragment, scenarios):
+        self._fragment = fragment
+        self.scenarios = scenarios
+        self.fragments = []
+        self.magnitudes = None
+        self.node_weights = None
+        self.reached = None
+        self._index = dict()
+
+    @property
+    def fragment(self):
+        return self._fragment
+
+    @property
+    def shape(self):
+        return len(self.scenarios), len(self.fragments)
+
+    def index(self, fragment):
+        """
+        :param fragment: a fragment in the tree, or its uuid
+        :return: the column index of the fragment
+        """
+        if hasattr(fragment, 'uuid'):
+            fragment = fragment.uuid
+        return self._index[fragment]
+
+    def magnitude(self, fragment):
+        return self.magnitudes[:, self.index(fragment)]
+
+    def node_weight(self, fragment):
+        return self.node_weights[:, self.index(fragment)]
+
+    def scenario_magnitudes(self, k):
+        """
+        :param k: row index
+        :return: dict of fragment uuid to magnitude for the nodes reached in scenario k
+        """
+        return {f.uuid: self.magnitudes[k, j] for j, f in enumerate(self.fragments) if self.reached[k, j]}
+
+
+class _IoAccumulator(object):
+    """
+    Column-wise version of the accumulators in group_ios.  Magnitudes are stored in an absolute sign convention
+    (Output positive) and converted to group_ios' first-seen-direction convention when the inventory is grouped.
+    """
+    def __init__(self, n, dtype=float):
+        self.first = np.zeros(n, dtype=int)  # direction sign of the first flow seen; 0 = not seen
+        self.value = np.zeros(n, dtype=dtype)
+        self.pos = np.zeros(n, dtype=dtype)
+        self.neg = np.zeros(n, dtype=dtype)
+
+    def add(self, dsign, magnitude, mask):
+        new = mask & (self.first == 0)
+        self.first[new] = np.broadcast_to(dsign, self.first.shape)[new]
+        v = np.where(mask, magnitude * dsign, 0.0)
+        self.value += v
+        self.pos += np.where(v.real > 0, v, 0.0)
+        self.neg -= np.where(v.real < 0, v, 0.0)
+
+
+class _IoEntry(object):
+    """
+    One grouped io flow, column-wise: a FragmentFlow.cutoff() with a direction sign and magnitude in each column where
+    it is present
+    """
+    def __init__(self, flow, dsign, magnitude, present):
+        self.flow = flow
+        self.dsign = dsign
+        self.magnitude = magnitude
+        self.present = present
+
+    @property
+    def value(self):
+        return self.dsign * self.magnitude
+
+    def copy(self):
+        """
+        A copy whose present mask can be consumed (see _ColumnTraversal._take) without altering this entry
+        """
+        return _IoEntry(self.flow, self.dsign, self.magnitude, self.present.copy())
+
+
+class _ColumnTraversal(object):
+    """
+    Traverses a fragment for a list of normalized scenario sets (one per column).  The tree is flattened in
+    traversal order (balance flows last among their siblings); static properties are resolved once per distinct
+    scenario set; and numeric properties are propagated as columns.
+
+    samples, if given, is a dict mapping fragment uuid to a dict of {exchange value key: array of sampled values},
+    indexed by sample number.  Key 0 is the cached exchange value, 1 the observed exchange value, and any other key a
+    scenario name; the key None applies to whichever exchange value is in effect.  columns maps each column to its
+    sample number (by default, column k is sample k).
+
+    memo, shared by a column traversal and all of its subfragment traversals, maps (subfragment uuid, the scenario set
+    of each column[, the sample number of each column]) to the subfragment's grouped inventory and column traversal,
+    so that a subfragment that occurs many times in the tree is traversed once for each distinct set of columns.
+
+    tangents, if given, is a dict mapping fragment uuid to an array of imaginary increments, indexed by sample
+    number, which are added to the exchange value in effect.  The traversal is then computed in complex arithmetic,
+    and the imaginary part of every result is its derivative with respect to the increments (the complex-step method;
+    see sensitivity.py).  All comparisons and sign decisions are made on real parts, so the real part of every result
+    is unaffected.
+    """
+    def __init__(self, fragment, scenario_sets, ancestry=(), passthru_threshold=0.45, samples=None, columns=None,
+                 tangents=None, memo=None):
+        self._fragment = fragment
+        self._ancestry = tuple(ancestry)
+        self._threshold = passthru_threshold
+        self.n = len(scenario_sets)
+        self._samples = samples or dict()
+        self._tangents = tangents or dict()
+        self._dtype = complex if self._tangents else float
+        if columns is None:
+            columns = np.arange(self.n)
+        self._columns = columns
+        if memo is None:
+            memo = dict()
+        self._memo = memo
+
+        self.nodes = []
+        self.parents = []
+        self._flatten()
+
+        # the reference fragment removes one-time normalization scenarios from the scenario set before anything else
+        self._root_keys = []
+        self._sets = []
+        for scens in scenario_sets:
+            try:
+                key = fragment._match_scenario_ev(scens)
+            except ScenarioConflict as e:
+                key = e
+            self._root_keys.append(key)
+            self._sets.append(scens)
+
+        # distinct scenario sets
+        self._unique = []
+        u_index = dict()
+        cols = []
+        for scens, key in zip(self._sets, self._root_keys):
+            uk = (None if scens is None else frozenset(scens), id(key) if isinstance(key, Exception) else key)
+            if uk not in u_index:
+                u_index[uk] = len(self._unique)
+                self._unique.append(len(cols))  # a representative column
+            cols.append(u_index[uk])
+        self._u_cols = np.array(cols, dtype=int)
+
+        self._io = dict()
+        self._resolved = None
+        self._subs = []  # (node index, columns, non-zero mask, subfragment traversal or None, term)
+
+    def _flatten(self):
+        stack = [(self._fragment, -1)]
+        while stack:
+            frag, parent = stack.pop()
+            self.nodes.append(frag)
+            self.parents.append(parent)
+            i = len(self.nodes) - 1
+            children = [c for c in frag.child_flows if not c.is_balance]
+            children.extend(c for c in frag.child_flows if c.is_balance)
+            stack.extend((c, i) for c in reversed(children))
+        n = len(self.nodes)
+        ends = list(range(1, n + 1))
+        for i in range(n - 1, 0, -1):
+            p = self.parents[i]
+            if ends[i] > ends[p]:
+                ends[p] = ends[i]
+        self.ends = ends
+
+    '''
+    Static resolution, once per distinct scenario set
+    '''
+    def _resolve(self):
+        """
+        For each node and each distinct scenario set, resolve: node kind, termination, exchange value (or None if
+        the value is driven), node weight multiplier, conservation factor w.r.t. the parent, balance status, and
+        stock value for conserving foreground nodes.  Errors are stored to be raised if a column reaches the node.
+        :return: a list of per-node dicts of arrays of length U
+        """
+        U = len(self._unique)
+        N = len(self.nodes)
+        kinds = np.full((N, U), NODE_UNREACHED, dtype=int)
+        evs = np.zeros((N, U))
+        driven = np.zeros((N, U), dtype=bool)
+        mults = np.ones((N, U))
+        cfs = np.zeros((N, U))
+        has_cf = np.zeros((N, U), dtype=bool)
+        balance = np.zeros((N, U), dtype=bool)
+        is_null = np.zeros((N, U), dtype=bool)
+        stocks = np.zeros((N, U))
+        conserving = np.zeros((N, U), dtype=bool)
+        terms = [[None] * U for _ in range(N)]
+        errors = [dict() for _ in range(N)]
+        ev_keys = dict()  # (i, u): (matched ev key, stock factor) for sampled nodes
+
+        for u, col in enumerate(self._unique):
+            scens = self._sets[col]
+            for i, frag in enumerate(self.nodes):
+                p = self.parents[i]
+                if p < 0:
+                    parent_kind = None
+                else:
+                    parent_kind = kinds[p, u]
+                    if parent_kind in (NODE_UNREACHED, NODE_CUTOFF) or u in errors[p]:
+                        continue
+                try:
+                    if p < 0:
+                        if frag.reference_entity is None and frag.uuid in self._ancestry:
+                            raise InvalidParentChild('Frag %s seeing self\n %s' % (frag.uuid,
+                                                                                     '; '.join(self._ancestry)))
+                        key = self._root_keys[col]
+                        if isinstance(key, Exception):
+                            raise key
+                        evs[i, u] = frag.exchange_value(key)
+                    elif parent_kind == NODE_SUBFRAGMENT or (frag.is_balance and conserving[p, u]):
+                        driven[i, u] = True
+                        balance[i, u] = parent_kind == NODE_FOREGROUND
+                        key = None
+                    else:
+                        key = frag._match_scenario_ev(scens)
+                        evs[i, u] = frag.exchange_value(key)
+                    if (frag.uuid in self._samples or frag.uuid in self._tangents) and not driven[i, u]:
+                        ev_keys[i, u] = (0 if key is None else key, None)
+                    term = frag.termination(frag._match_scenario_term(scens))
+                    terms[i][u] = term
+                    mults[i, u] = term.node_weight_multiplier
+                    if p >= 0 and conserving[p, u] and not balance[i, u]:
+                        cf = self.nodes[p].conserved_quantity.cf(frag.flow)
+                        if frag.direction == 'Output':
+                            cf *= -1
+                        cfs[i, u] = cf
+                        has_cf[i, u] = True
+                    if term.is_null or term.is_context:
+                        kinds[i, u] = NODE_CUTOFF
+                        is_null[i, u] = term.is_null
+                    elif term.is_fg or term.is_process or not term.valid:
+                        kinds[i, u] = NODE_FOREGROUND
+                        if frag.is_conserved_parent:
+                            conserving[i, u] = True
+                            if term.is_fg or not term.valid:
+                                if frag.reference_entity is None:
+                                    stock = frag.exchange_value(frag._match_scenario_ev(scens))
+                                else:
+                                    stock = 1.0
+                            else:
+                                stock = term.inbound_exchange_value
+                            stock *= frag.balance_magnitude
+                            if frag.direction == 'Input':
+                                stock *= -1
+                            stocks[i, u] = stock
+                            if (i, u) in ev_keys and frag.reference_entity is None and (term.is_fg or not term.valid):
+                                # the stock is proportional to the sampled reference exchange value
+                                factor = frag.balance_magnitude
+                                if frag.direction == 'Input':
+                                    factor *= -1
+                                ev_keys[i, u] = (ev_keys[i, u][0], factor)
+                    else:
+                        kinds[i, u] = NODE_SUBFRAGMENT
+                except (ScenarioConflict, InvalidParentChild, FlowConversionError, MissingFlow) as e:
+                    errors[i][u] = e
+
+        g = self._u_cols  # gather distinct sets into columns
+        r = {
+            'kinds': kinds[:, g],
+            'evs': evs[:, g],
+            'driven': driven[:, g],
+            'mults': mults[:, g],
+            'cfs': cfs[:, g],
+            'has_cf': has_cf[:, g],
+            'balance': balance[:, g],
+            'is_null': is_null[:, g],
+            'stocks': stocks[:, g],
+            'conserving': conserving[:, g],
+            'terms': terms,
+            'errors': errors
+        }
+        if ev_keys:
+            self._apply_samples(r, ev_keys)
+        return r
+
+    def _apply_samples(self, r, ev_keys):
+        """
+        Replace the resolved exchange values of sampled nodes with their samples, column by column, and add
+        tangents.  Samples under key None take precedence over samples for the matched exchange value.
+        """
+        r['evs'] = r['evs'].astype(self._dtype)
+        r['stocks'] = r['stocks'].astype(self._dtype)
+        for (i, u), (key, factor) in ev_keys.items():
+            uuid = self.nodes[i].uuid
+            cols = np.flatnonzero(self._u_cols == u)
+            draws = self._samples.get(uuid, dict())
+            x = draws.get(None)
+            if x is None:
+                x = draws.get(key)
+            if x is not None:
+                r['evs'][i, cols] = x[self._columns[cols]]
+            if uuid in self._tangents:
+                r['evs'][i, cols] += self._tangents[uuid][self._columns[cols]]
+            if factor is not None:
+                r['stocks'][i, cols] = r['evs'][i, cols] * factor
+
+    '''
+    Column-wise propagation
+    '''
+    def run(self, tm=None):
+        """
+        Propagate node weights for all columns.
+        :param tm: a TraversalMatrix to populate (optional)
+        :return: magnitudes, node_weights, live: N x S arrays
+        """
+        r = self._resolve()
+        self._resolved = r
+        S = self.n
+        N = len(self.nodes)
+        kinds = r['kinds']
+        is_ref = np.array([f.reference_entity is None for f in self.nodes])
+
+        dt = self._dtype
+        mags = np.zeros((N, S), dtype=dt)
+        nws = np.zeros((N, S), dtype=dt)
+        live = np.zeros((N, S), dtype=bool)
+        cont = np.zeros((N, S), dtype=bool)  # whether traversal continues to the node's children
+        downstream = np.zeros((N, S), dtype=dt)
+        driven_evs = np.zeros((N, S), dtype=dt)
+        skip = np.zeros((N, S), dtype=bool)
+        stock = np.zeros((N, S), dtype=dt)
+        stock_in = np.zeros((N, S), dtype=dt)
+        stock_out = np.zeros((N, S), dtype=dt)
+
+        closing = []  # (end, list of _IoEntry scaled to the parent's traversal, sub-node mask)
+
+        for i, frag in enumerate(self.nodes):
+            while closing and closing[-1][0] <= i:
+                self._add_entries(closing.pop()[1])
+
+            p = self.parents[i]
+            if p < 0:
+                here = np.ones(S, dtype=bool)
+                upstream = np.ones(S)
+            else:
+                here = cont[p] & ~skip[i]
+                upstream = downstream[p]
+            if not here.any():
+                continue
+
+            for u, e in r['errors'][i].items():
+                if (here & (self._u_cols == u)).any():
+                    raise e
+
+            live[i] = here
+
+            bal = r['balance'][i] & here
+            if bal.any():
+                s = stock[p]
+                smax = np.maximum(np.abs(stock_in[p].real), np.abs(stock_out[p].real))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    quash = (s.real != 0) & (np.abs(s.real) / smax < 1e-10)
+                s = np.where(quash, s - s.real, s)
+                if frag.direction == 'Input':
+                    s = -s
+                driven_evs[i] = np.where(bal, s, driven_evs[i])
+
+            ev = np.where(r['driven'][i], driven_evs[i], r['evs'][i])
+            mag = np.where(here, upstream * ev, 0.0)
+            if is_ref[i]:
+                nw = np.where(mag == 0, 0.0, upstream)
+            else:
+                nw = mag
+            nw = np.where(here, nw * r['mults'][i], 0.0)
+
+            hc = r['has_cf'][i] & here
+            if hc.any():
+                cv = np.where(hc, ev * r['cfs'][i], 0.0)
+                stock[p] += cv
+                stock_in[p] += np.where(cv.real > 0, cv, 0.0)
+                stock_out[p] -= np.where(cv.real < 0, cv, 0.0)
+
+            nl = r['is_null'][i] & here
+            if nl.any():
+                self._acc(frag.flow).add(_dir_sign(frag.direction), mag, nl)
+
+            mags[i] = mag
+            nws[i] = nw
+
+            active = here & (mag != 0)
+            fg = active & (kinds[i] == NODE_FOREGROUND)
+            if fg.any():
+                cont[i] = fg
+                downstream[i] = np.where(fg, nw, 0.0)
+                cs = r['conserving'][i] & fg
+                if cs.any():
+                    s = np.where(cs, r['stocks'][i], 0.0)
+                    stock[i] = s
+                    stock_in[i] = np.where(s.real > 0, s, 0.0)
+                    stock_out[i] = np.where(s.real < 0, -s, 0.0)
+
+            sub = active & (kinds[i] == NODE_SUBFRAGMENT)
+            if sub.any():
+                remainder = self._traverse_subfragments(i, sub, nws, r['terms'][i], cont, downstream, driven_evs,
+                                                        skip)
+                closing.append((self.ends[i], remainder))
+
+        while closing:
+            self._add_entries(closing.pop()[1])
+
+        if tm is not None:
+            tm.fragments = list(self.nodes)
+            tm._index = {f.uuid: j for j, f in enumerate(self.nodes)}
+            tm.magnitudes = mags.T.copy()
+            tm.node_weights = nws.T.copy()
+            tm.reached = live.T.copy()
+        self.magnitudes = mags
+        self.node_weights = nws
+        self.live = live
+        return mags, nws, live
+
+    def _acc(self, flow):
+        if flow not in self._io:
+            self._io[flow] = _IoAccumulator(self.n, dtype=self._dtype)
+        return self._io[flow]
+
+    def _add_entries(self, entries):
+        for e in entries:
+            if e.present.any():
+                self._acc(e.flow).add(e.dsign, e.magnitude, e.present)
+
+    def _traverse_subfragments(self, i, sub, nws, terms, cont, downstream, driven_evs, skip):
+        """
+        Subfragment normalization, column-wise.  Columns are grouped by subfragment; each group's inventory is
+        computed by a column traversal of the subfragment over the group's scenario sets.
+        :return: a list of _IoEntry of the unmatched inventory flows, scaled by the downstream node weight
+        """
+        frag = self.nodes[i]
+        groups = dict()
+        for s in np.flatnonzero(sub):
+            term = terms[self._u_cols[s]]
+            node = term.term_node
+            if isinstance(node, LcFragment):
+                k = (node.top().uuid, term.term_flow)
+            else:
+                k = (s, )  # remote subfragments: no grouping
+            groups.setdefault(k, (term, []))[1].append(s)
+
+        remainder = []
+        for term, cols in groups.values():
+            cols = np.array(cols, dtype=int)
+            entries, sub_traversal = self._subfragment_inventory(term, cols)
+
+            # match the term flow
+            in_ex, found = self._take(entries, term.term_flow, len(cols), dtype=self._dtype)
+            if not found.all():
+                raise MissingFlow('Term flow: %s' % term.term_flow.link)
+            if frag.direction == 'Output':
+                in_ex = -in_ex
+            ok = in_ex != 0
+            self._subs.append((i, cols, ok, sub_traversal, term))
+            for s in cols[~ok]:
+                print('Frag %.5s: Zero inbound exchange' % frag.uuid)
+                if tracer.enabled:
+                    tracer.event(frag, 'zero_inbound', column=int(s))
+            with np.errstate(divide='ignore'):
+                dnw = np.where(ok, nws[i, cols] / np.where(ok, in_ex, 1.0), 0.0)
+            nws[i, cols[ok]] = dnw[ok]
+            okc = cols[ok]
+            cont[i, okc] = True
+            downstream[i, okc] = dnw[ok]
+
+            # drive the children
+            for c, child in self._children(i):
+                v, found = self._take(entries, child.flow, len(cols), mask=ok, dtype=self._dtype)
+                if child.direction != 'Output':
+                    v = -v
+                driven_evs[c, cols] = np.where(found, v, driven_evs[c, cols])
+                skip[c, cols] = ~found
+
+            # scale the rest
+            for e in entries:
+                present = np.zeros(self.n, dtype=bool)
+                present[okc] = e.present[ok]
+                if not present.any():
+                    continue
+                dsign = np.zeros(self.n, dtype=int)
+                dsign[cols] = e.dsign
+                mag = np.zeros(self.n, dtype=self._dtype)
+                mag[okc] = e.magnitude[ok] * dnw[ok]
+                remainder.append(_IoEntry(e.flow, dsign, mag, present))
+        return remainder
+
+    def _children(self, i):
+        return [(c, self.nodes[c]) for c in range(i + 1, self.ends[i]) if self.parents[c] == i]
+
+    @staticmethod
+    def _take(entries, flow, n, mask=None, dtype=float):
+        """
+        Take the first present entry for the flow in each column, as list.remove(next(...)) does in a live traversal
+        :return: value, found mask
+        """
+        val = np.zeros(n, dtype=dtype)
+        found = np.zeros(n, dtype=bool)
+        for e in entries:
+            if e.flow != flow:
+                continue
+            t = e.present & ~found
+            if mask is not None:
+                t &= mask
+            val[t] = e.value[t]
+            e.present[t] = False
+            found |= t
+        return val, found
+
+    def _subfragment_inventory(self, term, cols):
+        """
+        :param term: a subfragment termination
+        :param cols: column indices
+        :return: list of _IoEntry over the given columns, in the order group_ios would generate them; and the
+         subfragment's column traversal (None for remote subfragments)
+        """
+        node = term.term_node
+        if not isinstance(node, LcFragment):
+            # remote subfragment: one column only
+            s = cols[0]
+            ios, _ = node.unit_inventory(scenario=self._sets[s])
+            return [_IoEntry(x.fragment.flow, np.array([_dir_sign(x.fragment.direction)]), np.array([x.magnitude]),
+                             np.array([True])) for x in ios], None
+        top = node.top()
+        if self._fragment.reference_entity is None:
+            ancestry = self._ancestry + (self._fragment.uuid, )
+        else:
+            ancestry = self._ancestry
+        sets = [None if self._sets[s] is None else ScenarioSet(self._sets[s]) for s in cols]
+        key = (top.uuid, tuple(None if k is None else frozenset(k) for k in sets))
+        if self._samples or self._tangents:
+            key += (tuple(self._columns[cols]), )
+        if key not in self._memo:
+            sub = _ColumnTraversal(top, sets, ancestry=ancestry, passthru_threshold=self._threshold,
+                                   samples=self._samples, columns=self._columns[cols], tangents=self._tangents,
+                                   memo=self._memo)
+            sub.run()
+            self._memo[key] = (sub.grouped_ios(), sub)
+        entries, sub = self._memo[key]
+        return [e.copy() for e in entries], sub
+
+    def grouped_ios(self):
+        """
+        Column-wise group_ios of the completed traversal
+        :return: list of _IoEntry
+        """
+        n = self.n
+        ref = self._fragment.top()
+        ref_mag = self.magnitudes[0]
+        ref_sign = _dir_sign(ref.direction)
+        thresh = self._threshold
+
+        entries = []
+        if ref.flow in self._io:
+            acc = self._io[ref.flow]
+            seen = acc.first != 0
+            s0 = acc.first
+            val = s0 * acc.value
+            pos = np.where(s0 > 0, acc.pos, acc.neg)
+            neg = np.where(s0 > 0, acc.neg, acc.pos)
+            auto_sign = np.where(val.real < 0, -s0, s0)
+            if (seen & (auto_sign != ref_sign)).any():
+                raise CumulatingFlows('%s' % self._fragment)
+            auto = seen & (np.abs(val.real) < thresh * ref_mag.real)
+            if auto.any():
+                val = np.where(auto, val + np.where(auto_sign > 0, ref_mag, -ref_mag), val)
+                pos = np.where(auto & (ref_mag.real > 0), pos + ref_mag, pos)
+                neg = np.where(auto & (ref_mag.real < 0), neg - ref_mag, neg)
+            # translate back to absolute sign convention
+            acc.value = s0 * val
+            acc.pos = np.where(s0 > 0, pos, neg)
+            acc.neg = np.where(s0 > 0, neg, pos)
+            entries.append(_IoEntry(ref.flow, np.where(seen, -auto_sign, -ref_sign), ref_mag, ~seen | ~auto))
+        else:
+            entries.append(_IoEntry(ref.flow, np.full(n, -ref_sign), ref_mag, np.ones(n, dtype=bool)))
+
+        for flow, acc in self._io.items():
+            seen = acc.first != 0
+            s0 = acc.first
+            val = s0 * acc.value
+            abs_mag = np.maximum(acc.pos.real, acc.neg.real)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                quash = (val.real != 0) & (abs_mag != 0) & (np.abs(val.real) / abs_mag < 1e-12)
+            val = np.where(quash, val - val.real, val)
+            entries.append(_IoEntry(flow, np.where(val.real < 0, -s0, s0), _magnitude(val), seen))
+        return entries
+
+    '''
+    Column-wise LCIA
+    '''
+    def lcia(self, quantities, scored=None, **kwargs):
+        """
+        Column-wise frag_flow_lcia of the completed traversal.  Unit scores of process and context terminations are
+        looked up once per node and distinct scenario set; local subfragments are scored from their own column
+        traversals, and remote subfragments column by column.  Unresolved anchors score zero.
+        :param quantities: a list of quantity refs
+        :param scored: [None] dict of subfragment column traversal to its scores, shared with the subfragment
+         traversals, so that a column traversal reused from the memo is scored once
+        :param kwargs: passed to score_cache()
+        :return: quantities x columns array of total scores
+        """
+        if self._resolved is None:
+            raise ValueError('Column traversal has not been run')
+        if scored is None:
+            scored = dict()
+        r = self._resolved
+        scores = np.zeros((len(quantities), self.n), dtype=self._dtype)
+        for i, frag in enumerate(self.nodes):
+            nw = np.where(self.live[i], self.node_weights[i], 0.0)
+            for u, term in enumerate(r['terms'][i]):
+                if term is None or term.is_null or term.is_subfrag or r['kinds'][i, u] == NODE_UNREACHED:
+                    continue
+                cols = self._u_cols == u
+                if not (nw[cols] != 0).any():
+                    continue
+                sense = -1.0 if term.direction == frag.direction else 1.0
+                for k, q in enumerate(quantities):
+                    scores[k, cols] += sense * nw[cols] * self._unit_score(term, q, kwargs)
+
+        for i, cols, ok, sub, term in self._subs:
+            frag = self.nodes[i]
+            sense = -1.0 if term.direction == frag.direction else 1.0
+            nw = self.node_weights[i, cols[ok]]
+            if sub is not None:
+                if sub not in scored:
+                    scored[sub] = sub.lcia(quantities, scored=scored, **kwargs)
+                scores[:, cols[ok]] += sense * nw * scored[sub][:, ok]
+                continue
+            for s in cols[ok]:
+                for k, q in enumerate(quantities):
+                    try:
+                        v = term.score_cache(quantity=q, **kwargs).total()
+                    except UnCachedScore:
+                        v = term.term_node.fragment_lcia(q, scenario=self._sets[s]).total()
+                    scores[k, s] += sense * self.node_weights[i, s] * v
+        return scores
+
+    @staticmethod
+    def _unit_score(term, quantity, kwargs):
+        try:
+            return term.score_cache(quantity=quantity, **kwargs).total()
+        except UnresolvedAnchor:
+            return 0.0
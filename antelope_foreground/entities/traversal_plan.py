@@ -0,0 +1,623 @@
+"""
+Compiled traversal plans.
+
+LcFragment.traverse() walks the fragment tree afresh on every call: each node re-matches the scenario set, looks up
+its termination, recomputes flow conversions and conserved-quantity characterizations, and regenerates its list of
+child flows.  None of that changes from one traversal to the next unless the model itself is edited.
+
+A TraversalPlan does that work once.  The fragment is flattened into a linear sequence of nodes in traversal order,
+and the static properties of each node (parent index, termination kind, node weight multiplier, matched scenarios,
+conservation factors) are stored in flat lists indexed by position.  TraversalPlan.execute() then replays the
+traversal as a single loop over those lists and returns the same list of FragmentFlows that traverse() would.
+Subfragments are compiled into their own plans, which are shared among all the nodes that terminate to them.
+
+Exchange values are read from the fragments at execution time, so observations made after a plan is compiled are
+honored.  Structural changes to the model-- adding or removing child flows, re-terminating fragments, setting
+balance flows, or adding scenario-specific exchange values or terminations-- require the plan to be recompiled.
+
+Errors that a live traversal would only encounter upon reaching a node (scenario conflicts, recursive subfragment
+loops, flow conversion failures) are recorded during compilation and raised when the plan execution reaches the node,
+so that a plan fails in exactly the circumstances in which traverse() fails.
+
+An IncrementalTraversal uses fragment revision counters to keep a traversal result current as the model is edited,
+recomputing only the parts of the plan affected by each change.
+"""
+
+from .fragments import (LcFragment, InvalidParentChild, ScenarioConflict, ZeroInboundExchange, ScenarioSet,
+                        _match_subfragment_inventory, copy_ios, memo_unit_inventory)
+from ..fragment_flows import FragmentFlow, group_ios
+from ..terminations import FlowConversionError, MissingFlow
+from ..tracing import tracer
+
+
+NODE_CUTOFF = 0  # null or context termination: traversal ends
+NODE_FOREGROUND = 1  # foreground node, process, or invalid anchor: traversal continues to child flows
+NODE_SUBFRAGMENT = 2  # subfragment: child flow exchange values are determined by the subfragment inventory
+
+
+class _Driven(object):
+    """
+    Marker for nodes whose exchange values are determined during traversal (balance flows and children of
+    subfragment nodes)
+    """
+    def __repr__(self):
+        return 'DRIVEN'
+
+
+DRIVEN = _Driven()
+
+
+def traversal_scenarios(scenario=None, observed=False):
+    """
+    Normalize a scenario specification into the scenario set used during traversal, exactly as
+    LcFragment.traverse() does.
+    :param scenario: None, a scenario name, or a set, tuple, or list of scenario names
+    :param observed: used only if scenario is None
+    :return: a new ScenarioSet, or None
+    """
+    if isinstance(scenario, set) or isinstance(scenario, tuple) or isinstance(scenario, list):
+        return ScenarioSet(scenario)
+    elif scenario is None:
+        if observed:
+            return ScenarioSet([1])
+        return None
+    return ScenarioSet([scenario])
+
+
+class TraversalPlan(object):
+    """
+    A fragment traversal, flattened into a sequence of nodes for a fixed scenario specification.
+
+    Per-node arrays (all indexed by position in traversal order):
+     fragments: the LcFragment at each node
+     parents: index of the node's parent in the plan, or -1 for the root
+     kinds: NODE_CUTOFF, NODE_FOREGROUND, or NODE_SUBFRAGMENT
+     terms: the FlowTermination matched for the scenario
+     ev_keys: the matched exchange value key, or DRIVEN if the exchange value is determined during traversal
+     match_terms: the matched termination key
+     multipliers: the termination's node weight multiplier
+     ends: one past the index of the last node in the node's subtree
+    """
+    @classmethod
+    def compile(cls, fragment, scenario=None, observed=False):
+        """
+        Compile a traversal plan for the given fragment.  Arguments have the same meaning as for
+        LcFragment.traverse().
+        :param fragment:
+        :param scenario:
+        :param observed:
+        :return: a TraversalPlan
+        """
+        return cls(fragment, traversal_scenarios(scenario, observed=observed))
+
+    def __init__(self, fragment, scenarios, _ancestry=(), _subplans=None):
+        """
+        Use TraversalPlan.compile() to build a plan from user-facing scenario specifications.
+
+        :param fragment: the fragment to traverse
+        :param scenarios: a scenario set as constructed by traversal_scenarios() (note: one-time normalization
+         scenarios are removed from the set during compilation, as in a live traversal)
+        :param _ancestry: uuids of reference fragments whose plans enclose this one, to catch recursive loops
+        :param _subplans: a dict of subfragment plans to share among all plans in a compilation
+        """
+        self._fragment = fragment
+        self._scenarios = scenarios
+        self._ancestry = tuple(_ancestry)
+        if _subplans is None:
+            _subplans = dict()
+        self._subplan_cache = _subplans
+
+        self.fragments = []
+        self.parents = []
+        self.kinds = []
+        self.terms = []
+        self.ev_keys = []
+        self.match_terms = []
+        self.multipliers = []
+        self.ends = []
+
+        self._is_ref = []
+        self._conserved = []  # static conserved flag, or None if determined by conserved value
+        self._cons_cfs = []  # signed conservation factor w.r.t. parent's conserved quantity, or None
+        self._stock_keys = []  # for conserving reference fg nodes: 1-tuple of the ev key for the inbound stock
+        self._stock_factors = []  # for conserving fg nodes: balance magnitude x sign x constant stock
+        self._balance_of = []  # for balance flows of conserving parents: index of the parent, else -1
+        self._children = []
+        self._subplans = []
+        self._errors = []
+
+        self._compile()
+
+    def __len__(self):
+        return len(self.fragments)
+
+    @property
+    def fragment(self):
+        return self._fragment
+
+    @property
+    def scenarios(self):
+        if self._scenarios is None:
+            return None
+        return ScenarioSet(self._scenarios)
+
+    '''
+    Compilation
+    '''
+    def _new_node(self, frag, parent):
+        self.fragments.append(frag)
+        self.parents.append(parent)
+        self.kinds.append(NODE_CUTOFF)
+        self.terms.append(None)
+        self.ev_keys.append(DRIVEN)
+        self.match_terms.append(None)
+        self.multipliers.append(1.0)
+        self.ends.append(None)
+        self._is_ref.append(frag.reference_entity is None)
+        self._conserved.append(None)
+        self._cons_cfs.append(None)
+        self._stock_keys.append(None)
+        self._stock_factors.append(None)
+        self._balance_of.append(-1)
+        self._children.append([])
+        self._subplans.append(None)
+        self._errors.append(None)
+        if parent >= 0:
+            self._children[parent].append(len(self.fragments) - 1)
+        return len(self.fragments) - 1
+
+    def _compile(self):
+        """
+        Flatten the fragment tree in traversal order, using an explicit stack.  Each stack entry is
+        (fragment, parent index, driven, conserved_qty, balance_parent)
+        """
+        scenarios = self._scenarios
+        stack = [(self._fragment, -1, False, None, -1)]
+        while stack:
+            frag, parent, driven, conserved_qty, balance_parent = stack.pop()
+            i = self._new_node(frag, parent)
+            self._balance_of[i] = balance_parent
+            try:
+                children = self._compile_node(i, frag, scenarios, driven, conserved_qty, balance_parent)
+            except (ScenarioConflict, InvalidParentChild, FlowConversionError, MissingFlow) as e:
+                # this node fails when reached, and nothing beyond it can be reached
+                self._errors[i] = e
+                continue
+            # push in reverse so that children pop off in traversal order
+            stack.extend(reversed(children))
+
+        # compute subtree extents: children always come after their parents
+        n = len(self.fragments)
+        ends = list(range(1, n + 1))
+        for i in range(n - 1, 0, -1):
+            p = self.parents[i]
+            if ends[i] > ends[p]:
+                ends[p] = ends[i]
+        self.ends = ends
+
+    def _compile_node(self, i, frag, scenarios, driven, conserved_qty, balance_parent):
+        """
+        Resolve the static properties of a node, in the same sequence as LcFragment._node_flow(), and return the
+        stack entries for its children
+        """
+        if self._is_ref[i] and i == 0 and frag.uuid in self._ancestry:
+            raise InvalidParentChild('Frag %s seeing self\n %s' % (frag.uuid, '; '.join(self._ancestry)))
+
+        if not driven:
+            self.ev_keys[i] = frag._match_scenario_ev(scenarios)  # may remove one-time normalization scenarios
+        match_term = frag._match_scenario_term(scenarios)
+        term = frag.termination(match_term)
+        self.match_terms[i] = match_term
+        self.terms[i] = term
+        self.multipliers[i] = term.node_weight_multiplier
+
+        if conserved_qty is not None:
+            cf = conserved_qty.cf(frag.flow)
+            if frag.direction == 'Output':  # convention: inputs to parent are positive
+                cf *= -1
+            self._cons_cfs[i] = cf
+        elif balance_parent >= 0 or frag.is_balance:
+            self._conserved[i] = True
+        else:
+            self._conserved[i] = frag.conserved
+
+        if term.is_null or term.is_context:
+            self.kinds[i] = NODE_CUTOFF
+            return []
+
+        if term.is_fg or term.is_process or not term.valid:
+            self.kinds[i] = NODE_FOREGROUND
+            return self._compile_fg_children(i, frag, term, scenarios)
+
+        self.kinds[i] = NODE_SUBFRAGMENT
+        self._compile_subplan(i, term, scenarios)
+        return [(c, i, True, None, -1) for c in frag.child_flows]
+
+    def _compile_fg_children(self, i, frag, term, scenarios):
+        if not frag.is_conserved_parent:
+            return [(c, i, False, None, -1) for c in frag.child_flows]
+
+        if term.is_fg or not term.valid:
+            if frag.reference_entity is None:
+                # inbound exchange value is read at execution time
+                self._stock_keys[i] = (frag._match_scenario_ev(scenarios), )
+            stock = 1.0
+        else:
+            stock = term.inbound_exchange_value
+        stock *= frag.balance_magnitude
+        if frag.direction == 'Input':
+            stock *= -1
+        self._stock_factors[i] = stock
+
+        cq = frag.conserved_quantity
+        children = []
+        bal = None
+        for c in frag.child_flows:
+            if c.is_balance:
+                bal = c
+            else:
+                children.append((c, i, False, cq, -1))
+        if bal is not None:
+            children.append((bal, i, True, None, i))
+        return children
+
+    def _compile_subplan(self, i, term, scenarios):
+        node = term.term_node
+        if not isinstance(node, LcFragment):
+            return  # remote fragments are traversed live
+
+        top = node.top()
+        if self._is_ref[0]:
+            ancestry = self._ancestry + (self._fragment.uuid, )
+        else:
+            ancestry = self._ancestry
+        if scenarios is None:
+            sub_scenarios = None
+            key = (top.uuid, None)
+        else:
+            sub_scenarios = ScenarioSet(scenarios)
+            key = (top.uuid, frozenset(sub_scenarios))
+
+        if key in self._subplan_cache and top.uuid not in ancestry:
+            self._subplans[i] = self._subplan_cache[key]
+        else:
+            sub = TraversalPlan(top, sub_scenarios, _ancestry=ancestry, _subplans=self._subplan_cache)
+            if top.uuid not in ancestry:
+                self._subplan_cache[key] = sub
+            self._subplans[i] = sub
+
+    '''
+    Execution
+    '''
+    def execute(self, memo=None):
+        """
+        Replay the traversal.
+        :param memo: [None] a dict for memoizing subfragment unit inventories, as in LcFragment.traverse().  If None,
+         a new memo is used for each execution.
+        :return: a list of FragmentFlows identical to the output of LcFragment.traverse()
+        """
+        ffs, _ = self._execute(memo, None)
+        return ffs
+
+    def patch(self, state=None, memo=None):
+        """
+        Replay the traversal, reusing the results of a prior execution wherever they are still valid.  A node's
+        subtree is reused if the node's fragment revision and exchange value are unchanged since the prior execution;
+        if its upstream node weight has changed, the reused subtree is rescaled.  All other nodes are recomputed.
+
+        Changes to remote subfragments (FragmentRefs) are not tracked.
+
+        :param state: the state returned by a prior call to patch(), or None to execute in full
+        :param memo: as in execute()
+        :return: ffs, state
+        """
+        if state is None:
+            state = _PlanState(len(self.fragments))
+        return self._execute(memo, state)
+
+    def _execute(self, memo, state):
+        if memo is None:
+            memo = dict()
+        if self._scenarios is None:
+            scenarios = None
+        else:
+            scenarios = ScenarioSet(self._scenarios)
+
+        n = len(self.fragments)
+        fragments = self.fragments
+        parents = self.parents
+        kinds = self.kinds
+        terms = self.terms
+        ev_keys = self.ev_keys
+        match_terms = self.match_terms
+        multipliers = self.multipliers
+        ends = self.ends
+
+        downstream = [0.0] * n  # node weight passed to child flows
+        driven = [None] * n  # exchange values determined during traversal
+        skip = [False] * n  # children of subfragments with no matching inventory flow
+        stock = [0.0] * n
+        stock_in = [0.0] * n
+        stock_out = [0.0] * n
+
+        out = _PlanState(n)  # per-node results
+
+        i = 0
+        while i < n:
+            if skip[i]:
+                i = ends[i]
+                continue
+            if self._errors[i] is not None:
+                raise self._errors[i]
+
+            frag = fragments[i]
+            p = parents[i]
+            if p < 0:
+                upstream_nw = 1.0
+            else:
+                upstream_nw = downstream[p]
+
+            b = self._balance_of[i]
+            if b >= 0:
+                driven[i] = self._balance_value(b, frag, stock, stock_in, stock_out)
+
+            key = ev_keys[i]
+            if key is DRIVEN:
+                ev = driven[i]
+                match_ev = None
+            else:
+                ev = frag.exchange_value(key)
+                match_ev = key
+
+            cf = self._cons_cfs[i]
+            if cf is not None:
+                conserved_val = ev * cf
+                stock[p] += conserved_val
+                if conserved_val > 0:
+                    stock_in[p] += conserved_val
+                else:
+                    stock_out[p] -= conserved_val
+
+            if state is not None and state.reuse(out, i, ends[i], frag, upstream_nw, ev):
+                i = ends[i]
+                continue
+            out.record(i, frag, upstream_nw, ev)
+
+            magnitude = upstream_nw * ev
+            if self._is_ref[i]:
+                node_weight = upstream_nw
+                if magnitude == 0:
+                    node_weight = 0
+            else:
+                node_weight = magnitude
+            node_weight *= multipliers[i]
+
+            if cf is None:
+                conserved = self._conserved[i]
+            else:
+                conserved = conserved_val != 0
+
+            ff = FragmentFlow(frag, magnitude, node_weight, terms[i], conserved, match_ev=match_ev,
+                              match_term=match_terms[i])
+            out.ffs[i] = ff
+
+            kind = kinds[i]
+            if magnitude == 0 or kind == NODE_CUTOFF:
+                i = ends[i]
+                continue
+
+            if kind == NODE_FOREGROUND:
+                downstream[i] = node_weight
+                factor = self._stock_factors[i]
+                if factor is not None:
+                    self._init_stock(i, frag, factor, stock, stock_in, stock_out)
+                i += 1
+                continue
+
+            # subfragment
+            try:
+                _, unit_inv, downstream_nw = self._traverse_subfragment(i, ff, scenarios, memo)
+            except ZeroInboundExchange:
+                if tracer.enabled:
+                    tracer.event(frag, 'zero_inbound')
+                i = ends[i]
+                continue
+            downstream[i] = downstream_nw
+            for c in self._children[i]:
+                f = fragments[c]
+                try:
+                    m = next(j for j in unit_inv if j.fragment.flow == f.flow)
+                except StopIteration:
+                    skip[c] = True
+                    continue
+                if m.fragment.direction == f.direction:
+                    driven[c] = m.magnitude
+                else:
+                    driven[c] = -m.magnitude
+                unit_inv.remove(m)
+            for x in unit_inv:
+                x.scale(downstream_nw)
+            out.rems[i] = unit_inv
+            i += 1
+
+        return out.assemble(ends), out
+
+    def _init_stock(self, i, frag, factor, stock, stock_in, stock_out):
+        key = self._stock_keys[i]
+        if key is None:
+            s = factor
+        else:
+            s = frag.exchange_value(key[0]) * factor
+        stock[i] = s
+        if s > 0:
+            stock_in[i] = s
+            stock_out[i] = 0.0
+        else:
+            stock_in[i] = 0.0
+            stock_out[i] = -s
+
+    @staticmethod
+    def _balance_value(p, bal_f, stock, stock_in, stock_out):
+        s = stock[p]
+        stock_max = max([abs(stock_in[p]), abs(stock_out[p])])
+        if s != 0 and (abs(s) / stock_max < 1e-10):
+            s = 0.0
+        if bal_f.direction == 'Input':
+            s *= -1
+        return s
+
+    def _traverse_subfragment(self, i, ff, scenarios, memo):
+        sub = self._subplans[i]
+        term = ff.term
+        if sub is None:
+            # remote subfragment: no plan, so traverse live
+            unit_inv, subfrags = memo_unit_inventory(term.term_node, scenarios, None, memo)
+        else:
+            # subplans are shared among all nodes with the same subfragment and scenario set
+            key = (id(sub), term.term_node.link)
+            if key not in memo:
+                memo[key] = group_ios(term.term_node, sub.execute(memo=memo))
+            ios, internal = memo[key]
+            unit_inv, subfrags = copy_ios(ios), list(internal)
+        return _match_subfragment_inventory(ff, unit_inv, subfrags, scenarios)
+
+    def show(self):
+        """
+        Print the plan, one node per line
+        """
+        codes = {NODE_CUTOFF: 'cut', NODE_FOREGROUND: 'fg ', NODE_SUBFRAGMENT: 'sub'}
+        for i, frag in enumerate(self.fragments):
+            if self._errors[i] is not None:
+                print('%4d %4d  ERR %s' % (i, self.parents[i], self._errors[i]))
+                continue
+            print('%4d %4d  %s %-8.8s %8.4g %s' % (i, self.parents[i], codes[self.kinds[i]], self.ev_keys[i],
+                                                   self.multipliers[i], frag))
+
+
+class IncrementalTraversal(object):
+    """
+    Keeps the traversal of a fragment under a fixed scenario specification up to date as the model is edited.
+
+    Fragments record their modifications in revision counters that propagate up the parent chain and into every
+    fragment that uses them as a subfragment (see LcFragment.revision).  traverse() returns the prior result
+    unchanged if the fragment's revision has not advanced; recompiles the plan if the structure of the model has
+    changed; and otherwise patches the prior result, recomputing only the subtrees that were affected by the change
+    and rescaling the node weights of unaffected subtrees downstream of it.
+    """
+    def __init__(self, fragment, scenario=None, observed=False):
+        self._fragment = fragment
+        self._scenario = scenario
+        self._observed = observed
+        self._plan = None
+        self._structure = None
+        self._state = None
+        self._revision = None
+        self._ffs = None
+
+    @property
+    def fragment(self):
+        return self._fragment
+
+    @property
+    def plan(self):
+        return self._plan
+
+    @property
+    def is_dirty(self):
+        return self._ffs is None or self._fragment.revision != self._revision
+
+    def traverse(self):
+        """
+        :return: a list of FragmentFlows equivalent to the output of LcFragment.traverse()
+        """
+        frag = self._fragment
+        revision = frag.revision
+        structure = frag.structure_revision
+        if self._plan is None or structure != self._structure:
+            self._plan = TraversalPlan.compile(frag, self._scenario, observed=self._observed)
+            self._structure = structure
+            self._state = None
+        elif not self.is_dirty:
+            return list(self._ffs)
+
+        state, self._state = self._state, None  # discard state if the traversal fails
+        self._ffs, self._state = self._plan.patch(state)
+        self._revision = revision
+        return list(self._ffs)
+
+
+def _scaled_ff(ff, factor):
+    """
+    A copy of a FragmentFlow with magnitude and node weight scaled
+    """
+    if factor == 1.0:
+        return ff
+    x = FragmentFlow(ff.fragment, ff.magnitude * factor, ff.node_weight * factor, ff.term, ff.is_conserved,
+                     match_ev=ff.match_scenarios[0], match_term=ff.match_scenarios[1])
+    if ff.term.is_subfrag:
+        x.aggregate_subfragments(ff.subfragments, scenarios=ff.subfragment_scenarios)
+    return x
+
+
+class _PlanState(object):
+    """
+    The per-node results of a plan execution, indexed by position in the plan: the FragmentFlow generated at the
+    node (or None if the node was not reached), unmatched subfragment io flows emitted at the end of the node's
+    subtree, and the inputs that determined them (upstream node weight, exchange value, and fragment revision).
+    """
+    def __init__(self, n):
+        self.ffs = [None] * n
+        self.rems = [None] * n
+        self.ups = [None] * n
+        self.evs = [None] * n
+        self.revs = [None] * n
+
+    def record(self, i, frag, upstream_nw, ev):
+        self.ups[i] = upstream_nw
+        self.evs[i] = ev
+        self.revs[i] = frag.revision
+
+    def reuse(self, out, i, end, frag, upstream_nw, ev):
+        """
+        Copy the results for the subtree at i into out, if they are still valid
+        :return: True if reused
+        """
+        if self.ffs[i] is None or self.revs[i] != frag.revision or self.evs[i] != ev:
+            return False
+        prior = self.ups[i]
+        if upstream_nw == prior:
+            factor = 1.0
+        elif prior == 0 or upstream_nw == 0:
+            return False
+        else:
+            factor = upstream_nw / prior
+        for j in range(i, end):
+            ff = self.ffs[j]
+            if ff is None:
+                continue
+            out.ffs[j] = _scaled_ff(ff, factor)
+            if self.rems[j] is not None:
+                out.rems[j] = [_scaled_ff(x, factor) for x in self.rems[j]]
+            out.ups[j] = self.ups[j] * factor
+            out.evs[j] = self.evs[j]
+            out.revs[j] = self.revs[j]
+        return True
+
+    def assemble(self, ends):
+        """
+        :param ends: the plan's subtree extents
+        :return: the list of FragmentFlows in traversal order
+        """
+        ffs = []
+        closing = []  # nodes whose unmatched subfragment io flows are appended when their subtree is finished
+        for i, ff in enumerate(self.ffs):
+            while closing and ends[closing[-1]] <= i:
+                ffs.extend(self.rems[closing.pop()])
+            if ff is None:
+                continue
+            ffs.append(ff)
+            if self.rems[i] is not None:
+                closing.append(i)
+        while closing:
+            ffs.extend(self.rems[closing.pop()])
+        return ffs
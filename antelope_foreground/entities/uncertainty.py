@@ -0,0 +1,139 @@
+"""
+Probability distributions for fragment exchange values.
+
+A fragment stores point exchange values, one per scenario.  A Distribution may be attached to any of them (see
+LcFragment.set_uncertainty()) to describe its uncertainty; the point value itself is unaffected, and is what every
+deterministic traversal uses.  Distributions are only consulted by monte_carlo.py, which draws arrays of samples from
+them.
+
+Three distributions are supported, following the conventions of ecoinvent and the ILCD format:
+
+ * Lognormal(median, gsd): the logarithm of the value is normally distributed with mean ln(median) and standard
+   deviation ln(gsd).  Note that gsd is the geometric standard deviation itself, not its square (the 95% interval is
+   median / gsd**2 to median * gsd**2).  A negative median describes a negative value.
+ * Triangular(minimum, mode, maximum)
+ * Uniform(minimum, maximum)
+
+Distributions are immutable, and serialize to dicts for storage with the fragment.
+"""
+
+import numpy as np
+
+
+class DistributionError(Exception):
+    pass
+
+
+class Distribution(object):
+    """
+    Abstract base class.  Subclasses set _type and _params and implement _draw().
+    """
+    _type = None
+    _params = ()
+
+    @classmethod
+    def from_json(cls, j):
+        """
+        :param j: a dict, as produced by serialize()
+        :return: a Distribution
+        """
+        j = dict(j)
+        t = j.pop('distribution')
+        for k in cls.__subclasses__():
+            if k._type == t:
+                return k(**j)
+        raise DistributionError('Unknown distribution %s' % t)
+
+    def sample(self, n, rng=None):
+        """
+        :param n: number of samples
+        :param rng: a numpy Generator (default: a new, unseeded one)
+        :return: an array of n samples
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        return self._draw(int(n), rng)
+
+    def _draw(self, n, rng):
+        raise NotImplementedError
+
+    def scale(self, factor):
+        """
+        :param factor: may be negative
+        :return: a new Distribution describing the value multiplied by factor
+        """
+        raise NotImplementedError
+
+    def serialize(self):
+        j = {'distribution': self._type}
+        for p in self._params:
+            j[p] = getattr(self, p)
+        return j
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.serialize() == other.serialize()
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.serialize().items())))
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%g' % getattr(self, p) for p in self._params))
+
+
+class Lognormal(Distribution):
+    _type = 'lognormal'
+    _params = ('median', 'gsd')
+
+    def __init__(self, median, gsd):
+        if gsd < 1:
+            raise DistributionError('Geometric standard deviation must be at least 1 (%g)' % gsd)
+        self.median = float(median)
+        self.gsd = float(gsd)
+
+    def _draw(self, n, rng):
+        return self.median * np.exp(np.log(self.gsd) * rng.standard_normal(n))
+
+    def scale(self, factor):
+        return Lognormal(self.median * factor, self.gsd)
+
+
+class Triangular(Distribution):
+    _type = 'triangular'
+    _params = ('minimum', 'mode', 'maximum')
+
+    def __init__(self, minimum, mode, maximum):
+        if not minimum <= mode <= maximum:
+            raise DistributionError('Triangular distribution requires minimum <= mode <= maximum (%g, %g, %g)' %
+                                    (minimum, mode, maximum))
+        self.minimum = float(minimum)
+        self.mode = float(mode)
+        self.maximum = float(maximum)
+
+    def _draw(self, n, rng):
+        if self.minimum == self.maximum:
+            return np.full(n, self.mode)
+        return rng.triangular(self.minimum, self.mode, self.maximum, n)
+
+    def scale(self, factor):
+        if factor < 0:
+            return Triangular(self.maximum * factor, self.mode * factor, self.minimum * factor)
+        return Triangular(self.minimum * factor, self.mode * factor, self.maximum * factor)
+
+
+class Uniform(Distribution):
+    _type = 'uniform'
+    _params = ('minimum', 'maximum')
+
+    def __init__(self, minimum, maximum):
+        if not minimum <= maximum:
+            raise DistributionError('Uniform distribution requires minimum <= maximum (%g, %g)' % (minimum, maximum))
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+
+    def _draw(self, n, rng):
+        return rng.uniform(self.minimum, self.maximum, n)
+
+    def scale(self, factor):
+        if factor < 0:
+            return Uniform(self.maximum * factor, self.minimum * factor)
+        return Uniform(self.minimum * factor, self.maximum * factor)
@@ -1,9 +1,11 @@
 from antelope import comp_dir, ExchangeRef
 
 from .terminations import FlowTermination, UnCachedScore, UnresolvedAnchor
+from .profiling import profiler
+from .tracing import tracer
 from antelope_core.lcia_results import LciaResult, DetailedLciaResult, SummaryLciaResult
 
-from collections import defaultdict
+import numpy as np
 
 
 class CumulatingFlows(Exception):
@@ -14,12 +16,46 @@ class CumulatingFlows(Exception):
     pass
 
 
+class FlowIndex(object):
+    """
+    An intern table that assigns a dense integer id to every distinct flow, so that flows can be accumulated in arrays
+    instead of dicts keyed by flow.  Hashing or comparing a flow entity formats its link every time, whereas the id of
+    a flow object the table has already seen is found with a single identity lookup.
+
+    Flows are distinct by link (which is what entity equality compares), so that an entity and a catalog ref for the
+    same flow share an id.  The table holds a reference to every flow object it has seen, so that object ids are never
+    reused while it is in use; ids are never reassigned.  Each group_ios() call uses a table of its own, which is
+    discarded (with its references) when the call returns.
+    """
+    def __init__(self):
+        self._by_object = dict()  # id(flow) -> flow id
+        self._by_link = dict()  # flow link -> flow id
+        self._objects = []
+
+    def __len__(self):
+        return len(self._by_link)
+
+    def index(self, flow):
+        """
+        :param flow: a flow entity or ref
+        :return: the flow's integer id
+        """
+        try:
+            return self._by_object[id(flow)]
+        except KeyError:
+            k = self._by_link.setdefault(flow.link, len(self._by_link))
+            self._by_object[id(flow)] = k
+            self._objects.append(flow)
+            return k
+
+
 class FragmentFlow(object):
     """
     A FragmentFlow is a an immutable record of a traversal query. essentially an enhanced NodeCache record which
     can be easily serialized to an antelope fragmentflow record.
 
-    A fragment traversal generates an array of FragmentFlow objects.
+    A fragment traversal generates an array of FragmentFlow objects.  A large traversal generates tens of thousands
+    of them, so they (and GhostFragments) are slotted records, without instance dicts.
 
     X    "fragmentID": 8, - added by antelope
     X    "fragmentStageID": 80,
@@ -78,6 +114,9 @@ class FragmentFlow(object):
                    parent.is_conserved_parent)
     '''
 
+    __slots__ = ('fragment', 'magnitude', 'node_weight', 'term', 'is_conserved', '_subfrags_params',
+                 'match_scenarios')
+
     @classmethod
     def cutoff(cls, parent, flow, direction, magnitude, is_conserved=False):
         fragment = GhostFragment(parent, flow, direction)
@@ -260,55 +299,63 @@ def group_ios(parent, ffs, include_ref_flow=True, passthru_threshold=0.45):
 
     As a reminder, if you need to model such a process, it is easy to do- just give the input and output distinct flows!
 
+    IO flows are identified by their ids in a FlowIndex and accumulated with numpy.bincount, in order of appearance,
+    so that the results are identical to summing them one at a time.
+
     :param parent: the node generating the cutoffs
-    :param ffs: a list of fragment flows resulting from a traversal of the parent
+    :param ffs: a list of fragment flows resulting from a traversal of the parent.  Any iterable will do, including the
+     generator returned by LcFragment.traverse_iter(); it is consumed in a single pass.
     :param include_ref_flow: [True] whether to include the reference fragment and adjust for autoconsumption
     :param passthru_threshold: [0.33] smaller than this is treated as autoconsumption / induced load
-    :return: [list of grouped IO flows], [list of internal non-null flows]
+    :return: [list of grouped IO flows], [list of internal non-null flows]; both empty if ffs is empty
     """
-    out = defaultdict(float)  # accumulates net total
-    pos_mag = defaultdict(float)  # accumulates +ve
-    neg_mag = defaultdict(float) # accumulates -ve
-    dirs = dict()
-    # cons = dict()
     internal = []
     external = []
+    nulls = []  # the io flows, and their flow ids
+    ids = []
+    index = FlowIndex().index
+    ref_mag = None
     for ff in ffs:
+        if ref_mag is None:
+            ref_mag = ff.magnitude
         if ff.term.is_null:
-            # accumulate IO flows according to the first seen direction
-            if ff.fragment.flow not in dirs:
-                dirs[ff.fragment.flow] = ff.fragment.direction
-            # and correct the signs of subsequent flows
-            if ff.fragment.direction == dirs[ff.fragment.flow]:
-                magnitude = ff.magnitude
-            else:
-                magnitude = -ff.magnitude
-
-            ''' # ditto conservation status  # but this doesn't work
-            if ff.fragment.flow not in cons:
-                cons[ff.fragment.flow] = ff.is_conserved
-            else:
-                if ff.is_conserved ^ cons[ff.fragment.flow]:
-                    print('** Surprise! conservation status not shared among matching flows %s' % ff.fragment.uuid)
-            '''
-
-            out[ff.fragment.flow] += magnitude
-            if magnitude > 0:  # separate test from above because we are ignoring relative-directions
-                pos_mag[ff.fragment.flow] += magnitude  # positive
-            else:
-                neg_mag[ff.fragment.flow] -= magnitude  # positive
+            nulls.append(ff)
+            ids.append(index(ff.fragment.flow))
         else:
             internal.append(ff)
+    if ref_mag is None:
+        return external, internal  # an empty traversal has no reference flow, and no io flows
+
+    # number the distinct flows 0..n-1 in order of first appearance
+    ids = np.array(ids, dtype=np.intp)
+    uniq, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.intp)
+    rank[order] = np.arange(len(order))
+    local = rank[inverse]
+    heads = [nulls[k].fragment for k in first[order]]
+
+    # accumulate IO flows according to the first seen direction, and correct the signs of subsequent flows
+    is_output = np.array([ff.fragment.direction == 'Output' for ff in nulls], dtype=bool)
+    magnitude = np.array([ff.magnitude for ff in nulls], dtype=float)
+    magnitude = np.where(is_output == is_output[first[order]][local], magnitude, -magnitude)
+    n = len(heads)
+    dirs = [h.direction for h in heads]
+    out = np.bincount(local, weights=magnitude, minlength=n).tolist()  # accumulates net total
+    # separate test from above because we are ignoring relative-directions
+    pos_mag = np.bincount(local, weights=np.where(magnitude > 0, magnitude, 0.0), minlength=n).tolist()  # +ve
+    neg_mag = np.bincount(local, weights=np.where(magnitude > 0, 0.0, -magnitude), minlength=n).tolist()  # +ve
 
     # now deal with reference flow-- trivial fragment should wind up with two equal-and-opposite [pass-through] flows
     ref_frag = parent.top()
     if include_ref_flow:
         # ref_cons = ref_frag.is_conserved_parent
-        ref_mag = ffs[0].magnitude
-        if ref_frag.flow in out:  # either pass through or autoconsumption
-            ref_frag.dbg_print('either pass through or autoconsumption')
-            val = out[ref_frag.flow]
-            auto_dirn = dirs[ref_frag.flow]
+        ref = index(ref_frag.flow)
+        j = int(np.searchsorted(uniq, ref))
+        if j < len(uniq) and uniq[j] == ref:  # either pass through or autoconsumption
+            r = int(rank[j])
+            val = out[r]
+            auto_dirn = dirs[r]
             if val < 0:
                 auto_dirn = comp_dir(auto_dirn)  # this is rare, but
             # else:
@@ -326,45 +373,52 @@ def group_ios(parent, ffs, include_ref_flow=True, passthru_threshold=0.45):
                 # case A here
                 if abs(val) < (passthru_threshold * ref_mag):
                     # A.1.b and A.3.b
-                    ref_frag.dbg_print('autoconsumption %g %g' % (val, ref_mag))
+                    if tracer.enabled:
+                        tracer.event(ref_frag, 'autoconsumption', value=val, ref_magnitude=ref_mag)
                     # autoconsumption, the inventory flow is subsumed by the ref_flow; direction sense should reverse
                     if auto_dirn == 'Output':
-                        out[ref_frag.flow] += ref_mag
+                        out[r] += ref_mag
                     else:
-                        out[ref_frag.flow] -= ref_mag
+                        out[r] -= ref_mag
                     if ref_mag > 0:
-                        pos_mag[ref_frag.flow] += ref_mag
+                        pos_mag[r] += ref_mag
                     else:
-                        neg_mag[ref_frag.flow] -= ref_mag
+                        neg_mag[r] -= ref_mag
 
                 else:
                     # A.1.a, A.3.a, A.2, A.4
-                    ref_frag.dbg_print('pass thru no effect %g %g' % (val, ref_mag))
+                    if tracer.enabled:
+                        tracer.event(ref_frag, 'pass_thru', value=val, ref_magnitude=ref_mag)
                     # pass-thru: pre-initialize external with the reference flow, having the opposite direction
                     external.append(FragmentFlow.cutoff(parent, ref_frag.flow, comp_dir(auto_dirn), ref_mag)) #,
                                                         #is_conserved=ref_cons))
             else:
                 # all case B
-                ref_frag.dbg_print('cumulation! %g %g' % (val, ref_mag))
+                if tracer.enabled:
+                    tracer.event(ref_frag, 'cumulation', value=val, ref_magnitude=ref_mag)
                 # cumulation: the directions are both the same... should they be accumulated?  not handled
                 raise CumulatingFlows('%s' % parent)
                 # external.append(FragmentFlow.cutoff(parent, ref_frag.flow, auto_dirn, ref_mag))
         else:
-            ref_frag.dbg_print('uncomplicated ref flow')
+            if tracer.enabled:
+                tracer.event(ref_frag, 'ref_flow')
             # no autoconsumption or pass-through, but we still want the ref flow to show up in the inventory
             external.append(FragmentFlow.cutoff(parent, ref_frag.flow, comp_dir(ref_frag.direction), ref_mag)) #,
                                                 #is_conserved=ref_cons))
 
-    for flow, value in out.items():
-        direction = dirs[flow]
-        abs_mag = max([pos_mag[flow], neg_mag[flow]])
+    for k, head in enumerate(heads):
+        flow = head.flow
+        value = out[k]
+        direction = dirs[k]
+        abs_mag = max([pos_mag[k], neg_mag[k]])
         if value != 0:
             if abs_mag == 0:  # we'd hate to get a ZeroDivisionError-- but this should be impossible
                 print('group_ios weird zero abs_mag %.5s (%s: %g, %g)' % (ref_frag.uuid, flow, value, abs_mag))
             elif abs(value) / abs_mag < 1e-12:
                 # these have never been controversial-- stop cluttering the console
                 # print('Quashing group_ios flow < 1e-12 magnitude (%s: %g, %g)' % (flow, value, abs_mag))
-                ref_frag.dbg_print('Quashing balance flow < 1e-12 magnitude (%s: %g, %g)' % (flow, value, abs_mag))
+                if tracer.enabled:
+                    tracer.event(ref_frag, 'quash_io', flow=flow.link, value=value, abs_magnitude=abs_mag)
                 value = 0.0
         if value < 0:
             direction = comp_dir(direction)
@@ -389,7 +443,9 @@ def ios_exchanges(ios, ref=None, scale=1.0):
 
 def frag_flow_lcia(fragmentflows, quantity_ref, scenario=None, **kwargs):
     """
-    Recursive function to compute LCIA of a traversal record contained in a set of Fragment Flows.
+    Function to compute LCIA of a traversal record contained in a set of Fragment Flows.  Subfragment records are
+    computed on an explicit stack of _frag_flow_lcia_steps generators, so nesting depth is not limited by the Python
+    stack.
     Note: refresh is no longer supported during traversal
     :param fragmentflows:
     :param quantity_ref:
@@ -397,6 +453,47 @@ def frag_flow_lcia(fragmentflows, quantity_ref, scenario=None, **kwargs):
     :param ignore_uncached: [True] whether to allow zero scores for un-cached, un-computable fragments
     :return:
     """
+    prof = profiler.enabled
+    if prof:
+        depth = profiler.depth
+        profiler.enter('lcia', _record_fragment(fragmentflows))
+    stack = [_frag_flow_lcia_steps(fragmentflows, quantity_ref, scenario, kwargs)]
+    value = None
+    try:
+        while True:
+            try:
+                sub_ffs, sub_scenario = stack[-1].send(value)
+            except StopIteration as e:
+                stack.pop()
+                if prof:
+                    profiler.exit()
+                if len(stack) == 0:
+                    return e.value
+                value = e.value
+                continue
+            if prof:
+                profiler.enter('lcia', _record_fragment(sub_ffs))
+            stack.append(_frag_flow_lcia_steps(sub_ffs, quantity_ref, sub_scenario, kwargs))
+            value = None
+    finally:
+        if prof:
+            profiler.unwind(depth)
+
+
+def _record_fragment(ffs):
+    """
+    :return: the fragment whose traversal is recorded in ffs, for profiling
+    """
+    if isinstance(ffs, list) and len(ffs) > 0:
+        return ffs[0].fragment
+    return None
+
+
+def _frag_flow_lcia_steps(fragmentflows, quantity_ref, scenario, kwargs):
+    """
+    The body of frag_flow_lcia, as a generator: yields (subfragments, subfragment_scenarios) whenever a subfragment
+    record must be computed, and is sent back the LciaResult.
+    """
     result = LciaResult(quantity_ref, scenario=str(scenario))
     _first_ff = True
     for ff in fragmentflows:
@@ -435,21 +532,12 @@ def frag_flow_lcia(fragmentflows, quantity_ref, scenario=None, **kwargs):
                 _recursive_remote = True
 
         else:
-            v = frag_flow_lcia(ff.subfragments, quantity_ref, scenario=ff.subfragment_scenarios, **kwargs)
+            v = yield ff.subfragments, ff.subfragment_scenarios
             if v.is_null:
                 continue
 
         # if we arrive here, we have a unit score from a subfragment
-
-        if ff.term.descend:
-            if v.has_summaries:
-                for k in v.keys():
-                    c = v[k]
-                    result.add_summary(k, c.entity, c.node_weight * node_weight, c.internal_result)
-            else:
-                result.add_summary(ff.fragment.uuid, ff, node_weight, v)
-        else:
-            result.add_summary(ff.fragment.uuid, ff, node_weight, v)
+        _add_subfragment_result(result, ff, node_weight, v)
 
         if _first_ff and _recursive_remote:
             return result  # bail out
@@ -457,11 +545,119 @@ def frag_flow_lcia(fragmentflows, quantity_ref, scenario=None, **kwargs):
     return result
 
 
+def _add_subfragment_result(result, ff, node_weight, v):
+    if ff.term.descend:
+        if v.has_summaries:
+            for k in v.keys():
+                c = v[k]
+                result.add_summary(k, c.entity, c.node_weight * node_weight, c.internal_result)
+        else:
+            result.add_summary(ff.fragment.uuid, ff, node_weight, v)
+    else:
+        result.add_summary(ff.fragment.uuid, ff, node_weight, v)
+
+
+def frag_flow_lcia_many(fragmentflows, quantities, scenario=None, **kwargs):
+    """
+    Compute the LCIA of a traversal record for several quantities at once.  The record, and the record of every
+    subfragment, is walked only once, and each termination's unit scores are fetched together (see
+    FlowTermination.score_caches()).  The results are identical to those of frag_flow_lcia() for each quantity.
+    :param fragmentflows:
+    :param quantities: a list of quantity refs
+    :param scenario: necessary if any remote traversals are required
+    :param kwargs: passed to score_caches()
+    :return: a list of LciaResults, one per quantity, in order
+    """
+    quantities = list(quantities)
+    prof = profiler.enabled
+    if prof:
+        depth = profiler.depth
+        profiler.enter('lcia', _record_fragment(fragmentflows))
+    stack = [_frag_flow_lcia_many_steps(fragmentflows, quantities, scenario, kwargs)]
+    value = None
+    try:
+        while True:
+            try:
+                sub_ffs, sub_scenario = stack[-1].send(value)
+            except StopIteration as e:
+                stack.pop()
+                if prof:
+                    profiler.exit()
+                if len(stack) == 0:
+                    return e.value
+                value = e.value
+                continue
+            if prof:
+                profiler.enter('lcia', _record_fragment(sub_ffs))
+            stack.append(_frag_flow_lcia_many_steps(sub_ffs, quantities, sub_scenario, kwargs))
+            value = None
+    finally:
+        if prof:
+            profiler.unwind(depth)
+
+
+def _frag_flow_lcia_many_steps(fragmentflows, quantities, scenario, kwargs):
+    """
+    The body of frag_flow_lcia_many, as a generator, following _frag_flow_lcia_steps quantity by quantity.  A quantity
+    whose result is settled by the record's first flow (a remote subfragment with no cached score) drops out of the
+    walk, exactly as the single-quantity walk bails out.
+    """
+    results = [LciaResult(q, scenario=str(scenario)) for q in quantities]
+    active = list(range(len(quantities)))
+    first = set(active)  # quantities for which no flow has yet been scored
+    for ff in fragmentflows:
+        if ff.term.is_null:
+            continue
+
+        node_weight = ff.node_weight
+        if node_weight == 0:
+            continue
+
+        if ff.term.direction == ff.fragment.direction:
+            node_weight *= -1
+
+        if len(ff.subfragments) == 0:
+            try:
+                vs = ff.term.score_caches([quantities[i] for i in active], **kwargs)
+            except UnresolvedAnchor:
+                for i in active:
+                    results[i].add_missing(ff.fragment.uuid, ff.term.term_node, node_weight)
+                first.clear()
+                continue
+
+            settled = []
+            for i, v in zip(active, vs):
+                if v is None:
+                    # a subfragment with no stored subfragments and no cached score: we gotta ask
+                    v = ff.term.term_node.fragment_lcia(quantities[i], scenario=scenario)
+                    _add_subfragment_result(results[i], ff, node_weight, v)
+                    if i in first:
+                        settled.append(i)  # bail out
+                elif not v.is_null:
+                    results[i].add_summary(ff.fragment.uuid, ff, node_weight, v)
+            first.clear()
+            if settled:
+                active = [i for i in active if i not in settled]
+                if len(active) == 0:
+                    break
+
+        else:
+            vs = yield ff.subfragments, ff.subfragment_scenarios
+            for i in active:
+                if vs[i].is_null:
+                    continue
+                _add_subfragment_result(results[i], ff, node_weight, vs[i])
+                first.discard(i)
+    return results
+
+
 class GhostFragment(object):
     """
     A GhostFragment is a non-actual fragment used for reporting and aggregating fragment inputs and outputs
       during traversal.
     """
+    __slots__ = ('_parent', 'flow', 'direction')
+
     def __init__(self, parent, flow, direction):
         self._parent = parent
         self.flow = flow
@@ -6,6 +6,16 @@ from antelope_core.implementations.quantity import UnknownRefQuantity
 from antelope_core.entities.xlsx_editor import XlsxArchiveUpdater
 from antelope_core.contexts import NullContext
 from ..entities.fragments import InvalidParentChild
+from ..entities.traversal_plan import TraversalPlan, IncrementalTraversal
+from ..entities.traversal_matrix import traverse_many
+from ..entities.batch_traversal import traverse_all
+from ..entities.loop_solver import solve_loops
+from ..entities.fragment_matrices import to_matrices, lcia_matrix
+from ..entities.scenario_sweep import scenario_sweep
+from ..entities.monte_carlo import monte_carlo
+from ..entities.sensitivity import sensitivity
+from ..contributions import top_contributors
+from ..score_dependencies import score_dependencies
 from ..entities.fragment_editor import create_fragment, clone_fragment, _fork_fragment, interpose
 
 
@@ -564,21 +574,228 @@ class AntelopeForegroundImplementation(BasicImplementation, AntelopeForegroundIn
         frag = self._archive.retrieve_or_fetch_entity(fragment)
         return frag.tree()
 
-    def traverse(self, fragment, scenario=None, **kwargs):
+    def traverse(self, fragment, scenario=None, loops=False, **kwargs):
+        """
+
+        :param fragment:
+        :param scenario:
+        :param loops: [False] if True, solve any loops of subfragment references (see loop_solver) instead of
+         raising InvalidParentChild
+        :param kwargs:
+        :return:
+        """
         frag = self._archive.retrieve_or_fetch_entity(fragment)
+        if loops:
+            return frag.traverse(scenario, observed=True, memo=solve_loops(frag, scenario, observed=True))
         return frag.traverse(scenario, observed=True)
 
+    def compile_traversal(self, fragment, scenario=None, **kwargs):
+        """
+        Compile a reusable traversal plan for the fragment.  plan.execute() gives the same result as traverse(), and
+        can be repeated without re-walking the fragment tree, so long as the model structure is not changed.
+        :param fragment:
+        :param scenario:
+        :param kwargs:
+        :return: a TraversalPlan
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        return TraversalPlan.compile(frag, scenario, observed=True)
+
+    def incremental_traversal(self, fragment, scenario=None, **kwargs):
+        """
+        Create a traversal that is kept up to date as the model is edited.  Each call to its traverse() method
+        recomputes only the parts of the fragment affected by changes (observations, exchange values, terminations)
+        made since the last call.
+        :param fragment:
+        :param scenario:
+        :param kwargs:
+        :return: an IncrementalTraversal
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        return IncrementalTraversal(frag, scenario, observed=True)
+
+    def traverse_many(self, fragment, scenarios, **kwargs):
+        """
+        Traverse a fragment under a list of scenario specifications in a single pass.
+        :param fragment:
+        :param scenarios: a list of scenario specifications, each as would be supplied to traverse()
+        :param kwargs:
+        :return: a TraversalMatrix, with scenario x node arrays of magnitudes and node weights
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        return traverse_many(frag, scenarios, observed=True)
+
+    def traverse_all(self, scenarios=(None, ), workers=None, fragments=None, quantities=None, background=None,
+                     **kwargs):
+        """
+        Traverse every reference fragment in the foreground under each of a list of scenarios, in parallel worker
+        processes.  Results are identical to a serial run (workers=1).
+        :param scenarios: [(None, )] a list of scenario specifications, each as would be supplied to traverse()
+        :param workers: [None] number of worker processes (default: number of CPUs)
+        :param fragments: [None] a list of fragments or fragment refs (default: all reference fragments, in order of
+         external ref)
+        :param quantities: [None] a list of quantity refs with which to score each traversal
+        :param background: [None] if True or False, only include reference fragments with matching background status
+        :param kwargs: passed to traverse_all()
+        :return: a BatchResult
+        """
+        if fragments is None:
+            fragments = sorted(self._archive._fragments(background=background), key=lambda x: x.external_ref)
+        else:
+            fragments = [self._archive.retrieve_or_fetch_entity(f) for f in fragments]
+        return traverse_all(fragments, scenarios, workers=workers, observed=True, quantities=quantities, **kwargs)
+
+    def to_matrices(self, fragment, scenario=None, loops=False, **kwargs):
+        """
+        Construct the sparse matrix representation of a fragment traversal: technology matrix A, cutoff matrix C, and
+        background dependency matrix B, with row and column index maps.
+        :param fragment:
+        :param scenario:
+        :param loops: [False] whether to solve loops of subfragment references
+        :param kwargs:
+        :return: a FragmentMatrices
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        memo = solve_loops(frag, scenario, observed=True) if loops else None
+        return to_matrices(frag, scenario, observed=True, memo=memo)
+
+    def lcia_matrix(self, fragment, quantities, scenario=None, loops=False, **kwargs):
+        """
+        The LCIA result of every node of a fragment traversal, as a dense nodes x quantities matrix with its index
+        :param fragment:
+        :param quantities: a list of quantity refs
+        :param scenario:
+        :param loops: [False] whether to solve loops of subfragment references
+        :param kwargs: passed to score_cache()
+        :return: a NodeScores
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        memo = solve_loops(frag, scenario, observed=True) if loops else None
+        return lcia_matrix(frag, quantities, scenario, observed=True, memo=memo, **kwargs)
+
+    def scenario_sweep(self, fragment, scenarios, quantities, executor='serial', **kwargs):
+        """
+        LCIA results of a fragment by stage, for every quantity, under every scenario, as a tidy columnar table
+        :param fragment:
+        :param scenarios: a list of scenario specifications, or a dict of dicts as supplied to set_scenario_knobs()
+         (whose knobs must already be set)
+        :param quantities: a list of quantity refs
+        :param executor: ['serial'] or 'process'
+        :param kwargs: workers, prefetch, and kwargs to score_cache()
+        :return: a SweepTable
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        return scenario_sweep(frag, scenarios, quantities, executor=executor, **kwargs)
+
     def clear_unit_scores(self, lcia_method=None):
         self._archive.clear_unit_scores(lcia_method)
 
+    def invalidate_unit_scores(self, process=None, quantity=None, flows=None):
+        """
+        Remove only the unit scores that depend on a changed background process or characterization, wherever they
+        are cached, along with any fragment scores computed from them.  See score_dependencies.py.
+        :param process: [None] a background process whose LCI has changed
+        :param quantity: [None] with process: only scores for this quantity.  Without process: a quantity whose
+         characterization factors have changed
+        :param flows: [None] with quantity: the flows whose characterization factors have changed.  None means all.
+        :return: list of the terminations whose scores were removed
+        """
+        if process is not None:
+            return score_dependencies.invalidate_process(process, quantity=quantity)
+        if quantity is None:
+            raise ValueError('A process or a quantity must be specified')
+        return score_dependencies.invalidate_characterization(quantity, flows=flows)
+
     def clear_scenarios(self, terminations=True):
         for f in self._archive.entities_by_type('fragment'):
             f.clear_scenarios(terminations=terminations)
 
-    def fragment_lcia(self, fragment, quantity_ref, scenario=None, refresh=False, **kwargs):
+    def fragment_lcia(self, fragment, quantity_ref, scenario=None, refresh=False, loops=False, **kwargs):
         frag = self._archive.retrieve_or_fetch_entity(fragment)
+        if loops:
+            kwargs['memo'] = solve_loops(frag, scenario, observed=True)
         return frag.top().fragment_lcia(quantity_ref, scenario=scenario, refresh=refresh, **kwargs)
 
+    def fragment_lcia_many(self, fragment, quantities, scenario=None, refresh=False, loops=False, **kwargs):
+        """
+        LCIA results for several quantities, computed from a single traversal
+        :param fragment:
+        :param quantities: a list of quantity refs
+        :param scenario:
+        :param refresh:
+        :param loops: [False] solve loops first, as in fragment_lcia()
+        :param kwargs:
+        :return: an LciaResults keyed by quantity
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        if loops:
+            kwargs['memo'] = solve_loops(frag, scenario, observed=True)
+        return frag.top().fragment_lcia_many(quantities, scenario=scenario, refresh=refresh, **kwargs)
+
+    def top_contributors(self, fragment, quantities, n=10, by='flow', threshold=0.0, scenario=None, loops=False,
+                         **kwargs):
+        """
+        The leading contributors to a fragment's LCIA result for each of several quantities, from a single traversal
+        :param fragment:
+        :param quantities: a list of quantity refs
+        :param n: [10] number of contributors per quantity
+        :param by: ['flow'] leaf fragment flows ('flow') or their term nodes ('process')
+        :param threshold: [0.0] a magnitude below which results and subfragments are not examined
+        :param scenario:
+        :param loops: [False] solve loops first, as in fragment_lcia()
+        :param kwargs: passed to score_cache()
+        :return: a list of Contributions, one per quantity
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment).top()
+        memo = solve_loops(frag, scenario, observed=True) if loops else None
+        ffs = frag.traverse(scenario=scenario, observed=True, memo=memo)
+        return [top_contributors(ffs, q, n=n, by=by, threshold=threshold, scenario=scenario, **kwargs)
+                for q in quantities]
+
+    def monte_carlo(self, fragment, quantities, n, scenario=None, distributions=None, seed=None, **kwargs):
+        """
+        Monte Carlo simulation of a fragment's LCIA results, using the distributions attached to the exchange values
+        of the fragment and its subfragments, all samples computed in a single vectorized traversal.
+        :param fragment:
+        :param quantities: a quantity ref or a list of quantity refs
+        :param n: number of samples
+        :param scenario:
+        :param distributions: [None] ad hoc distributions: a dict of knob name (or fragment) to Distribution
+        :param seed: [None] random seed
+        :param kwargs: passed to monte_carlo()
+        :return: a MonteCarloResult
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        if not isinstance(quantities, (list, tuple)):
+            quantities = [quantities]
+        dists = dict()
+        for k, d in (distributions or dict()).items():
+            if isinstance(k, str):
+                k = self.get(k)
+            dists[k] = d
+        return monte_carlo(frag.top(), quantities, n, scenario=scenario, observed=True, distributions=dists,
+                           seed=seed, **kwargs)
+
+    def sensitivity(self, fragment, quantities, knobs=None, scenario=None, **kwargs):
+        """
+        Derivatives of a fragment's LCIA results with respect to the exchange value of every knob, computed in a
+        single traversal.
+        :param fragment:
+        :param quantities: a quantity ref or a list of quantity refs
+        :param knobs: [None] a list of knobs or knob names.  Default is all knobs in the foreground.
+        :param scenario:
+        :param kwargs: passed to sensitivity()
+        :return: a knobs x quantities SensitivityTable
+        """
+        frag = self._archive.retrieve_or_fetch_entity(fragment)
+        if not isinstance(quantities, (list, tuple)):
+            quantities = [quantities]
+        if knobs is None:
+            knobs = list(self.knobs())
+        else:
+            knobs = [self.get(k) if isinstance(k, str) else k for k in knobs]
+        return sensitivity(frag.top(), quantities, knobs, scenario=scenario, observed=True, **kwargs)
+
     def create_process_model(self, process, ref_flow=None, set_background=None, **kwargs):
         """
         Create a fragment from the designated process model.  Note: the fragment's reference flow will have a unit
@@ -1,11 +1,106 @@
+import copyreg
+from bisect import bisect_left, insort
 from collections import defaultdict
+from numbers import Integral
+
+import numpy as np
+
 from antelope_core.lcia_results import LciaResult, DuplicateResult
 
 
+def _key_strings(key):
+    """
+    The strings under which a key can be found by prefix: the key itself, if it is a string, or else an entity's link
+    and external ref
+    """
+    if isinstance(key, str):
+        return key,
+    strings = tuple(k for k in (getattr(key, 'link', None), getattr(key, 'external_ref', None)) if isinstance(k, str))
+    return strings or (str(key), )
+
+
+class KeyIndex(object):
+    """
+    A sorted index of the strings of a set of keys, for lookup by exact string or by prefix.  Where several keys
+    match, the one added first is found.
+    """
+    def __init__(self, keys=()):
+        self._sorted = []  # (string, seq)
+        self._keys = dict()  # seq: key
+        self._seqs = dict()  # key: seq
+        self._seq = 0
+        for k in keys:
+            self.add(k)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        if key in self._seqs:
+            return
+        self._keys[self._seq] = key
+        self._seqs[key] = self._seq
+        for s in set(_key_strings(key)):
+            insort(self._sorted, (s, self._seq))
+        self._seq += 1
+
+    def remove(self, key):
+        seq = self._seqs.pop(key, None)
+        if seq is None:
+            return
+        del self._keys[seq]
+        for s in set(_key_strings(key)):
+            del self._sorted[bisect_left(self._sorted, (s, seq))]
+
+    def clear(self):
+        self._sorted = []
+        self._keys = dict()
+        self._seqs = dict()
+
+    def match(self, string, prefix=True):
+        """
+        :param string:
+        :param prefix: [True] whether to match keys whose strings merely begin with string
+        :return: the key whose string is string, or else (with prefix) the first key whose string begins with it; or
+         None
+        """
+        i = bisect_left(self._sorted, (string, ))
+        if i == len(self._sorted) or not self._sorted[i][0].startswith(string):
+            return None
+        if self._sorted[i][0] == string:
+            return self._keys[self._sorted[i][1]]  # entries with equal strings are in the order added
+        if not prefix:
+            return None
+        first = self._sorted[i][1]
+        for j in range(i + 1, len(self._sorted)):
+            s, seq = self._sorted[j]
+            if not s.startswith(string):
+                break
+            first = min(first, seq)
+        return self._keys[first]
+
+    def resolve(self, item):
+        """
+        :param item: a key, the string or prefix of a key's string, or an entity whose link or external ref is a key's
+         string
+        :return: the matching key, or None
+        """
+        if item in self._seqs:
+            return item
+        if isinstance(item, str):
+            return self.match(item)
+        for s in _key_strings(item):
+            k = self.match(s, prefix=False)
+            if k is not None:
+                return k
+        return None
+
+
 class LciaResults(dict):
     """
     A dict of LciaResult objects, with some useful attachments.  The dict gets added to in the normal way, but
-    also keeps track of the keys added in sequence, so that they can be retrieved by numerical index.
+    also keeps track of the keys added in sequence, so that they can be retrieved by numerical index, and keeps a
+    sorted index of the keys' strings, so that they can be retrieved by prefix.
 
     The LciaResults object keys should be quantity links
 
@@ -15,32 +110,63 @@ class LciaResults(dict):
         super(LciaResults, self).__init__(*args, **kwargs)
         self.entity = entity
         self._scale = 1.0
-        self._indices = []
+        self._indices = list(self.keys())
+        self._index = KeyIndex(self._indices)
+
+    def __reduce__(self):
+        """
+        The results are pickled with the attributes, rather than as dict items, so that they are restored after the
+        attributes __setitem__ relies on, and without being rescaled
+        """
+        return copyreg.__newobj__, (self.__class__, ), (self.__dict__, list(dict.items(self)))
+
+    def __setstate__(self, state):
+        attrs, items = state
+        self.__dict__.update(attrs)
+        for k, v in items:
+            super(LciaResults, self).__setitem__(k, v)
+
+    def _resolve(self, item):
+        """
+        :param item: a key, a numerical index, a string or prefix of a key's string, or an entity
+        :return: the matching key, or None
+        """
+        if super(LciaResults, self).__contains__(item):
+            return item
+        if isinstance(item, Integral):
+            return self._indices[item]
+        return self._index.resolve(item)
 
     def __getitem__(self, item):
         """
-        __getitem__ can either be used as a numerical index
+        __getitem__ can either be used as a numerical index, or with a key, or with the beginning of a key's string
+        (see KeyIndex); an unmatched item gives a null result
         :param item:
         :return:
         """
-        try:
-            return super(LciaResults, self).__getitem__(item)
-        except KeyError:
-            try:
-                int(item)
-                return super(LciaResults, self).__getitem__(self._indices[item])
-            except (ValueError, TypeError):
-                try:
-                    return super(LciaResults, self).__getitem__(next(k for k in self.keys() if k.startswith(item)))
-                except StopIteration:
-                    return LciaResult(None)  #
+        key = self._resolve(item)
+        if key is None:
+            return LciaResult(None)
+        return super(LciaResults, self).__getitem__(key)
 
     def __setitem__(self, key, value):
         assert isinstance(value, LciaResult)
         value.scale_result(self._scale)
-        super(LciaResults, self).__setitem__(key, value)
-        if key not in self._indices:
+        if not super(LciaResults, self).__contains__(key):
             self._indices.append(key)
+            self._index.add(key)
+        super(LciaResults, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(LciaResults, self).__delitem__(key)
+        self._indices.remove(key)
+        self._index.remove(key)
+
+    def pop(self, key, *args):
+        if super(LciaResults, self).__contains__(key):
+            self._indices.remove(key)
+            self._index.remove(key)
+        return super(LciaResults, self).pop(key, *args)
 
     '''
     def add(self, value):
@@ -56,6 +182,33 @@ class LciaResults(dict):
     def to_list(self):
         return [self.__getitem__(k) for k in self._indices]
 
+    def totals(self):
+        """
+        :return: an array of the total of each result, in index order
+        """
+        return np.array([super(LciaResults, self).__getitem__(k).total() for k in self._indices])
+
+    def weight_vector(self, weights):
+        """
+        :param weights: a dict mapping keys (or anything __getitem__ accepts) to numerical weights
+        :return: an array of weights, in index order; weights that match no key are ignored
+        """
+        position = {k: i for i, k in enumerate(self._indices)}
+        w = np.zeros(len(self._indices))
+        for item, weight in weights.items():
+            key = self._resolve(item)
+            if key is not None:
+                w[position[key]] += weight
+        return w
+
+    def weighted_total(self, weights):
+        """
+        The weighted sum of the results' totals, as a single dot product
+        :param weights: as supplied to apply_weighting()
+        :return:
+        """
+        return float(self.weight_vector(weights) @ self.totals())
+
     def scale(self, factor):
         if factor == self._scale:
             return
@@ -117,10 +270,87 @@ class LciaResults(dict):
     def clear(self):
         super(LciaResults, self).clear()
         self._indices = []
+        self._index.clear()
 
     def update(self, *args, **kwargs):
         super(LciaResults, self).update(*args, **kwargs)
         self._indices = list(self.keys())
+        self._index = KeyIndex(self._indices)
+
+
+class LciaTotals(object):
+    """
+    The totals of many LciaResults objects (e.g. the results of many fragments) as a single contiguous array, so
+    that weighting and normalization are array operations instead of a lookup per result and category.
+     entities: the entity of each LciaResults (a row index)
+     keys: the result keys (a column index)
+     values: entities x keys array; a key missing from an LciaResults has a total of 0
+    """
+    def __init__(self, results, keys=None):
+        """
+        :param results: a list of LciaResults
+        :param keys: [None] the keys to include; default is the indices of the first LciaResults
+        """
+        results = list(results)
+        if keys is None:
+            keys = list(results[0].indices()) if results else []
+        self.entities = [r.entity for r in results]
+        self.keys = list(keys)
+        self._index = KeyIndex(self.keys)
+        self.values = np.zeros((len(results), len(self.keys)))
+        for i, r in enumerate(results):
+            if r._indices == self.keys:
+                self.values[i] = r.totals()
+            else:
+                self.values[i] = [r[k].total() for k in self.keys]
+
+    @classmethod
+    def _from_values(cls, entities, keys, values):
+        t = cls([], keys)
+        t.entities = entities
+        t.values = values
+        return t
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def __len__(self):
+        return len(self.entities)
+
+    def vector(self, mapping):
+        """
+        :param mapping: a dict mapping keys (or strings, prefixes, or entities that match them) to numbers
+        :return: an array of the numbers, in key order; items that match no key are ignored
+        """
+        position = {k: j for j, k in enumerate(self.keys)}
+        v = np.zeros(len(self.keys))
+        for item, x in mapping.items():
+            key = self._index.resolve(item)
+            if key is not None:
+                v[position[key]] += x
+        return v
+
+    def column(self, key):
+        return self.values[:, self.keys.index(self._index.resolve(key))]
+
+    def apply_weighting(self, weights):
+        """
+        The weighted sum of each entity's totals
+        :param weights: a dict mapping keys to numerical weights, as for LciaResults.apply_weighting()
+        :return: an array of weighted totals, one per entity
+        """
+        return self.values @ self.vector(weights)
+
+    def scale(self, factors):
+        """
+        Scale the totals, e.g. to normalize them
+        :param factors: a number, or a dict mapping keys to factors (keys not mentioned are scaled by 0)
+        :return: a new LciaTotals
+        """
+        if isinstance(factors, dict):
+            factors = self.vector(factors)
+        return self._from_values(self.entities, self.keys, self.values * factors)
 
 
 class LciaWeighting(object):
@@ -136,5 +366,12 @@ class LciaWeighting(object):
     def weigh(self, res, **kwargs):
         return res.apply_weighting(self._w, self._q, **kwargs)
 
+    def weigh_totals(self, totals):
+        """
+        :param totals: an LciaTotals
+        :return: an array of weighted totals
+        """
+        return totals.apply_weighting(self._w)
+
     def q(self):
         return self._q.link
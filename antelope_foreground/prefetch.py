@@ -0,0 +1,121 @@
+"""
+Concurrent prefetch of termination unit scores.
+
+During frag_flow_lcia(), each process or context termination computes its unit score the first time it is asked for
+one, by a bg_lcia() or do_lcia() query.  When the background is remote, these queries are made one at a time and
+their latencies add up.  prefetch_unit_scores() instead collects, before the LCIA walk, every termination in a
+traversal record (subfragment records included) whose unit score is missing, and computes the missing scores
+concurrently on a bounded pool of threads.  The walk that follows then finds every score in its cache.
+
+Terminations are grouped by the inputs of the unit score computation, so that each distinct score is computed once:
+the term node, term flow, inbound exchange value, and quantity.  A process termination whose parent has child flows
+excludes them from its score (they are observed), and a context termination's score depends on its parent's flow, so
+these are also grouped by parent.  Every termination in a group receives its own copy of the result.
+
+A computation that fails to find what it needs-- a quantity, an entity, a background, or a remote resource (see
+LOOKUP_ERRORS)-- is left uncached, so that score_cache() raises the error in the LCIA walk just as it would have
+without the prefetch.  Any other error is raised by prefetch_unit_scores() itself.  Profiling frames, trace events, and the persistent score store (see score_store.py) are
+only used from the calling thread.
+"""
+
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+from antelope import BackgroundRequired, EntityNotFound, QuantityRequired
+
+from .profiling import profiler
+from .score_store import unit_score_store
+
+
+LOOKUP_ERRORS = (QuantityRequired, EntityNotFound, BackgroundRequired, NotImplementedError,
+                 OSError)  # OSError includes connection and HTTP errors from remote queries
+
+
+def _record_terminations(fragmentflows):
+    """
+    The terminations whose score caches the LCIA walk would consult, in order, without duplicates
+    :param fragmentflows:
+    :return:
+    """
+    terms = []
+    seen = set()
+    stack = [fragmentflows]
+    while stack:
+        for ff in stack.pop():
+            term = ff.term
+            if term.is_null or ff.node_weight == 0:
+                continue
+            if len(ff.subfragments) > 0:
+                stack.append(ff.subfragments)
+                continue
+            if term.is_fg or term.is_frag or id(term) in seen:
+                continue
+            seen.add(id(term))
+            if term.valid:
+                terms.append(term)
+    return terms
+
+
+def _unit_score_key(term, quantity):
+    if term.is_context:
+        return tuple(term.term_node.as_list()), term.term_flow.link, term._parent.uuid, quantity.link
+    if len(list(term._parent.child_flows)) > 0:
+        anchor = term._parent.uuid
+    else:
+        anchor = None
+    return term.term_node.link, term.term_flow.link, term.inbound_exchange_value, anchor, quantity.link
+
+
+def _compute(term, quantity, kwargs):
+    try:
+        return term.compute_unit_score(quantity, **kwargs)
+    except LOOKUP_ERRORS:  # left for score_cache() to raise
+        return None
+
+
+def _copy_result(res):
+    if isinstance(res, list):
+        return [copy.copy(k) for k in res]
+    return copy.copy(res)
+
+
+def prefetch_unit_scores(fragmentflows, quantities, threads=8, **kwargs):
+    """
+    Compute, concurrently, the unit scores the LCIA of a traversal record will need that are not yet cached.
+    :param fragmentflows: a traversal record
+    :param quantities: a list of quantity refs
+    :param threads: [8] maximum number of concurrent unit score computations
+    :param kwargs: passed to compute_unit_score()
+    :return: the number of distinct unit scores computed
+    """
+    groups = dict()  # key: (quantity, [terminations])
+    for term in _record_terminations(fragmentflows):
+        for q in quantities:
+            if term.has_unit_score(q):
+                continue
+            if unit_score_store.enabled and unit_score_store.load(term, q):
+                continue
+            groups.setdefault(_unit_score_key(term, q), (q, []))[1].append(term)
+    if len(groups) == 0:
+        return 0
+
+    prof = profiler.enabled
+    if prof:
+        profiler.enter('prefetch', fragmentflows[0].fragment)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(threads, len(groups)))) as pool:
+            futures = [(q, terms, pool.submit(_compute, terms[0], q, kwargs)) for q, terms in groups.values()]
+            for q, terms, future in futures:
+                res = future.result()
+                if res is None:
+                    continue
+                terms[0].store_unit_score(q, res)
+                for term in terms[1:]:
+                    term.store_unit_score(q, _copy_result(res))
+                if unit_score_store.enabled:
+                    for term in terms:
+                        unit_score_store.save(term, q, term.score_cache()[q])
+    finally:
+        if prof:
+            profiler.exit()
+    return len(groups)
@@ -0,0 +1,265 @@
+"""
+Per-node profiling of fragment traversal and LCIA.
+
+The traversal and LCIA code open and close profiling frames at the points where time is spent, each frame attributed
+to a fragment and, for terminations, to the termination's node:
+
+ * 'traverse' - a traversal of a reference fragment (traverse(), unit_inventory(), ...)
+ * 'subfragment' - a subfragment traversal performed on behalf of a parent traversal
+ * 'node' - the computation of one node's FragmentFlow
+ * 'lcia' - the LCIA of a traversal record, or of a subfragment's record within it
+ * 'score' - a request to a termination's score cache
+ * 'unit_score' - the computation of a unit score, after a score cache miss
+ * 'prefetch' - the concurrent computation of a traversal record's missing unit scores (see prefetch.py)
+
+Like trace events (see tracing.py), frames are only opened when profiler.enabled is set, which profile() does for the
+duration of a with block:
+
+    with profile() as p:
+        frag.fragment_lcia(quantity)
+    p.report()
+    p.write_collapsed('lcia.folded')
+
+For every (kind, fragment, termination) the profile records the number of calls, the inclusive and exclusive wall
+time, and cache hits and misses: score cache lookups for 'score' frames, and memoized subfragment inventories for
+'subfragment' frames.  It also records the exclusive time of every distinct stack of frames, which write_collapsed()
+exports in the collapsed-stack format read by flamegraph.pl, speedscope, and similar tools.
+
+Note that when a traversal is streamed (traverse_iter()), the time spent by the consumer between FragmentFlows is
+counted in the traversal's frame.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+def _name(entity):
+    if entity is None:
+        return '-'
+    name = getattr(entity, 'external_ref', None)
+    if name is None:
+        return str(entity)
+    return str(name)
+
+
+class ProfileStats(object):
+    """
+    Accumulated statistics for one (kind, fragment, termination)
+    """
+    __slots__ = ('kind', 'fragment', 'name', 'term', 'calls', 'inclusive', 'exclusive', 'hits', 'misses')
+
+    def __init__(self, kind, fragment, name, term):
+        self.kind = kind
+        self.fragment = fragment  # uuid
+        self.name = name
+        self.term = term
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def label(self):
+        if self.term is None:
+            return '%s:%s' % (self.kind, self.name)
+        return '%s:%s->%s' % (self.kind, self.name, self.term)
+
+    def serialize(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class Profile(object):
+    """
+    The result of profile()
+    """
+    def __init__(self):
+        self.stats = dict()  # key: ProfileStats
+        self._path_index = dict()  # (parent path, stats key): path
+        self._path_parent = []
+        self._path_key = []
+        self._path_time = []
+
+    def _stats(self, kind, fragment, term):
+        uuid = getattr(fragment, 'uuid', None)
+        key = (kind, uuid, None if term is None else _name(term))
+        try:
+            return key, self.stats[key]
+        except KeyError:
+            s = self.stats[key] = ProfileStats(kind, uuid, _name(fragment), key[2])
+            return key, s
+
+    def _path(self, parent, key):
+        try:
+            return self._path_index[(parent, key)]
+        except KeyError:
+            p = self._path_index[(parent, key)] = len(self._path_key)
+            self._path_parent.append(parent)
+            self._path_key.append(key)
+            self._path_time.append(0.0)
+            return p
+
+    def rows(self, sort='exclusive', kind=None):
+        """
+        :param sort: ['exclusive'] any ProfileStats attribute: 'exclusive', 'inclusive', 'calls', 'misses', ...
+        :param kind: [None] only report the given kind of frame
+        :return: a list of ProfileStats, in descending order
+        """
+        rows = [s for s in self.stats.values() if kind is None or s.kind == kind]
+        return sorted(rows, key=lambda s: getattr(s, sort), reverse=True)
+
+    def hot_fragments(self, n=10):
+        """
+        The fragments with the most exclusive time, summed over all kinds of frames
+        :param n:
+        :return: list of (exclusive seconds, fragment uuid, name)
+        """
+        agg = dict()
+        for s in self.stats.values():
+            t, name = agg.get(s.fragment, (0.0, s.name))
+            agg[s.fragment] = (t + s.exclusive, name)
+        return sorted(((t, u, name) for u, (t, name) in agg.items()), reverse=True)[:n]
+
+    def report(self, n=25, sort='exclusive', kind=None):
+        """
+        Print the top n rows, sorted in descending order
+        :param n:
+        :param sort:
+        :param kind:
+        :return:
+        """
+        print('%-11s %-40s %8s %10s %10s %8s %8s' % ('kind', 'fragment [-> term]', 'calls', 'incl (s)', 'excl (s)',
+                                                   'hits', 'misses'))
+        for s in self.rows(sort=sort, kind=kind)[:n]:
+            name = s.name if s.term is None else '%s -> %s' % (s.name, s.term)
+            print('%-11s %-40.40s %8d %10.4f %10.4f %8d %8d' % (s.kind, name, s.calls, s.inclusive, s.exclusive,
+                                                              s.hits, s.misses))
+
+    def collapsed(self):
+        """
+        :return: a list of (stack, microseconds) with the stack given as a ;-separated string of frame labels
+        """
+        out = []
+        for p, t in enumerate(self._path_time):
+            us = int(round(t * 1e6))
+            if us == 0:
+                continue
+            labels = []
+            while p is not None:
+                labels.append(self.stats[self._path_key[p]].label.replace(';', ','))
+                p = self._path_parent[p]
+            out.append((';'.join(reversed(labels)), us))
+        return out
+
+    def write_collapsed(self, path):
+        """
+        Write exclusive times, in microseconds, in the collapsed-stack format of flamegraph.pl
+        :param path:
+        :return:
+        """
+        with open(path, 'w') as fp:
+            for stack, us in self.collapsed():
+                fp.write('%s %d\n' % (stack, us))
+
+
+class Profiler(object):
+    """
+    Maintains the stack of open frames on behalf of the active Profile.  There is a single instance, profiler.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._profile = None
+        self._stack = []  # [stats key, path, start, child time]
+
+    @property
+    def depth(self):
+        return len(self._stack)
+
+    def start(self, prof):
+        if self._profile is not None:
+            raise ValueError('A profile is already active')
+        self._profile = prof
+        self._stack = []
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        self._profile = None
+        self._stack = []
+
+    def enter(self, kind, fragment, term=None):
+        """
+        Open a frame.  Callers test profiler.enabled first, and must close the frame with exit().
+        :param kind: a kind of frame
+        :param fragment: the fragment the time is attributed to
+        :param term: [None] the termination's node, for termination frames
+        :return:
+        """
+        key, s = self._profile._stats(kind, fragment, term)
+        s.calls += 1
+        parent = self._stack[-1][1] if self._stack else None
+        self._stack.append([key, self._profile._path(parent, key), time.perf_counter(), 0.0])
+
+    def exit(self):
+        if not self._stack:
+            return
+        key, path, start, child = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        s = self._profile.stats[key]
+        s.inclusive += elapsed
+        s.exclusive += elapsed - child
+        self._profile._path_time[path] += elapsed - child
+        if self._stack:
+            self._stack[-1][3] += elapsed
+
+    def unwind(self, depth):
+        """
+        Close any frames left open above the given depth, e.g. by an exception
+        :param depth:
+        :return:
+        """
+        while len(self._stack) > depth:
+            self.exit()
+
+    def hit(self):
+        """
+        Count a cache hit against the current frame
+        """
+        if self._stack:
+            self._profile.stats[self._stack[-1][0]].hits += 1
+
+    def miss(self):
+        if self._stack:
+            self._profile.stats[self._stack[-1][0]].misses += 1
+
+    def count(self, kind, fragment, term=None, hit=True):
+        """
+        Count a cache hit or miss without opening a frame
+        :param kind:
+        :param fragment:
+        :param term:
+        :param hit:
+        :return:
+        """
+        _, s = self._profile._stats(kind, fragment, term)
+        if hit:
+            s.hits += 1
+        else:
+            s.misses += 1
+
+
+profiler = Profiler()
+
+
+@contextmanager
+def profile():
+    """
+    Profile the traversals and LCIA computed within a with block
+    :return: a Profile
+    """
+    prof = Profile()
+    profiler.start(prof)
+    try:
+        yield prof
+    finally:
+        profiler.stop()
@@ -414,9 +414,15 @@ class LcForeground(BasicArchive):
         self._do_load(fragments)
 
     def _recurse_frags(self, frag):
-        frags = [frag]
-        for x in sorted(frag.child_flows, key=lambda z: z.uuid):
-            frags.extend(self._recurse_frags(x))
+        """
+        The fragment and all its child flows, depth first, with children ordered by uuid
+        """
+        frags = []
+        stack = [frag]
+        while stack:
+            x = stack.pop()
+            frags.append(x)
+            stack.extend(sorted(x.child_flows, key=lambda z: z.uuid, reverse=True))
         return frags
 
     def save_fragments(self, save_unit_scores=False):
@@ -0,0 +1,206 @@
+"""
+Dependency tracking for termination unit scores.
+
+A process termination's unit score for a quantity depends on the background process (its LCI), and on the
+characterization factors of the quantity for the flows in that LCI.  A context termination's unit score depends on
+the characterization factor of its flow.  Whenever a unit score enters a score cache-- computed, restored from a
+persistent store, prefetched, or added with add_lcia_score()-- it is recorded here along with what it depends on:
+
+ * the process, for process terminations
+ * the quantity
+ * the set of flows whose characterization factors were consulted, taken from the result's details, cutoffs, and
+   zeros.  Where the result does not say (a remote or aggregated score, or one added by hand), the score is assumed
+   to depend on every flow.
+
+When a background process or a characterization factor changes, invalidate_process() or
+invalidate_characterization() removes exactly the unit scores that used it from the score caches.  Invalidation then
+propagates upward: scores cached on terminations to any fragment whose traversal includes an invalidated termination
+(through the parent chain and subfragment terminations, as for fragment revisions) are removed as well.  Scores in an
+attached persistent store (see score_store.py) are removed whether or not they have been loaded: every stored score of
+the process, or every stored score for the quantity, since a stored score does not record the flows it consulted.
+
+A score removed from a score cache by reset_score() or clear_score_cache() is no longer tracked.
+
+Terminations are held by weak reference.
+"""
+
+import weakref
+
+from .score_store import unit_score_store
+
+
+def _result_flows(res):
+    """
+    :param res: an LciaResult
+    :return: frozenset of the links of flows consulted in computing res, or None if not known
+    """
+    flows = set()
+    for c in res.components():
+        details = getattr(c, 'LciaDetails', None)
+        if details is None:
+            return None
+        for d in details:
+            flows.add(d.flow.link)
+    for x in res.cutoffs():
+        flows.add(x.flow.link)
+    for x in res.zeros():
+        flows.add(x.flow.link)
+    if len(flows) == 0:
+        return None
+    return frozenset(flows)
+
+
+def _process_key(term):
+    if term.is_process:
+        return term.term_node.origin, term.term_node.external_ref
+    return None
+
+
+class ScoreDependencies(object):
+    """
+    The dependency graph from processes, quantities, and characterized flows to cached unit scores.  There is a single
+    instance, score_dependencies.
+    """
+    def __init__(self):
+        self._scores = dict()  # (id(term), quantity link): (term weakref, quantity, process key, flows)
+        self._by_process = dict()  # process key: {score keys}
+        self._by_quantity = dict()  # quantity link: {score keys}
+        self._by_term = dict()  # id(term): {score keys}
+
+    def __len__(self):
+        return len(self._scores)
+
+    def record(self, term, quantity, res):
+        """
+        Record the dependencies of a unit score entering a termination's score cache
+        :param term: a FlowTermination
+        :param quantity:
+        :param res: the LciaResult
+        :return:
+        """
+        if not (term.is_process or term.is_context):
+            return
+        key = (id(term), quantity.link)
+        self._discard(key)
+        process = _process_key(term)
+        self._scores[key] = (weakref.ref(term), quantity, process, _result_flows(res))
+        if process is not None:
+            self._by_process.setdefault(process, set()).add(key)
+        self._by_quantity.setdefault(quantity.link, set()).add(key)
+        self._by_term.setdefault(key[0], set()).add(key)
+
+    def _discard(self, key):
+        entry = self._scores.pop(key, None)
+        if entry is None:
+            return None
+        if entry[2] is not None:
+            self._by_process[entry[2]].discard(key)
+        self._by_quantity[entry[1].link].discard(key)
+        keys = self._by_term[key[0]]
+        keys.discard(key)
+        if len(keys) == 0:
+            self._by_term.pop(key[0])
+        return entry
+
+    def forget(self, term, quantity=None):
+        """
+        Stop tracking a termination's unit scores, e.g. when they are removed from its score cache
+        :param term: a FlowTermination
+        :param quantity: [None] only the score for this quantity
+        :return:
+        """
+        if quantity is not None:
+            self._discard((id(term), quantity.link))
+            return
+        for key in list(self._by_term.get(id(term), ())):
+            self._discard(key)
+
+    def dependents(self, process=None, quantity=None, flows=None):
+        """
+        :param process: [None] a process entity or ref
+        :param quantity: [None] a quantity
+        :param flows: [None] flows or flow links, with quantity: only scores that consulted their CFs
+        :return: list of (termination, quantity) whose unit scores depend on the arguments
+        """
+        if process is not None:
+            keys = set(self._by_process.get((process.origin, process.external_ref), ()))
+            if quantity is not None:
+                keys &= self._by_quantity.get(quantity.link, set())
+        elif quantity is not None:
+            keys = set(self._by_quantity.get(quantity.link, ()))
+        else:
+            keys = set(self._scores.keys())
+        if flows is not None:
+            links = set(getattr(f, 'link', f) for f in flows)
+            keys = set(k for k in keys if self._scores[k][3] is None or self._scores[k][3] & links)
+        found = []
+        for k in keys:
+            term = self._scores[k][0]()
+            if term is None:
+                self._discard(k)
+                continue
+            found.append((term, self._scores[k][1]))
+        return found
+
+    def _invalidate(self, dependents):
+        invalidated = []
+        for term, quantity in dependents:
+            term.reset_score(quantity)  # also stops tracking the score
+            invalidated.append(term)
+            invalidated.extend(_invalidate_users(term, quantity))
+        return invalidated
+
+    def invalidate_process(self, process, quantity=None):
+        """
+        Remove the unit scores computed from a background process, e.g. after its LCI has changed
+        :param process: a process entity or ref
+        :param quantity: [None] only scores for this quantity
+        :return: list of the terminations whose scores were removed, including upward propagation
+        """
+        if unit_score_store.enabled:
+            unit_score_store.store.remove(origin=process.origin, external_ref=process.external_ref, quantity=quantity)
+        return self._invalidate(self.dependents(process=process, quantity=quantity))
+
+    def invalidate_characterization(self, quantity, flows=None):
+        """
+        Remove the unit scores that used a quantity's characterization factors, e.g. after they have changed
+        :param quantity:
+        :param flows: [None] the flows whose characterization factors changed.  None means all of them.
+        :return: list of the terminations whose scores were removed, including upward propagation
+        """
+        if unit_score_store.enabled:
+            unit_score_store.store.remove(quantity=quantity)  # stored scores do not record the flows they consulted
+        return self._invalidate(self.dependents(quantity=quantity, flows=flows))
+
+    def clear(self):
+        self._scores = dict()
+        self._by_process = dict()
+        self._by_quantity = dict()
+        self._by_term = dict()
+
+
+def _invalidate_users(term, quantity):
+    """
+    Remove scores for the quantity cached on terminations to any fragment whose traversal includes the termination
+    :param term:
+    :param quantity:
+    :return: list of terminations whose scores were removed
+    """
+    invalidated = []
+    stack = [term._parent]
+    seen = set()
+    while stack:
+        frag = stack.pop()
+        while frag is not None and id(frag) not in seen:
+            seen.add(id(frag))
+            for user in frag._subfragment_users:
+                for t in user._terminations.values():
+                    if t.term_node is frag and t.has_unit_score(quantity):
+                        t.reset_score(quantity)
+                        invalidated.append(t)
+                stack.append(user)
+            frag = frag.reference_entity
+    return invalidated
+
+
+score_dependencies = ScoreDependencies()
@@ -0,0 +1,219 @@
+"""
+Persistent storage of termination unit scores.
+
+Unit scores are kept in each termination's score cache, which lasts as long as the foreground is loaded, and which is
+only saved with the foreground's fragments when save(save_unit_scores=True) is requested (and then only for
+background fragments).  A ScoreStore keeps unit scores in a SQLite database of its own instead, so that a restarted
+service or notebook finds the background LCIA scores it has already computed.
+
+A score is stored under the termination's anchor (the term node's origin and external ref, and the term flow), its
+direction, its inbound exchange value (by which the score is scaled), the child flows of the parent node (which are
+excluded from the score as observed), the quantity, the locale, and a version label for the background data, supplied
+when the store is opened.  Only process terminations
+are stored: context terminations are scored from a single exchange, and subfragment scores depend on a traversal.
+As with saved score caches, only the total score is stored, and a stored score is restored as a unit score with no
+components.
+
+While a store is attached, FlowTermination.score_cache() consults it on a cache miss, before computing the unit score,
+and records every unit score it computes:
+
+    with persistent_scores('unit_scores.sqlite', version='3.9.1') as store:
+        frag.fragment_lcia(quantity)
+
+Writes and removals are committed in batches, and whenever the store is flushed, detached, or closed.  Stored
+scores are only removed by remove(), which score_dependencies.py calls when a process or a characterization changes:
+a structural edit to the foreground changes the key of the affected scores, rather than making stored scores wrong.
+
+The layout of the database is identified by FORMAT, which is recorded in the database itself.  A database written in
+an earlier format is emptied when it is opened, because its keys do not identify a score unambiguously.
+"""
+
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+
+
+FORMAT = 2
+SCHEMA = '''CREATE TABLE IF NOT EXISTS unit_scores (
+    origin TEXT NOT NULL,
+    external_ref TEXT NOT NULL,
+    term_flow TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    inbound_ev REAL NOT NULL,
+    observed TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    locale TEXT NOT NULL,
+    version TEXT NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (origin, external_ref, term_flow, direction, inbound_ev, observed, quantity, locale, version))'''
+
+
+def _observed_key(term):
+    """
+    A digest of the parent node's child flows, which the unit score excludes; '' if there are none
+    """
+    flows = sorted('%s:%s' % (c.flow.link, c.direction) for c in term._parent.child_flows)
+    if len(flows) == 0:
+        return ''
+    return hashlib.sha1('\n'.join(flows).encode()).hexdigest()
+
+
+class ScoreStore(object):
+    """
+    A SQLite database of unit scores.  A connection may only be used from the thread that opened it.
+    """
+    def __init__(self, path, version='', batch=100):
+        """
+        :param path: database file; created if it does not exist
+        :param version: [''] a label for the version of the background data.  Scores stored under other versions are
+         ignored.
+        :param batch: [100] number of writes per commit
+        """
+        self.path = path
+        self.version = str(version)
+        self._batch = batch
+        self._pending = 0
+        self._conn = sqlite3.connect(path)
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] != FORMAT:
+            self._conn.execute('DROP TABLE IF EXISTS unit_scores')
+            self._conn.execute('PRAGMA user_version = %d' % FORMAT)
+        self._conn.execute(SCHEMA)
+        self._conn.commit()
+
+    def key(self, term, quantity):
+        """
+        :param term: a process termination
+        :param quantity:
+        :return: the key under which the termination's unit score is stored
+        """
+        return (term.term_node.origin, term.term_node.external_ref, term.term_flow.link, term.direction,
+                float(term.inbound_exchange_value), _observed_key(term), quantity.link, term.term_locale, self.version)
+
+    def get(self, term, quantity):
+        """
+        :param term:
+        :param quantity:
+        :return: the stored unit score, or None
+        """
+        row = self._conn.execute('SELECT score FROM unit_scores WHERE origin=? AND external_ref=? AND term_flow=? AND '
+                                 'direction=? AND inbound_ev=? AND observed=? AND quantity=? AND locale=? AND '
+                                 'version=?', self.key(term, quantity)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, term, quantity, score):
+        self._conn.execute('INSERT OR REPLACE INTO unit_scores VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           self.key(term, quantity) + (float(score), ))
+        self._pending += 1
+        if self._pending >= self._batch:
+            self.flush()
+
+    def remove(self, origin=None, quantity=None, external_ref=None):
+        """
+        Remove stored scores of the current version
+        :param origin: [None] only scores of processes from this origin
+        :param quantity: [None] only scores for this quantity
+        :param external_ref: [None] only scores of this process
+        :return: number of scores removed
+        """
+        clauses = ['version=?']
+        args = [self.version]
+        if origin is not None:
+            clauses.append('origin=?')
+            args.append(origin)
+        if external_ref is not None:
+            clauses.append('external_ref=?')
+            args.append(external_ref)
+        if quantity is not None:
+            clauses.append('quantity=?')
+            args.append(getattr(quantity, 'link', quantity))
+        n = self._conn.execute('DELETE FROM unit_scores WHERE %s' % ' AND '.join(clauses), args).rowcount
+        self._pending += 1
+        if self._pending >= self._batch:
+            self.flush()
+        return n
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM unit_scores WHERE version=?', (self.version, )).fetchone()[0]
+
+    def flush(self):
+        self._conn.commit()
+        self._pending = 0
+
+    def close(self):
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+
+class UnitScoreStore(object):
+    """
+    Connects score caches to the attached ScoreStore, if any.  There is a single instance, unit_score_store.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._store = None
+
+    @property
+    def store(self):
+        return self._store
+
+    def attach(self, store):
+        if self._store is not None:
+            raise ValueError('A score store is already attached')
+        self._store = store
+        self.enabled = True
+
+    def detach(self):
+        if self._store is not None:
+            self._store.flush()
+        self._store = None
+        self.enabled = False
+
+    def load(self, term, quantity):
+        """
+        Restore a stored unit score into the termination's score cache.  Callers test unit_score_store.enabled first.
+        :param term:
+        :param quantity:
+        :return: True if a score was restored
+        """
+        if not term.is_process:
+            return False
+        score = self._store.get(term, quantity)
+        if score is None:
+            return False
+        term.add_lcia_score(quantity, score)
+        return True
+
+    def save(self, term, quantity, res):
+        """
+        Store a computed unit score.  Callers test unit_score_store.enabled first.
+        :param term:
+        :param quantity:
+        :param res: the LciaResult
+        :return:
+        """
+        if term.is_process:
+            self._store.put(term, quantity, res.total())
+
+
+unit_score_store = UnitScoreStore()
+
+
+@contextmanager
+def persistent_scores(path, version=''):
+    """
+    Consult and update a persistent unit score store within a with block
+    :param path: database file
+    :param version: [''] a label for the version of the background data
+    :return: the ScoreStore
+    """
+    store = ScoreStore(path, version=version)
+    unit_score_store.attach(store)
+    try:
+        yield store
+    finally:
+        unit_score_store.detach()
+        store.close()
@@ -14,6 +14,9 @@ from antelope_core.exchanges import ExchangeValue
 from antelope_core.lcia_results import LciaResult
 from .lcia_dict import LciaResults
 from .models import Anchor, EntityRef, UNRESOLVED_ANCHOR_TYPE
+from .profiling import profiler
+from .score_dependencies import score_dependencies
+from .score_store import unit_score_store
 
 
 # from lcatools.catalog_ref import NoCatalog
@@ -66,6 +69,7 @@ class FlowTermination(object):
     _term_flow = None
     _direction = None
     _descend = True
+    _lcia_results = None
 
     """
     these are stored by scenario in a dict on the mainland
@@ -195,7 +199,6 @@ class FlowTermination(object):
                     entity = None
 
         self._term = entity  # this must have origin, external_ref, and entity_type, and be operable (if ref)
-        self._score_cache = LciaResults(fragment)
 
         self.term_flow = term_flow
         self.direction = _direction
@@ -591,6 +594,17 @@ class FlowTermination(object):
                 for x in self.term_node.unobserved_lci(self._parent.child_flows, ref_flow=self.term_flow):
                     yield x  # this should forward out any cutoff exchanges
 
+    @property
+    def term_locale(self):
+        """
+        The locale of a process termination's unit score
+        :return:
+        """
+        try:
+            return self.term_node['SpatialScope']
+        except KeyError:
+            return 'GLO'
+
     def compute_unit_score(self, quantity_ref, refresh=False, **kwargs):
         """
         four different ways to do this.
@@ -614,10 +628,7 @@ class FlowTermination(object):
 
         else:
             # OK, so we are not frag and we are not context and we are not null-- we are process!
-            try:
-                locale = self.term_node['SpatialScope']
-            except KeyError:
-                locale = 'GLO'
+            locale = self.term_locale
 
             try:
                 res = self.term_node.bg_lcia(quantity_ref, observed=self._parent.child_flows, ref_flow=self.term_flow,
@@ -656,6 +667,46 @@ class FlowTermination(object):
         if self.is_null or self.is_fg:
             return LciaResult(quantity)
 
+        if profiler.enabled:
+            profiler.enter('score', self._parent, self.term_node)
+            try:
+                return self._cached_score(quantity, refresh=refresh, **kwargs)
+            finally:
+                profiler.exit()
+        return self._cached_score(quantity, refresh=refresh, **kwargs)
+
+    def score_caches(self, quantities, refresh=False, **kwargs):
+        """
+        Unit scores for several quantities at once, for batched LCIA.  Equivalent to calling score_cache() for each
+        quantity, except that a subfragment's uncached scores are reported as None rather than raised.
+        :param quantities: a list of quantity refs
+        :param refresh: If True, re-compute unit scores even if they are already present in the cache.
+        :param kwargs:
+        :return: a list of LciaResults (or None), one per quantity, in order
+        """
+        if self.is_null or self.is_fg:
+            return [LciaResult(q) for q in quantities]
+
+        if profiler.enabled:
+            profiler.enter('score', self._parent, self.term_node)
+            try:
+                return self._cached_scores(quantities, refresh=refresh, **kwargs)
+            finally:
+                profiler.exit()
+        return self._cached_scores(quantities, refresh=refresh, **kwargs)
+
+    def _cached_scores(self, quantities, refresh=False, **kwargs):
+        if not self.valid:
+            raise UnresolvedAnchor
+        scores = []
+        for q in quantities:
+            try:
+                scores.append(self._cached_score(q, refresh=refresh, **kwargs))
+            except UnCachedScore:
+                scores.append(None)
+        return scores
+
+    def _cached_score(self, quantity, refresh=False, **kwargs):
         if not self.valid:
             raise UnresolvedAnchor
 
@@ -663,10 +714,16 @@ class FlowTermination(object):
             self._score_cache.pop(quantity, None)
 
         if quantity in self._score_cache:
+            if profiler.enabled:
+                profiler.hit()
             return self._score_cache[quantity]
         else:
+            if profiler.enabled:
+                profiler.miss()
             if self.is_frag:  # but not fg, ergo subfrag
                 raise UnCachedScore(quantity)
+            elif unit_score_store.enabled and not refresh and unit_score_store.load(self, quantity):
+                return self._score_cache[quantity]
             else:
                 '''
                 # This refresh situation is a problem.  On the one hand, if we don't pass refresh on to do_lcia,
@@ -692,14 +749,47 @@ class FlowTermination(object):
                     calling do_lcia() with an inventory that includes them.  This is obviously not ideal, and a new 
                     solution should be sought.  
                 '''
-                res = self.compute_unit_score(quantity, refresh=refresh, **kwargs)
-            if isinstance(res, list):
-                for k in res:
-                    self._score_cache[k.quantity] = k
-            else:
-                self._score_cache[quantity] = res
+                if profiler.enabled:
+                    profiler.enter('unit_score', self._parent, self.term_node)
+                    try:
+                        res = self.compute_unit_score(quantity, refresh=refresh, **kwargs)
+                    finally:
+                        profiler.exit()
+                else:
+                    res = self.compute_unit_score(quantity, refresh=refresh, **kwargs)
+            self.store_unit_score(quantity, res)
+            if unit_score_store.enabled:
+                unit_score_store.save(self, quantity, self._score_cache[quantity])
             return self._score_cache[quantity]
 
+    def has_unit_score(self, quantity):
+        return self._lcia_results is not None and quantity in self._lcia_results
+
+    def store_unit_score(self, quantity, res):
+        """
+        Cache the result of compute_unit_score()
+        :param quantity:
+        :param res: an LciaResult, or a list of LciaResults
+        :return:
+        """
+        if isinstance(res, list):
+            for k in res:
+                self._score_cache[k.quantity] = k
+                score_dependencies.record(self, k.quantity, k)
+        else:
+            self._score_cache[quantity] = res
+            score_dependencies.record(self, quantity, res)
+
+    @property
+    def _score_cache(self):
+        """
+        Created on first use: most terminations, and every cutoff generated during traversal, are never scored
+        :return: an LciaResults
+        """
+        if self._lcia_results is None:
+            self._lcia_results = LciaResults(self._parent)
+        return self._lcia_results
+
     def score_cache_items(self):
         return self._score_cache.items()
 
@@ -708,10 +798,25 @@ class FlowTermination(object):
             print('%s' % v)
 
     def reset_score(self, lcia):
-        self._score_cache.pop(lcia, None)
+        """
+        Remove a unit score from the score cache and from the dependency graph.  A persistent store is left alone: its
+        rows are keyed by the parent node's child flows, so that they remain valid for the configuration they describe
+        :param lcia: a quantity
+        :return:
+        """
+        if self._lcia_results is not None:
+            self._lcia_results.pop(lcia, None)
+        score_dependencies.forget(self, lcia)
 
     def clear_score_cache(self):
-        self._score_cache.clear()
+        """
+        Remove every unit score, as reset_score().  A score cache that was never created is left uncreated.
+        :return:
+        """
+        if self._lcia_results is None:
+            return
+        score_dependencies.forget(self)
+        self._lcia_results.clear()
 
     def _serialize_score_cache(self):
         """
@@ -731,9 +836,10 @@ class FlowTermination(object):
         res = LciaResult(quantity, scenario=scenario)
         res.add_summary(self._parent.external_ref, self._parent, 1.0, score)
         self._score_cache[quantity] = res
+        score_dependencies.record(self, quantity, res)
 
     def _deserialize_score_cache(self, fg, sc, scenario):
-        self._score_cache = LciaResults(self._parent)
+        self._lcia_results = LciaResults(self._parent)
         for i in sc:
             q = fg.catalog_ref(i['quantity']['origin'], i['quantity']['externalId'], entity_type='quantity')
             self.add_lcia_score(q, i['score'], scenario=scenario)
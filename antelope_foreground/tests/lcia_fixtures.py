@@ -0,0 +1,92 @@
+"""
+Building blocks for the LCIA tests: small fragment models whose results can be checked by hand.
+
+Leaves are terminated to NullContext and given unit scores by hand, unless a test needs the scores computed.  Each
+test builds the topology it exercises-- shared subfragments, balance flows, scenarios-- from these pieces.
+"""
+
+from antelope_core.archives import Qdb
+from antelope_core.contexts import NullContext
+from antelope_core.entities import LcFlow
+
+from ..entities.fragment_editor import create_fragment
+
+
+origin = 'test.lcia'
+
+qdb = Qdb.new()
+qi = qdb.make_interface('quantity')
+
+
+def new_flow(name, ref_quantity, **kwargs):
+    return LcFlow.new(name, ref_qty=qi.get_canonical(ref_quantity), origin=origin, **kwargs)
+
+
+def new_fragment(*args, **kwargs):
+    return create_fragment(*args, origin=origin, **kwargs)
+
+
+product = new_flow('A product flow', 'mass')
+emission = new_flow('An emission flow', 'mass')
+fuel = new_flow('A fuel flow', 'mass')
+
+mass = product.reference_entity
+volume = qi.get_canonical('volume')
+
+
+def scored_leaf(parent, flow, value, scores=None, direction='Output', term=NullContext, **kwargs):
+    """
+    A child flow terminated to a context, with unit scores added by hand
+    :param parent:
+    :param flow:
+    :param value: exchange value
+    :param scores: [None] dict of quantity to unit score.  None leaves the scores to be computed.
+    :param direction: ['Output']
+    :param term: [NullContext] the termination
+    :param kwargs: passed to create_fragment()
+    :return: the new fragment
+    """
+    frag = new_fragment(flow, direction, parent=parent, value=value, observe=True, **kwargs)
+    frag.terminate(term)
+    for q, score in (scores or dict()).items():
+        frag.termination().add_lcia_score(q, score)
+    return frag
+
+
+def scored_subfragment(ref_value=2.0, value=3.0, scores=None, **kwargs):
+    """
+    A reference fragment producing ref_value of product, with a single emission of value.  Its unit score per unit of
+    product is value / ref_value times the emission's unit score.
+    :param ref_value: [2.0]
+    :param value: [3.0]
+    :param scores: [{mass: 1.0}] the emission's unit scores
+    :param kwargs: passed to scored_leaf()
+    :return: (the subfragment, its emission)
+    """
+    if scores is None:
+        scores = {mass: 1.0}
+    inner = new_fragment(product, 'Output', value=ref_value, observe=True)
+    e = scored_leaf(inner, emission, value, scores, **kwargs)
+    return inner, e
+
+
+def new_model(**kwargs):
+    """
+    :param kwargs: passed to create_fragment()
+    :return: a reference fragment producing 1 unit of product
+    """
+    return new_fragment(product, 'Output', value=1.0, observe=True, **kwargs)
+
+
+def use_subfragment(parent, sub, value, **kwargs):
+    """
+    An input of product to parent, terminated to a subfragment
+    :param parent:
+    :param sub:
+    :param value:
+    :param kwargs: passed to terminate(), e.g. descend=False
+    :return: the new fragment
+    """
+    frag = new_fragment(product, 'Input', parent=parent, value=value, observe=True)
+    frag.terminate(sub, **kwargs)
+    return frag
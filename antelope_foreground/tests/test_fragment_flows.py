@@ -0,0 +1,40 @@
+import unittest
+
+from ..fragment_flows import group_ios, FlowIndex
+from .lcia_fixtures import product, emission, fuel, new_fragment, new_model
+
+
+class GroupIosTest(unittest.TestCase):
+    def test_group_ios(self):
+        """
+        Repeated flows are netted in order of first appearance; the reference flow passes through above the threshold
+        """
+        top = new_model()
+        top.terminate(top)
+        new_fragment(emission, 'Input', parent=top, value=2.0, observe=True)
+        new_fragment(fuel, 'Input', parent=top, value=1.0, observe=True)
+        new_fragment(emission, 'Output', parent=top, value=0.5, observe=True)
+        new_fragment(product, 'Input', parent=top, value=0.6, observe=True)
+        ios, internal = group_ios(top, top.traverse(observed=True))
+        self.assertEqual(internal[0].fragment, top)
+        self.assertEqual([(x.fragment.flow, x.fragment.direction, x.magnitude) for x in ios],
+                         [(product, 'Output', 1.0), (emission, 'Input', 1.5), (fuel, 'Input', 1.0),
+                          (product, 'Input', 0.6)])
+        ios, _ = group_ios(top, top.traverse(observed=True), passthru_threshold=0.7)
+        self.assertEqual([(x.fragment.flow, x.fragment.direction, x.magnitude) for x in ios],
+                         [(emission, 'Input', 1.5), (fuel, 'Input', 1.0), (product, 'Output', 0.4)])
+
+    def test_group_ios_empty(self):
+        top = new_model()
+        for include_ref_flow in (True, False):
+            self.assertEqual(group_ios(top, [], include_ref_flow=include_ref_flow), ([], []))
+            self.assertEqual(group_ios(top, iter([]), include_ref_flow=include_ref_flow), ([], []))
+
+    def test_flow_index(self):
+        index = FlowIndex()
+        self.assertEqual([index.index(f) for f in (emission, fuel, emission, product)], [0, 1, 0, 2])
+        self.assertEqual(len(index), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from ..lcia_dict import LciaTotals
+from .lcia_fixtures import fuel, mass, volume, scored_leaf
+
+
+class LciaResultsTest(unittest.TestCase):
+    def test_lcia_results_index(self):
+        k = scored_leaf(None, fuel, 1.5, {mass: 2.0, volume: 0.1})
+        res = k.fragment_lcia_many([mass, volume])
+        self.assertIs(res[1], res[volume])
+        self.assertIs(res[volume.link], res[volume])
+        self.assertIs(res[volume.external_ref[:16]], res[volume])
+        self.assertIs(res[mass.origin], res[mass])  # several keys match: the first added
+        self.assertTrue(res['no such quantity'].is_null)
+        self.assertAlmostEqual(res.weighted_total({mass.external_ref: 1.0, volume.link: 10.0}), 2.0 + 1.0)
+        other = scored_leaf(None, fuel, 3.0, {mass: 1.0})
+        totals = LciaTotals([res, other.fragment_lcia_many([volume, mass])])
+        self.assertEqual(totals.keys, [mass, volume])
+        self.assertEqual(totals.values.tolist(), [[2.0, 0.1], [1.0, 0.0]])
+        self.assertEqual(totals.apply_weighting({mass: 2.0}).tolist(), [4.0, 2.0])
+        self.assertEqual(totals.scale({volume: 10.0}).column(volume).tolist(), [1.0, 0.0])
+        res.pop(mass)
+        self.assertIs(res[0], res[volume])
+        self.assertIs(res[mass.origin], res[volume])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from unittest.mock import patch
+
+from antelope import QuantityRequired
+
+from ..terminations import FlowTermination
+from ..prefetch import prefetch_unit_scores
+from .lcia_fixtures import qdb, fuel, mass, scored_leaf, scored_subfragment, new_model, use_subfragment
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_prefetch_unit_scores(self):
+        emissions = qdb.tm['Emissions']
+        inner, e = scored_subfragment(2.0, 3.0, {}, term=emissions)
+        top = new_model()
+        for i in range(2):
+            use_subfragment(top, inner, 4.0)
+        k = scored_leaf(top, fuel, 1.5, term=emissions)
+        ffs = top.traverse(observed=True)
+        self.assertEqual(prefetch_unit_scores(ffs, [mass], threads=4), 2)  # e is reached twice but computed once
+        self.assertTrue(e.termination().has_unit_score(mass))
+        self.assertTrue(k.termination().has_unit_score(mass))
+        self.assertEqual(prefetch_unit_scores(ffs, [mass]), 0)
+        prefetched = top.fragment_lcia(mass).total()
+        self.assertAlmostEqual(prefetched, 2 * 4.0 * 3.0 / 2.0 + 1.5)
+        for frag in (e, k):
+            frag.termination().clear_score_cache()
+        self.assertEqual(top.fragment_lcia(mass).total(), prefetched)
+        for frag in (e, k):
+            frag.termination().clear_score_cache()
+        self.assertEqual(top.fragment_lcia(mass, prefetch=2).total(), prefetched)
+
+    def test_prefetch_errors(self):
+        """
+        Lookup errors are left for the LCIA walk to raise; any other error is raised at once
+        """
+        top = new_model()
+        k = scored_leaf(top, fuel, 1.5, term=qdb.tm['Emissions'])
+        ffs = top.traverse(observed=True)
+        with patch.object(FlowTermination, 'compute_unit_score', side_effect=QuantityRequired):
+            self.assertEqual(prefetch_unit_scores(ffs, [mass]), 1)
+        self.assertFalse(k.termination().has_unit_score(mass))
+        with patch.object(FlowTermination, 'compute_unit_score', side_effect=TypeError):
+            with self.assertRaises(TypeError):
+                prefetch_unit_scores(ffs, [mass])
+        self.assertFalse(k.termination().has_unit_score(mass))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+
+from ..profiling import profiler, profile
+from .lcia_fixtures import mass, scored_subfragment, new_model, use_subfragment
+
+
+class ProfileTest(unittest.TestCase):
+    def test_profile(self):
+        """
+        A subfragment occurring three times is traversed once and scored from the cache thereafter
+        """
+        inner, e = scored_subfragment(2.0, 3.0)
+        top = new_model()
+        for i in range(3):
+            use_subfragment(top, inner, 4.0)
+        with profile() as p:
+            self.assertAlmostEqual(top.fragment_lcia(mass).total(), 18.0)
+        self.assertFalse(profiler.enabled)
+        sub = p.rows(kind='subfragment')
+        self.assertEqual([(s.fragment, s.calls, s.hits, s.misses) for s in sub], [(inner.uuid, 1, 2, 1)])
+        score = p.rows(kind='score')[0]
+        self.assertEqual((score.fragment, score.calls, score.hits), (e.uuid, 3, 3))
+        self.assertEqual(len(p.rows(kind='node')), 6)
+        for row in p.rows():
+            self.assertGreaterEqual(row.inclusive, row.exclusive)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'lcia.folded')
+            p.write_collapsed(path)
+            with open(path) as fp:
+                stacks = [line.rsplit(' ', 1) for line in fp]
+        self.assertIn('traverse:%s;subfragment:%s;node:%s' % (top.uuid, inner.uuid, e.uuid), [k for k, v in stacks])
+        self.assertAlmostEqual(sum(int(v) for k, v in stacks) / 1e6,
+                               sum(row.exclusive for row in p.rows()), places=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
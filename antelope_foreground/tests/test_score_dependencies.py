@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from antelope_core.entities import LcProcess
+
+from ..score_dependencies import score_dependencies
+from ..score_store import persistent_scores
+from .lcia_fixtures import origin, qdb, product, emission, fuel, mass, volume, new_fragment, scored_leaf
+
+
+class ScoreDependenciesTest(unittest.TestCase):
+    def test_score_dependencies(self):
+        p = LcProcess.new('A dependency process', origin=origin)
+        p.add_exchange(emission, 'Output', value=1.0)
+        p.set_reference(emission, 'Output')
+        inner = new_fragment(product, 'Output', value=1.0, observe=True)
+        e = new_fragment(emission, 'Input', parent=inner, value=3.0, observe=True)
+        e.terminate(p)
+        e.termination().add_lcia_score(mass, 2.0)
+        c = scored_leaf(inner, fuel, 1.5, term=qdb.tm['Emissions'])
+        top = new_fragment(product, 'Output', value=1.0, observe=True)
+        s = new_fragment(product, 'Input', parent=top, value=1.0, observe=True)
+        s.terminate(inner, descend=False)
+        s.termination().add_lcia_score(mass, 7.5)  # a fragment-level score computed from inner
+        self.assertAlmostEqual(inner.fragment_lcia(mass).total(), 7.5)
+        self.assertTrue(c.termination().has_unit_score(mass))
+
+        # a CF change for a flow that c does not emit leaves c's computed score alone
+        invalidated = score_dependencies.invalidate_characterization(mass, flows=[emission])
+        self.assertIn(e.termination(), invalidated)  # added by hand: depends on every flow
+        self.assertIn(s.termination(), invalidated)  # propagated upward
+        self.assertNotIn(c.termination(), invalidated)
+        self.assertTrue(c.termination().has_unit_score(mass))
+        self.assertFalse(s.termination().has_unit_score(mass))
+
+        e.termination().add_lcia_score(mass, 2.0)
+        self.assertEqual(score_dependencies.invalidate_process(p, quantity=volume), [])
+        self.assertEqual(score_dependencies.invalidate_process(p), [e.termination()])
+        self.assertFalse(e.termination().has_unit_score(mass))
+        self.assertTrue(c.termination().has_unit_score(mass))
+        self.assertIn(c.termination(), score_dependencies.invalidate_characterization(mass, flows=[fuel]))
+        self.assertFalse(c.termination().has_unit_score(mass))
+
+    def test_reset_score(self):
+        top = new_fragment(product, 'Output', value=1.0, observe=True)
+        c = scored_leaf(top, fuel, 1.5, {mass: 2.0, volume: 0.5})
+        term = c.termination()
+        term.reset_score(mass)
+        self.assertNotIn(term, [t for t, q in score_dependencies.dependents(quantity=mass)])
+        self.assertIn(term, [t for t, q in score_dependencies.dependents(quantity=volume)])
+        term.clear_score_cache()
+        self.assertNotIn(term, [t for t, q in score_dependencies.dependents()])
+        self.assertNotIn(id(term), score_dependencies._by_term)
+
+        unscored = scored_leaf(top, emission, 1.0).termination()
+        unscored.clear_score_cache()
+        self.assertIsNone(unscored._lcia_results)
+
+    def test_invalidate_stored(self):
+        """
+        Stored scores that were never loaded this session are invalidated all the same
+        """
+        p = LcProcess.new('A stored dependency process', origin=origin)
+        p.add_exchange(emission, 'Output', value=1.0)
+        p.set_reference(emission, 'Output')
+        top = new_fragment(product, 'Output', value=1.0, observe=True)
+        e = new_fragment(emission, 'Input', parent=top, value=3.0, observe=True)
+        e.terminate(p)
+        with tempfile.TemporaryDirectory() as tmp:
+            with persistent_scores(os.path.join(tmp, 'unit_scores.sqlite')) as store:
+                store.put(e.termination(), mass, 2.5)
+                store.put(e.termination(), volume, 0.5)
+                fresh = new_fragment(emission, 'Input', parent=top, value=1.0, observe=True)
+                fresh.terminate(p)
+                self.assertEqual(store.get(fresh.termination(), mass), 2.5)  # same key: the term is not scored yet
+                self.assertFalse(fresh.termination().has_unit_score(mass))
+                score_dependencies.invalidate_characterization(mass, flows=[fuel])
+                self.assertIsNone(store.get(fresh.termination(), mass))
+                self.assertEqual(store.get(fresh.termination(), volume), 0.5)
+                score_dependencies.invalidate_process(p)
+                self.assertEqual(len(store), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from antelope_core.entities import LcProcess
+from antelope_core.lcia_results import LciaResult
+
+from ..terminations import FlowTermination
+from ..score_store import FORMAT, ScoreStore, persistent_scores, unit_score_store
+from .lcia_fixtures import origin, product, emission, fuel, mass, volume, new_fragment
+
+
+class ScoreStoreTest(unittest.TestCase):
+    def test_score_store(self):
+        p = LcProcess.new('A stored process', origin=origin)
+        p.add_exchange(emission, 'Output', value=1.0)
+        p.set_reference(emission, 'Output')
+        top = new_fragment(product, 'Output', value=1.0, observe=True)
+        e = new_fragment(emission, 'Input', parent=top, value=3.0, observe=True)
+        e.terminate(p)
+        term = e.termination()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'unit_scores.sqlite')
+            with persistent_scores(path, version='1') as store:
+                store.put(term, mass, 2.5)
+                self.assertTrue(unit_score_store.enabled)
+                self.assertAlmostEqual(top.fragment_lcia(mass).total(), 7.5)
+                fresh = LciaResult(mass)
+                fresh.add_summary(p.external_ref, p, 1.0, 4.0)
+                with patch.object(FlowTermination, 'compute_unit_score', return_value=fresh):
+                    self.assertEqual(term.score_cache(mass, refresh=True).total(), 4.0)  # not the stored score
+                self.assertEqual(store.get(term, mass), 4.0)
+                store.put(term, mass, 2.5)
+            self.assertFalse(unit_score_store.enabled)
+            self.assertTrue(term.has_unit_score(mass))
+            term.clear_score_cache()
+            store = ScoreStore(path, version='1')
+            self.assertEqual(store.get(term, mass), 2.5)
+            self.assertEqual(len(store), 1)
+            other = ScoreStore(path, version='2')
+            self.assertIsNone(other.get(term, mass))
+            other.close()
+            self.assertIsNone(store.get(e.termination(), volume))
+            new_fragment(fuel, 'Output', parent=e, value=1.0, observe=True)  # excluded from the score as observed
+            self.assertIsNone(store.get(term, mass))
+            self.assertEqual(store.remove(quantity=mass), 1)
+            self.assertEqual(len(store), 0)
+            store.close()
+
+    def test_inbound_exchange_value(self):
+        """
+        Terminations to the same process whose scores are scaled differently are stored apart
+        """
+        p = LcProcess.new('A two-way process', origin=origin)
+        p.add_exchange(emission, 'Output', value=1.0)
+        p.set_reference(emission, 'Output')
+        top = new_fragment(product, 'Output', value=1.0, observe=True)
+        consumes = new_fragment(emission, 'Input', parent=top, value=1.0, observe=True)
+        consumes.terminate(p)
+        emits = new_fragment(emission, 'Output', parent=top, value=1.0, observe=True)
+        emits.terminate(p)
+        self.assertEqual([f.termination().inbound_exchange_value for f in (consumes, emits)], [1.0, -1.0])
+        with tempfile.TemporaryDirectory() as tmp:
+            store = ScoreStore(os.path.join(tmp, 'unit_scores.sqlite'))
+            store.put(consumes.termination(), mass, 2.5)
+            store.put(emits.termination(), mass, -2.5)
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store.get(consumes.termination(), mass), 2.5)
+            self.assertEqual(store.get(emits.termination(), mass), -2.5)
+            store.close()
+
+    def test_reset_score(self):
+        """
+        Removing scores from a score cache, e.g. after a structural edit, leaves the stored scores alone
+        """
+        p = LcProcess.new('A reset process', origin=origin)
+        p.add_exchange(emission, 'Output', value=1.0)
+        p.set_reference(emission, 'Output')
+        top = new_fragment(product, 'Output', value=1.0, observe=True)
+        e = new_fragment(emission, 'Input', parent=top, value=3.0, observe=True)
+        e.terminate(p)
+        term = e.termination()
+        with tempfile.TemporaryDirectory() as tmp:
+            with persistent_scores(os.path.join(tmp, 'unit_scores.sqlite')) as store:
+                for q, score in ((mass, 2.5), (volume, 0.5)):
+                    term.add_lcia_score(q, score)
+                    unit_score_store.save(term, q, term.score_cache(q))
+                term.reset_score(mass)
+                self.assertFalse(term.has_unit_score(mass))
+                self.assertEqual(store.get(term, mass), 2.5)
+                c = new_fragment(fuel, 'Output', parent=e, value=1.0, observe=True)
+                self.assertFalse(term.has_unit_score(volume))
+                self.assertEqual(len(store), 2)
+                c.unset_parent()
+                self.assertEqual(store.get(term, volume), 0.5)  # the configuration it was stored under
+
+    def test_earlier_format(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'unit_scores.sqlite')
+            conn = sqlite3.connect(path)
+            conn.execute('''CREATE TABLE unit_scores (origin TEXT, external_ref TEXT, term_flow TEXT, direction TEXT,
+                observed TEXT, quantity TEXT, locale TEXT, version TEXT, score REAL)''')
+            conn.execute("INSERT INTO unit_scores VALUES ('o', 'p', 'f', 'Output', '', 'q', 'GLO', '', 1.0)")
+            conn.commit()
+            conn.close()
+            store = ScoreStore(path)
+            self.assertEqual(len(store), 0)
+            self.assertEqual(store._conn.execute('PRAGMA user_version').fetchone()[0], FORMAT)
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+
+from ..tracing import tracer, trace, TraceLog
+from .lcia_fixtures import product, new_fragment, new_model
+
+
+class TracingTest(unittest.TestCase):
+    def test_tracing(self):
+        top = new_model()
+        top.terminate(top)
+        b = new_fragment(product, 'Output', parent=top, balance=True)
+        new_fragment(product, 'Input', parent=top, value=4.0, observe=True)
+        self.assertFalse(tracer.enabled)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.jsonl')
+            with trace(path=path) as log:
+                self.assertTrue(tracer.enabled)
+                top.traverse(observed=True)
+            self.assertFalse(tracer.enabled)
+            bal = log.events(top, 'balance_value')
+            self.assertEqual(len(bal), 1)
+            self.assertEqual((bal[0].fields['value'], bal[0].fields['balance_flow']), (3.0, b.uuid))
+            self.assertEqual(bal[0].message, '3 balance value passed to %.3s (Output)' % b.uuid)
+            replayed = TraceLog.load(path)
+            self.assertEqual([e.serialize() for e in replayed], [e.serialize() for e in log])
+        top.set_debug_threshold(2)
+        self.assertTrue(tracer.enabled)
+        top.set_debug_threshold(-1)
+        self.assertFalse(tracer.enabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
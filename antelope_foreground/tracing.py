@@ -0,0 +1,223 @@
+"""
+Structured tracing of fragment traversal.
+
+The traversal reports what it is doing-- balance computations, subfragment matching, autoconsumption decisions-- as
+events: a name, a level of detail, and a few fields of plain data.  Every report is guarded by a test of
+tracer.enabled, so when nothing is listening the event is never constructed and no message is ever formatted:
+
+    if tracer.enabled:
+        tracer.event(frag, 'node_flow', magnitude=magnitude, node_weight=node_weight)
+
+Events are delivered to any number of TraceLogs, which capture them in a ring buffer of fixed capacity and optionally
+write them to a file as JSON lines.  A TraceLog can later be reloaded from its file and replayed, in whole or for one
+fragment at a time:
+
+    with trace(path='traversal.jsonl') as log:
+        frag.traverse(scenario)
+    log.replay(frag)
+
+LcFragment.set_debug_threshold() still works as before: it asks the tracer to echo a fragment's events to the
+console, in the format of the dbg_print() messages they replace, at levels of detail below the threshold.
+"""
+
+import json
+from collections import deque
+from contextlib import contextmanager
+
+
+EVENTS = {
+    # node flows
+    'balance_ev': '{ev:g} balance',
+    'unobserved_reference': 'Unobserved reference fragment',
+    'node_flow': 'magnitude: {magnitude:g} node_weight: {node_weight:g}',
+    'found_balance': 'Found balance flow',
+    'conserved_cf': 'consrv cf {cf:g} for qty {quantity}',
+    'conserved_value': 'conserved_val {value:g}',
+    # conservation
+    'inbound_balance': '{stock:g} inbound-balance',
+    'accumulate': '{value:g} returned cons_value',
+    'balance_magnitude': '{stock:g} bal magnitude on {balance_flow:.3}',
+    'quash_balance': 'Quashing <1e-10 balance flow ({stock:g} vs {inflow:g})',
+    'balance_value': '{value:g} balance value passed to {balance_flow:.3} ({direction})',
+    # traversal
+    'zero_magnitude': 'zero magnitude',
+    'cutoff': 'cutoff or bg',
+    'fg': 'fg',
+    'subfrag': 'subfrag',
+    'zero_inbound': 'subfragment divide by zero',  # column traversals add the column
+    'child_ev': 'traversing child flow {child:.5} with ev = {ev:g}',
+    'no_driving_flow': 'no driving flows found for child flow {child:.5}',
+    # subfragment matching
+    'matched_flow': 'matched flow {flow}',
+    'reverse_driven': 'reverse-driven subfragment {match:.3}',
+    'subfrags': '{count:d} subfrags resulting from this traversal',
+    # group_ios
+    'ref_flow': 'uncomplicated ref flow',
+    'autoconsumption': 'autoconsumption {value:g} {ref_magnitude:g}',
+    'pass_thru': 'pass thru no effect {value:g} {ref_magnitude:g}',
+    'cumulation': 'cumulation! {value:g} {ref_magnitude:g}',
+    'quash_io': 'Quashing balance flow < 1e-12 magnitude ({flow}: {value:g}, {abs_magnitude:g})',
+}
+
+
+class TraceEvent(object):
+    """
+    One traversal event.  Fields are plain data (numbers and strings), so that events can be written as JSON.
+    """
+    __slots__ = ('seq', 'fragment', 'event', 'level', 'fields')
+
+    def __init__(self, seq, fragment, event, level, fields):
+        self.seq = seq
+        self.fragment = fragment
+        self.event = event
+        self.level = level
+        self.fields = fields
+
+    @property
+    def message(self):
+        return EVENTS[self.event].format(**self.fields)
+
+    def serialize(self):
+        return {'seq': self.seq, 'fragment': self.fragment, 'event': self.event, 'level': self.level,
+                'fields': self.fields}
+
+    @classmethod
+    def from_json(cls, j):
+        return cls(j['seq'], j['fragment'], j['event'], j['level'], j['fields'])
+
+    def __str__(self):
+        return '%6d %.5s %s' % (self.seq, self.fragment, self.message)
+
+
+class Tracer(object):
+    """
+    The switchboard between the traversal and whatever is listening.  There is a single instance, tracer.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._logs = []
+        self._echo = dict()  # fragment uuid: threshold
+        self._seq = 0
+
+    def _update(self):
+        self.enabled = bool(self._logs or self._echo)
+
+    def attach(self, log):
+        self._logs.append(log)
+        self._update()
+
+    def detach(self, log):
+        self._logs.remove(log)
+        self._update()
+
+    def echo(self, fragment, threshold):
+        """
+        Print a fragment's events to the console, as dbg_print() used to.
+        :param fragment: an LcFragment or its uuid
+        :param threshold: events are printed if their level is less than this.  0 or less stops echoing.
+        :return:
+        """
+        uuid = getattr(fragment, 'uuid', fragment)
+        if threshold > 0:
+            self._echo[uuid] = threshold
+        else:
+            self._echo.pop(uuid, None)
+        self._update()
+
+    def event(self, fragment, event, level=1, **fields):
+        """
+        Report an event.  Callers test tracer.enabled first.
+        :param fragment: the fragment the event concerns
+        :param event: an event name, one of EVENTS
+        :param level: [1] level of detail; higher is more verbose
+        :param fields: plain-data values for the event's message
+        :return:
+        """
+        self._seq += 1
+        ev = TraceEvent(self._seq, fragment.uuid, event, level, fields)
+        for log in self._logs:
+            log.append(ev)
+        threshold = self._echo.get(ev.fragment)
+        if threshold is not None and level < threshold:
+            print('%.3s %s' % (ev.fragment, ev.message))
+
+
+tracer = Tracer()
+
+
+class TraceLog(object):
+    """
+    A ring buffer of TraceEvents, optionally also written to a file as JSON lines.
+    """
+    def __init__(self, capacity=None, path=None):
+        """
+        :param capacity: [None] number of events to retain in memory; older events are discarded.  None is unbounded.
+        :param path: [None] file to which every event is written, one JSON object per line
+        """
+        self._events = deque(maxlen=capacity)
+        self._file = None if path is None else open(path, 'w')
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: a file written by a TraceLog
+        :return: a TraceLog containing the file's events
+        """
+        log = cls()
+        with open(path) as fp:
+            for line in fp:
+                if line.strip():
+                    log._events.append(TraceEvent.from_json(json.loads(line)))
+        return log
+
+    def append(self, event):
+        self._events.append(event)
+        if self._file is not None:
+            self._file.write(json.dumps(event.serialize()) + '\n')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def events(self, fragment=None, event=None):
+        """
+        :param fragment: [None] a fragment or uuid, to select its events only
+        :param event: [None] an event name, to select those events only
+        :return: a list of TraceEvents, in order
+        """
+        uuid = getattr(fragment, 'uuid', fragment)
+        return [e for e in self._events if (uuid is None or e.fragment == uuid) and (event is None or e.event == event)]
+
+    def replay(self, fragment=None, event=None):
+        """
+        Print the selected events, in order
+        :param fragment:
+        :param event:
+        :return:
+        """
+        for e in self.events(fragment=fragment, event=event):
+            print('%s' % e)
+
+
+@contextmanager
+def trace(capacity=100000, path=None):
+    """
+    Capture the traversal events generated within a with block
+    :param capacity: [100000] number of events to retain in memory
+    :param path: [None] file to which every event is written, one JSON object per line
+    :return: a TraceLog
+    """
+    log = TraceLog(capacity=capacity, path=path)
+    tracer.attach(log)
+    try:
+        yield log
+    finally:
+        tracer.detach(log)
+        log.close()
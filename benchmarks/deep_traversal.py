@@ -0,0 +1,190 @@
+"""
+Benchmark for fragment walks on very deep models.
+
+Two synthetic models are built at each depth:
+ * chain: a foreground chain, each node having one foreground child and one cutoff
+ * nested: a stack of subfragments, each one driving the next, alternating descend / non-descend
+
+and the following are timed on each: traverse(), tree(), nodes(), scenarios(), _recurse_frags() and
+fragment_lcia() (with unit scores cached on the cutoffs).
+
+Usage:
+    python benchmarks/deep_traversal.py [--depths 100 500 1000 5000] [--repeat 3] [--json]
+    python benchmarks/deep_traversal.py --compare /path/to/other/checkout [--recursion-limit 100000]
+
+--compare runs the same benchmark in a subprocess against another source tree (e.g. a worktree of an earlier
+commit, in which these walks were recursive) and reports both side by side.  The recursion limit and thread stack
+size are raised in both runs so that recursive implementations get as far as they can; failures are reported as
+the exception name.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from antelope_core.archives import Qdb
+from antelope_core.contexts import NullContext
+from antelope_core.entities import LcFlow
+
+from antelope_foreground.entities.fragment_editor import create_fragment
+from antelope_foreground.providers.lc_foreground import LcForeground
+
+
+ORIGIN = 'benchmark.deep'
+WALKS = ('traverse', 'tree', 'nodes', 'scenarios', 'recurse_frags', 'fragment_lcia')
+
+
+class _Model(object):
+    def __init__(self):
+        self.qdb = Qdb.new()
+        self.qi = self.qdb.make_interface('quantity')
+        self.mass = self.qi.get_canonical('mass')
+        self.flow = LcFlow.new('benchmark flow', ref_qty=self.mass, origin=ORIGIN)
+
+    def new_fragment(self, direction, **kwargs):
+        return create_fragment(self.flow, direction, origin=ORIGIN, observe=True, **kwargs)
+
+    def _cutoff(self, parent, value):
+        c = self.new_fragment('Output', parent=parent, value=value)
+        c.terminate(NullContext)
+        c.termination().add_lcia_score(self.mass, 1.0)
+        return c
+
+    def chain(self, depth):
+        top = self.new_fragment('Output', value=1.0)
+        top.set_exchange_value('benchmark', 1.5)
+        prev = top
+        for i in range(depth):
+            c = self.new_fragment('Input', parent=prev, value=0.999)
+            c.terminate(c)
+            self._cutoff(prev, 0.001)
+            prev = c
+        return top
+
+    def nested(self, depth):
+        inner = self.new_fragment('Output', value=1.0)
+        inner.set_exchange_value('__internal', 2.0)
+        self._cutoff(inner, 1.0)
+        for i in range(depth):
+            outer = self.new_fragment('Output', value=1.0)
+            c = self.new_fragment('Input', parent=outer, value=1.0)
+            c.terminate(inner, descend=bool(i % 2))
+            inner = outer
+        return inner
+
+
+class _Fg(object):
+    """
+    stand-in for an LcForeground, which is not needed to enumerate a fragment's child flows
+    """
+    def _recurse_frags(self, frag):
+        return LcForeground._recurse_frags(self, frag)
+
+
+def _walk(model, frag, walk):
+    if walk == 'traverse':
+        return len(frag.traverse())
+    if walk == 'tree':
+        return len(list(frag.tree()))
+    if walk == 'nodes':
+        return len(list(frag.nodes()))
+    if walk == 'scenarios':
+        return len(list(frag.scenarios()))
+    if walk == 'recurse_frags':
+        return len(_Fg()._recurse_frags(frag))
+    if walk == 'fragment_lcia':
+        return frag.fragment_lcia(model.mass).total()
+    raise ValueError(walk)
+
+
+def _time(model, frag, walk, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        try:
+            _walk(model, frag, walk)
+        except Exception as e:  # report, e.g., RecursionError
+            return type(e).__name__
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def run(depths, repeat):
+    model = _Model()
+    results = []
+    for depth in depths:
+        for shape in ('chain', 'nested'):
+            frag = getattr(model, shape)(depth)
+            for walk in WALKS:
+                results.append({'shape': shape, 'depth': depth, 'walk': walk,
+                                'seconds': _time(model, frag, walk, repeat)})
+    return results
+
+
+def _run_in_thread(depths, repeat, recursion_limit):
+    sys.setrecursionlimit(recursion_limit)
+    threading.stack_size(512 * 1024 * 1024)
+    out = []
+    t = threading.Thread(target=lambda: out.extend(run(depths, repeat)))
+    t.start()
+    t.join()
+    return out
+
+
+def _fmt(v):
+    if isinstance(v, float):
+        return '%10.4f' % v
+    return '%10.10s' % v
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depths', type=int, nargs='+', default=[100, 500, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--recursion-limit', type=int, default=100000)
+    parser.add_argument('--compare', default=None, help='source tree to benchmark against')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = _run_in_thread(args.depths, args.repeat, args.recursion_limit)
+
+    if args.compare is None:
+        if args.json:
+            print(json.dumps(results))
+            return
+        print('%-7s %6s %-14s %10s' % ('shape', 'depth', 'walk', 'seconds'))
+        for r in results:
+            print('%-7s %6d %-14s %s' % (r['shape'], r['depth'], r['walk'], _fmt(r['seconds'])))
+        return
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.abspath(args.compare)
+    cmd = [sys.executable, os.path.abspath(__file__), '--json', '--repeat', str(args.repeat),
+           '--recursion-limit', str(args.recursion_limit), '--depths'] + [str(d) for d in args.depths]
+    p = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, cwd=os.path.abspath(args.compare))
+    try:
+        other = json.loads(p.stdout.decode().splitlines()[-1])  # the catalog may log to stdout
+    except (ValueError, IndexError):
+        other = [{'seconds': 'exit %d' % p.returncode}] * len(results)
+
+    if args.json:
+        print(json.dumps({'this': results, 'compare': other}))
+        return
+    print('%-7s %6s %-14s %10s %10s %8s' % ('shape', 'depth', 'walk', 'this', 'compare', 'speedup'))
+    for r, o in zip(results, other):
+        a, b = r['seconds'], o['seconds']
+        if isinstance(a, float) and isinstance(b, float) and a > 0:
+            speedup = '%7.2fx' % (b / a)
+        else:
+            speedup = '%8s' % '--'
+        print('%-7s %6d %-14s %s %s %s' % (r['shape'], r['depth'], r['walk'], _fmt(a), _fmt(b), speedup))
+
+
+if __name__ == '__main__':
+    main()
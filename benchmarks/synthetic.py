@@ -0,0 +1,196 @@
+"""
+Synthetic foreground models for benchmarking.
+
+A SyntheticForeground builds, in a scratch directory, a catalog with a small local background (an archive of
+single-output processes, registered with the catalog but never written to the catalog's resources) and a foreground
+containing one reference model whose shape is set by a Shape:
+
+ * depth: number of levels of foreground nodes below the reference flow
+ * fanout: number of child flows of each foreground node
+ * shared: number of subfragments, each terminating several leaves of the model (and so traversed many times)
+ * balance: number of foreground nodes given a balance flow, conserving mass
+ * scenarios: number of named scenarios, each altering the exchange values of about a tenth of the nodes
+ * processes: number of background processes terminating the model's leaves
+
+Leaves of the model and of its subfragments are terminated to background processes or (with probability 1/4, if there
+are any) to the shared subfragments.  Every process termination is given a unit score for mass, since the local
+background provides no LCIA of its own.  Construction is deterministic for a given seed.
+"""
+
+import os
+import random
+from collections import deque
+
+from antelope_core.archives import LcArchive
+from antelope_core.entities import LcFlow, LcProcess
+
+from antelope_foreground.entities.fragment_editor import create_fragment
+from antelope_foreground.foreground_catalog import ForegroundCatalog
+from antelope_foreground.providers.lc_foreground import LcForeground
+
+
+BACKGROUND = 'synthetic.background'
+FOREGROUND = 'synthetic.foreground'
+
+
+class Shape(object):
+    """
+    The tunable parameters of a synthetic model
+    """
+    _fields = ('depth', 'fanout', 'shared', 'balance', 'scenarios', 'processes', 'seed')
+
+    def __init__(self, depth=4, fanout=3, shared=2, balance=2, scenarios=3, processes=20, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.shared = shared
+        self.balance = balance
+        self.scenarios = scenarios
+        self.processes = processes
+        self.seed = seed
+
+    @property
+    def scenario_names(self):
+        return ['scenario %d' % k for k in range(self.scenarios)]
+
+    @property
+    def label(self):
+        return 'd%d-f%d-s%d-b%d-n%d-p%d' % (self.depth, self.fanout, self.shared, self.balance, self.scenarios,
+                                            self.processes)
+
+    def serialize(self):
+        return {k: getattr(self, k) for k in self._fields}
+
+    def __str__(self):
+        return self.label
+
+
+class SyntheticForeground(object):
+    def __init__(self, root, shape=None):
+        """
+        :param root: a scratch directory; it will contain the catalog, the background, and the saved foreground
+        :param shape: [None] a Shape; default Shape()
+        """
+        self.root = root
+        self.shape = shape or Shape()
+        self._rng = random.Random(self.shape.seed)
+        self.catalog = ForegroundCatalog(os.path.join(root, 'catalog'))
+        self.mass = self.catalog.get_canonical('mass')
+        self.unit_scores = dict()  # process external ref: unit score
+        self.processes = self._background()
+
+        self.foreground = LcForeground(self.fg_path, catalog=self.catalog, ref=FOREGROUND)
+        self.flow = LcFlow.new('synthetic product', ref_qty=self.mass, origin=FOREGROUND)
+        self.subfragments = []
+        for k in range(self.shape.shared):
+            sub = self._new_fragment('Output', value=1.0, Name='shared subfragment %d' % k)
+            self._grow(sub, max(1, self.shape.depth // 2))
+            self.subfragments.append(sub)
+        self.model = self._new_fragment('Output', value=1.0, Name='synthetic model')
+        self._grow(self.model, self.shape.depth)
+        self._balance(self.model)
+
+        for frag in self.subfragments + [self.model]:
+            self.foreground.add_entity_and_children(frag)
+        self.seed_scores(self.fragments)
+
+    @property
+    def fg_path(self):
+        return os.path.join(self.root, 'foreground')
+
+    @property
+    def fragments(self):
+        """
+        :return: the reference fragments of the model: the shared subfragments and the model itself
+        """
+        return self.subfragments + [self.model]
+
+    def _background(self):
+        bg = LcArchive(os.path.join(self.root, 'background.json'), ref=BACKGROUND)
+        for k in range(self.shape.processes):
+            flow = LcFlow.new('background product %d' % k, ref_qty=self.mass, origin=BACKGROUND)
+            bg.add(flow)
+            p = LcProcess.new('background process %d' % k, origin=BACKGROUND)
+            p.add_exchange(flow, 'Output', value=1.0)
+            p.set_reference(flow, 'Output')
+            bg.add(p)
+            self.unit_scores[p.external_ref] = self._rng.uniform(0.1, 10.0)
+        bg.write_to_file(bg.source, gzip=False)
+        self.catalog.add_existing_archive(bg, interfaces=('basic', 'exchange'), store=False)
+        q = self.catalog.query(BACKGROUND)
+        return [q.get(ref) for ref in sorted(self.unit_scores.keys())]
+
+    def _new_fragment(self, direction, **kwargs):
+        return create_fragment(self.flow, direction, origin=FOREGROUND, observe=True, **kwargs)
+
+    def _vary(self, frag, value):
+        for name in self.shape.scenario_names:
+            if self._rng.random() < 0.1:
+                frag.set_exchange_value(name, value * self._rng.uniform(0.5, 1.5))
+
+    def _terminate_leaf(self, frag):
+        if self.subfragments and self._rng.random() < 0.25:
+            frag.terminate(self._rng.choice(self.subfragments))
+        else:
+            frag.terminate(self._rng.choice(self.processes))
+
+    def _grow(self, parent, depth):
+        """
+        Add depth levels of nodes below parent, breadth-first
+        :param parent:
+        :param depth:
+        :return:
+        """
+        level = [parent]
+        for d in range(depth):
+            nxt = []
+            for node in level:
+                for j in range(self.shape.fanout):
+                    value = self._rng.uniform(0.05, 0.3)
+                    c = self._new_fragment('Input', parent=node, value=value)
+                    self._vary(c, value)
+                    nxt.append(c)
+            level = nxt
+        for leaf in level:
+            self._terminate_leaf(leaf)
+
+    def _balance(self, model):
+        """
+        Give a balance flow to the first [shape.balance] foreground nodes of the model, in breadth-first order
+        :param model:
+        :return:
+        """
+        nodes = []
+        queue = deque([model])
+        while queue and len(nodes) < self.shape.balance:
+            node = queue.popleft()
+            if node.child_flows:
+                nodes.append(node)
+                queue.extend(node.child_flows)
+        for node in nodes:
+            b = self._new_fragment('Output', parent=node, balance=True)
+            b.terminate(self._rng.choice(self.processes))
+
+    def seed_scores(self, fragments):
+        """
+        Give every process termination within the fragments its unit score.  Must be repeated after the foreground is
+        reloaded, because unit scores are only saved for terminations to background processes.
+        :param fragments: reference fragments
+        :return:
+        """
+        for top in fragments:
+            for node in top.tree():
+                term = node.termination()
+                if term.is_process and term.term_node.external_ref in self.unit_scores:
+                    term.add_lcia_score(self.mass, self.unit_scores[term.term_node.external_ref])
+
+    def save(self):
+        self.foreground.save()
+
+    def load(self):
+        """
+        Load the saved foreground into a new LcForeground
+        :return: the new foreground's reference fragments, in the order of self.fragments
+        """
+        fg = LcForeground(self.fg_path, catalog=self.catalog, ref=FOREGROUND)
+        fg.make_interface('foreground')  # loads the fragments
+        return [fg[f.external_ref] for f in self.fragments]
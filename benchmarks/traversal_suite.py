@@ -0,0 +1,183 @@
+"""
+Benchmark suite for traversal, LCIA, and persistence on synthetic foregrounds (see synthetic.py).
+
+For each model shape, the following are timed (best of --repeat runs):
+ * build: construction of the model, its background, and its unit scores
+ * traverse: traverse() of the model under the default scenario and each named scenario
+ * traverse_many: traverse_many() of the model under the same scenarios at once
+ * unit_inventory: unit_inventory() of the model under the same scenarios
+ * fragment_lcia: fragment_lcia() of the model under the same scenarios
+ * save: saving the foreground
+ * load: loading the saved foreground, fragments included, into a new LcForeground
+
+Each run is appended to a JSON history file, along with the time, the git revision of the source tree, and the
+Python version, and compared with the most recent earlier run of the same shapes, so that regressions are visible
+between releases.  Timings more than --tolerance slower than the earlier run are marked.
+
+Usage:
+    python benchmarks/traversal_suite.py [--preset small wide deep] [--repeat 3] [--history traversal_history.json]
+    python benchmarks/traversal_suite.py --depth 5 --fanout 4 --shared 3 --balance 2 --scenarios 4 --processes 50
+    python benchmarks/traversal_suite.py --no-history --json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from antelope_foreground.entities.traversal_matrix import traverse_many
+
+from synthetic import Shape, SyntheticForeground
+
+
+PRESETS = {
+    'small': Shape(depth=3, fanout=3, shared=2, balance=1, scenarios=2, processes=10),
+    'wide': Shape(depth=3, fanout=8, shared=4, balance=2, scenarios=4, processes=50),
+    'deep': Shape(depth=8, fanout=2, shared=4, balance=4, scenarios=4, processes=50),
+}
+TIMINGS = ('build', 'traverse', 'traverse_many', 'unit_inventory', 'fragment_lcia', 'save', 'load')
+
+
+def _best(func, repeat):
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def _scenarios(shape):
+    return [None] + shape.scenario_names
+
+
+def run_shape(shape, repeat):
+    """
+    :param shape: a Shape
+    :param repeat: number of runs of each timing
+    :return: dict of results
+    """
+    root = tempfile.mkdtemp(prefix='antelope-bench-')
+    try:
+        t0 = time.perf_counter()
+        model = SyntheticForeground(root, shape)
+        timings = {'build': time.perf_counter() - t0}
+        frag = model.model
+        scenarios = _scenarios(shape)
+
+        timings['traverse'] = _best(lambda: [frag.traverse(s, observed=True) for s in scenarios], repeat)
+        timings['traverse_many'] = _best(lambda: traverse_many(frag, scenarios, observed=True), repeat)
+        timings['unit_inventory'] = _best(lambda: [frag.unit_inventory(s, observed=True) for s in scenarios], repeat)
+        timings['fragment_lcia'] = _best(lambda: [frag.fragment_lcia(model.mass, scenario=s) for s in scenarios],
+                                         repeat)
+        timings['save'] = _best(model.save, repeat)
+        timings['load'] = _best(model.load, repeat)
+
+        return {'shape': shape.label,
+                'params': shape.serialize(),
+                'nodes': sum(len(list(f.tree())) for f in model.fragments),
+                'flows': len(frag.traverse(observed=True)),
+                'seconds': timings}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        p = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=here, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    return p.stdout.decode().strip() or None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_history(path, history):
+    with open(path, 'w') as fp:
+        json.dump(history, fp, indent=2, sort_keys=True)
+
+
+def previous(history, result):
+    """
+    :param history: a list of runs, oldest first
+    :param result: a result from run_shape()
+    :return: the result of the most recent run in the history with the same shape, or None
+    """
+    for entry in reversed(history):
+        for r in entry['results']:
+            if r['params'] == result['params']:
+                return r
+    return None
+
+
+def report(results, history, tolerance):
+    print('%-22s %6s %-15s %10s %10s %8s' % ('shape', 'nodes', 'timing', 'seconds', 'previous', 'ratio'))
+    regressions = 0
+    for r in results:
+        prior = previous(history, r)
+        for k in TIMINGS:
+            a = r['seconds'][k]
+            b = None if prior is None else prior['seconds'].get(k)
+            if b:
+                ratio = a / b
+                flag = ' *' if ratio > 1.0 + tolerance else ''
+                regressions += bool(flag)
+                print('%-22s %6d %-15s %10.4f %10.4f %7.2fx%s' % (r['shape'], r['nodes'], k, a, b, ratio, flag))
+            else:
+                print('%-22s %6d %-15s %10.4f %10s %8s' % (r['shape'], r['nodes'], k, a, '--', '--'))
+    if regressions:
+        print('* %d timings more than %d%% slower than the previous run' % (regressions, round(tolerance * 100)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', nargs='+', choices=sorted(PRESETS.keys()), default=None,
+                        help='model shapes to run (default: all presets, unless a shape is given)')
+    for k in Shape._fields:
+        parser.add_argument('--%s' % k, type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--history', default='traversal_history.json', help='JSON file of earlier runs')
+    parser.add_argument('--no-history', action='store_true', help='neither read nor write the history')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='fractional slow-down marked as a regression')
+    parser.add_argument('--json', action='store_true', help='print this run as JSON')
+    args = parser.parse_args()
+
+    custom = {k: getattr(args, k) for k in Shape._fields if getattr(args, k) is not None}
+    shapes = [PRESETS[p] for p in (args.preset or [])]
+    if custom:
+        shapes.append(Shape(**custom))
+    elif not shapes:
+        shapes = [PRESETS[p] for p in sorted(PRESETS.keys())]
+
+    entry = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+             'revision': _revision(),
+             'python': platform.python_version(),
+             'results': [run_shape(shape, args.repeat) for shape in shapes]}
+
+    history = [] if args.no_history else load_history(args.history)
+    if args.json:
+        print(json.dumps(entry))  # the catalog logs to stdout, so this must be the last line
+    else:
+        print('revision %s' % entry['revision'])
+        report(entry['results'], history, args.tolerance)
+    if not args.no_history:
+        history.append(entry)
+        save_history(args.history, history)
+
+
+if __name__ == '__main__':
+    main()
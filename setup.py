@@ -3,7 +3,9 @@ from setuptools import setup, find_packages
 VERSION = '0.2.1'
 
 requires = [
-    'antelope_core>=0.2.1'
+    'antelope_core>=0.2.1',
+    'numpy',
+    'scipy'
 ]
 
 """